@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+
+def cache_key(key: str) -> str:
+    return f'auth_token:{key}'
+
+
+def get_auth_cache():
+    return caches[settings.AUTH_TOKEN_CACHE_ALIAS]
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthenticationの結果(ユーザーとトークン)をキャッシュする
+    リクエストごとのToken+Userの結合クエリを省く。
+    キャッシュはトークンの削除(ログアウト)とユーザーの保存・削除のシグナルで消す(account.signals)
+    消せるのはシグナルを受けたプロセスから見えるキャッシュだけなので、複数ワーカーでは
+    共有のキャッシュにするか、TTLを短くする(LocMemCacheのデフォルトは10秒)
+    """
+
+    def authenticate_credentials(self, key):
+        cache = get_auth_cache()
+        cached = cache.get(cache_key(key))
+        if cached is not None:
+            return cached
+        user, token = super().authenticate_credentials(key)
+        cache.set(cache_key(key), (user, token))
+        return user, token
+
+
+def invalidate_tokens(*keys):
+    get_auth_cache().delete_many([cache_key(key) for key in keys])
@@ -0,0 +1,24 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .authentication import invalidate_tokens
+from .models import User
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    """トークンの削除(djoserのログアウトなど)で認証のキャッシュを消す"""
+    invalidate_tokens(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, raw=False, **kwargs):
+    """
+    ユーザーの保存で認証のキャッシュを消す
+    無効化やパスワードの変更がキャッシュ済みのユーザーに残らないようにする
+    """
+    if raw:
+        return
+    keys = list(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+    if keys:
+        invalidate_tokens(*keys)
@@ -1,3 +1,57 @@
-from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APITestCase
+from .authentication import cache_key, get_auth_cache
+from .models import User
 
-# Create your tests here.
+
+class CachedTokenAuthenticationTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='testuser@example.com', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.url = reverse('chat:conversation_list')
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        return response, len(queries)
+
+    def test_cached_after_first_request(self):
+        response, first = self.get()
+        self.assertEqual(response.status_code, 200)
+        response, second = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(second, first - 1)
+        user, token = get_auth_cache().get(cache_key(self.token.key))
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_invalid_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+        self.assertIsNone(get_auth_cache().get(cache_key('invalid')))
+
+    def test_logout_invalidates(self):
+        self.get()
+        response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(get_auth_cache().get(cache_key(self.token.key)))
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_delete_invalidates(self):
+        self.get()
+        self.token.delete()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
+
+    def test_deactivate_invalidates(self):
+        self.get()
+        self.user.is_active = False
+        self.user.save()
+        response, _ = self.get()
+        self.assertEqual(response.status_code, 401)
@@ -1,15 +1,28 @@
 from django.contrib import admin
-from .models import Conversation, Message
+from .models import ArchivedConversation, Conversation, Message, TokenUsage
 
 
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ('topic', 'user', 'created_at')
+    list_display = ('topic', 'topic_status', 'user', 'message_count', 'total_tokens', 'last_activity_at', 'archived',
+                    'created_at')
 
 
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('message', 'is_bot', 'user', 'tokens', 'created_at')
 
 
+class TokenUsageAdmin(admin.ModelAdmin):
+    list_display = ('user', 'date', 'model', 'prompt_tokens', 'completion_tokens', 'topic_tokens', 'summary_tokens',
+                    'total_tokens')
+
+
+class ArchivedConversationAdmin(admin.ModelAdmin):
+    list_display = ('conversation', 'codec', 'message_count', 'raw_size', 'archived_at')
+    exclude = ('data',)
+
+
 # Register your models here.
 admin.site.register(Conversation, ConversationAdmin)
 admin.site.register(Message, MessageAdmin)
+admin.site.register(TokenUsage, TokenUsageAdmin)
+admin.site.register(ArchivedConversation, ArchivedConversationAdmin)
@@ -0,0 +1,159 @@
+"""
+放置された会話のアーカイブ
+
+CHAT_ARCHIVE['IDLE_DAYS']日以上更新のない会話のメッセージを、圧縮した一行にまとめて
+ArchivedConversationへ移し、Messageのテーブルとインデックスを小さく保つ。
+会話の集計値(一覧に使う)とメッセージの検索インデックスはそのまま残す。
+ConversationDetail、MessageList、build_historyで開かれたときにメッセージを元のIDのまま戻す。
+会話の一覧では戻さずに、圧縮したメッセージを展開して返す。
+圧縮はzlib。zstandardが入っていればCODEC='zstd'でzstdも使える
+"""
+import json
+import logging
+import zlib
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import ArchivedConversation, Conversation, Message
+from .search import get_search_backend
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 戻すときにまとめてINSERTする件数
+RESTORE_BATCH_SIZE = 500
+
+
+def archive_codec() -> str:
+    """zstdはzstandardが入っている場合だけ使う"""
+    codec = settings.CHAT_ARCHIVE['CODEC']
+    if codec == ArchivedConversation.CODEC_ZSTD and zstandard is None:
+        return ArchivedConversation.CODEC_ZLIB
+    return codec
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    level = settings.CHAT_ARCHIVE['LEVEL']
+    if codec == ArchivedConversation.CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == ArchivedConversation.CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstdでアーカイブした会話を戻すにはzstandardが必要です')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_messages(messages) -> bytes:
+    rows = [[m.id, m.user_id, m.message, m.tokens, m.is_bot, m.cumulative_tokens, m.created_at.isoformat()]
+            for m in messages]
+    return json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode_messages(conversation_id: int, data: bytes) -> list:
+    return [Message(id=id, conversation_id=conversation_id, user_id=user_id, message=message, tokens=tokens,
+                    is_bot=is_bot, cumulative_tokens=cumulative_tokens, created_at=parse_datetime(created_at))
+            for id, user_id, message, tokens, is_bot, cumulative_tokens, created_at in json.loads(data)]
+
+
+def archive_conversation(conversation_id: int, cutoff) -> bool:
+    """
+    会話のメッセージをアーカイブに移す
+    条件付きのUPDATEで印を付けてから移すので、その間に更新された会話は移さない
+    """
+    with transaction.atomic():
+        marked = Conversation.objects.filter(id=conversation_id, archived=False,
+                                             last_activity_at__lt=cutoff).update(archived=True)
+        if not marked:
+            return False
+        messages = list(Message.objects.filter(conversation_id=conversation_id).order_by('cumulative_tokens', 'id'))
+        raw = encode_messages(messages)
+        codec = archive_codec()
+        ArchivedConversation.objects.create(conversation_id=conversation_id, codec=codec, data=compress(raw, codec),
+                                            message_count=len(messages), raw_size=len(raw))
+        Message.objects.filter(conversation_id=conversation_id).delete()
+        # 削除のシグナルで消えた検索インデックスを入れ直し、アーカイブ中も検索に当たるようにする
+        backend = get_search_backend()
+        if backend is not None:
+            backend.index_messages(messages)
+    return True
+
+
+def archive_idle(days: int = None, limit: int = None) -> int:
+    """放置された会話をアーカイブし、件数を返す"""
+    days = settings.CHAT_ARCHIVE['IDLE_DAYS'] if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    candidates = Conversation.objects.filter(archived=False, last_activity_at__lt=cutoff, message_count__gt=0)
+    ids = candidates.order_by('last_activity_at').values_list('id', flat=True)
+    done = 0
+    for conversation_id in list(ids[:limit] if limit else ids):
+        if archive_conversation(conversation_id, cutoff):
+            done += 1
+    return done
+
+
+def restore(conversation_id: int, user_id: int = None) -> bool:
+    """
+    アーカイブした会話のメッセージを元のIDで戻す
+    条件付きのUPDATEで印を外したリクエストだけが戻すので、同時に開かれても二重に戻さない
+    user_idを渡すと、そのユーザーの会話でなければ戻さない
+    """
+    with transaction.atomic():
+        marked = Conversation.objects.filter(id=conversation_id, archived=True)
+        if user_id is not None:
+            marked = marked.filter(user_id=user_id)
+        if not marked.update(archived=False):
+            return False
+        archive = ArchivedConversation.objects.filter(conversation_id=conversation_id).first()
+        if archive is None:
+            return True
+        messages = decode_messages(conversation_id, decompress(bytes(archive.data), archive.codec))
+        created_at = [message.created_at for message in messages]
+        Message.objects.bulk_create(messages, batch_size=RESTORE_BATCH_SIZE)
+        # bulk_createはauto_now_addで作成日時を今にするので、元の日時を書き戻す
+        for message, original in zip(messages, created_at):
+            message.created_at = original
+        Message.objects.bulk_update(messages, ['created_at'], batch_size=RESTORE_BATCH_SIZE)
+        archive.delete()
+        # 戻したメッセージは新しく作ったのと同じく検索インデックスに入れる(既にあれば置き換える)
+        backend = get_search_backend()
+        if backend is not None:
+            backend.index_messages(messages)
+    logger.info('アーカイブした会話を戻しました conversation=%s messages=%s', conversation_id, len(messages))
+    return True
+
+
+def ensure_restored(conversation_id: int, user_id: int = None) -> bool:
+    """
+    アーカイブされていれば戻す。されていなければ読み取り一回で済む
+    リクエストから呼ぶ場合はuser_idを渡し、そのユーザーの会話だけを戻す
+    (user_idを省けるのは、build_historyのように会話の持ち主を確かめた後の呼び出しだけ)
+    """
+    conversations = Conversation.objects.filter(id=conversation_id, archived=True)
+    if user_id is not None:
+        conversations = conversations.filter(user_id=user_id)
+    if conversations.exists():
+        return restore(conversation_id, user_id)
+    return False
+
+
+def attach_archived_messages(conversations):
+    """
+    アーカイブされた会話に、戻さずに展開したメッセージをarchived_messagesとして付ける
+    一覧のように読むだけの場合に使う。アーカイブは一回のクエリでまとめて読む
+    """
+    archived = {conversation.id: conversation for conversation in conversations if conversation.archived}
+    if not archived:
+        return
+    for archive in ArchivedConversation.objects.filter(conversation_id__in=archived):
+        archived[archive.conversation_id].archived_messages = decode_messages(
+            archive.conversation_id, decompress(bytes(archive.data), archive.codec))
@@ -0,0 +1,265 @@
+"""
+チャットAPIの負荷・レイテンシ計測
+シミュレーターのLLMバックエンドを使い、エンドポイントごとに
+レイテンシ、SSEの最初のチャンクまでの時間、チャンク間隔、DBクエリ数、ピークRSSを測る
+"""
+import platform
+import random
+import sys
+import threading
+import time
+import django
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from account.models import User
+from .models import PREVIEW_LENGTH, Conversation, Message
+from .search import get_search_backend
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+WORDS = ['Python', 'Django', 'API', 'データベース', 'インデックス', 'ストリーム', 'キャッシュ',
+         '音楽', '詩', '札幌', 'アルバム', 'テスト', 'パフォーマンス', 'レイテンシ', '設計']
+SEARCH_WORD = 'インデックス'
+
+
+def percentile(values: list, p: float):
+    """線形補間でパーセンタイルを返す"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(values: list, scale: float = 1000.0):
+    """p50/p95/p99などの要約を返す。scaleは秒をミリ秒にするための倍率"""
+    if not values:
+        return None
+    return {
+        'p50': percentile(values, 50) * scale,
+        'p95': percentile(values, 95) * scale,
+        'p99': percentile(values, 99) * scale,
+        'mean': sum(values) / len(values) * scale,
+        'max': max(values) * scale,
+    }
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSはバイト、Linuxはキロバイト
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def make_text(rand: random.Random, length: int) -> str:
+    words = []
+    size = 0
+    while size < length:
+        word = rand.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+
+def seed_data(users: int, conversations: int, messages: int, message_length: int, seed: int = 0):
+    """
+    計測用のデータをまとめて作る
+    bulk_createはsaveやシグナルを通らないので、累積トークン・会話の集計・検索インデックスもここで埋める
+    """
+    rand = random.Random(seed)
+    tokens = []
+    for i in range(users):
+        user = User.objects.create_user(email=f'bench{i}@example.com', password='password')
+        tokens.append(Token.objects.create(user=user).key)
+        now = timezone.now()
+        Conversation.objects.bulk_create([
+            Conversation(user=user, topic=make_text(rand, 20), last_activity_at=now) for _ in range(conversations)
+        ])
+        conversation_list = list(Conversation.objects.filter(user=user).order_by('id'))
+        message_list = []
+        for conversation in conversation_list:
+            cumulative = 0
+            for j in range(messages):
+                text = make_text(rand, message_length)
+                token = len(text) // 2 + 8
+                cumulative += token
+                message_list.append(Message(conversation=conversation, user=user, message=text, tokens=token,
+                                            is_bot=bool(j % 2), cumulative_tokens=cumulative))
+            conversation.message_count = messages
+            conversation.total_tokens = cumulative
+            conversation.last_message_preview = message_list[-1].message[:PREVIEW_LENGTH] if messages else ''
+        Message.objects.bulk_create(message_list, batch_size=500)
+        Conversation.objects.bulk_update(conversation_list, ['message_count', 'total_tokens',
+                                                             'last_message_preview'])
+        backend = get_search_backend()
+        if backend is not None:
+            for conversation in conversation_list:
+                backend.index_conversation(conversation)
+            backend.index_messages(Message.objects.filter(user=user).only('id', 'message', 'conversation',
+                                                                          'user'))
+    return tokens
+
+
+class BenchContext:
+    """シナリオに渡すリクエストごとの情報"""
+
+    def __init__(self, token: str, conversation_ids: list, rand: random.Random, n: int, message_length: int):
+        self.token = token
+        self.conversation_ids = conversation_ids
+        self.rand = rand
+        self.n = n
+        self.message_length = message_length
+
+    def conversation_id(self):
+        return self.rand.choice(self.conversation_ids)
+
+    def prompt(self):
+        # コンプリーションのキャッシュに当たらないよう毎回変える
+        return f'{self.n}: {make_text(self.rand, self.message_length)}'
+
+
+# エンドポイント名 -> (メソッド, URLとデータを返す関数)
+SCENARIOS = {
+    'chat_stream': ('post', lambda c: (reverse('chat:chat_stream'), {'prompt': c.prompt()})),
+    'chat_stream_with_history': ('post', lambda c: (
+        reverse('chat:chat_stream_with_history', kwargs={'pk': c.conversation_id()}), {'prompt': c.prompt()})),
+    'conversation_list': ('get', lambda c: (reverse('chat:conversation_list'), None)),
+    'conversation_list_search': ('get', lambda c: (reverse('chat:conversation_list'), {'q': SEARCH_WORD})),
+    'conversation_create': ('post', lambda c: (
+        reverse('chat:conversation_create'), {'prompt': c.prompt(), 'ai_res': make_text(c.rand, c.message_length)})),
+    'message_create': ('post', lambda c: (
+        reverse('chat:message_create', kwargs={'conversation_id': c.conversation_id()}),
+        {'message': c.prompt(), 'is_bot': False})),
+}
+
+
+def measure(client: APIClient, method: str, url: str, data):
+    """一回分のリクエストを送り、計測結果を返す"""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        if method == 'get':
+            response = client.get(url, data)
+        else:
+            response = client.post(url, data, format='json')
+        ttfb = None
+        gaps = []
+        chunks = 0
+        exception = None
+        if response.streaming:
+            last = None
+            try:
+                for _ in response.streaming_content:
+                    now = time.perf_counter()
+                    if last is None:
+                        ttfb = now - start
+                    else:
+                        gaps.append(now - last)
+                    last = now
+                    chunks += 1
+            except Exception as e:
+                # ヘッダーを返した後の失敗はステータスに出ないので、例外の名前を記録する
+                exception = type(e).__name__
+            response.close()
+        else:
+            response.content
+        elapsed = time.perf_counter() - start
+    return {'status': response.status_code, 'exception': exception, 'latency': elapsed, 'ttfb': ttfb,
+            'gaps': gaps, 'chunks': chunks, 'queries': len(queries)}
+
+
+def run_scenario(name: str, tokens: list, requests: int, concurrency: int, message_length: int, seed: int = 0):
+    method, build = SCENARIOS[name]
+    conversation_ids = {
+        token: list(Conversation.objects.filter(user__auth_token__key=token).values_list('id', flat=True))
+        for token in tokens
+    }
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    results = []
+
+    def worker(index: int):
+        rand = random.Random(f'{seed}-{name}-{index}')
+        client = APIClient(raise_request_exception=False)
+        try:
+            while True:
+                with lock:
+                    n = next(counter, None)
+                if n is None:
+                    break
+                token = rand.choice(tokens)
+                client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+                url, data = build(BenchContext(token, conversation_ids[token], rand, n, message_length))
+                result = measure(client, method, url, data)
+                with lock:
+                    results.append(result)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    status_codes = {}
+    exceptions = {}
+    for result in results:
+        status_codes[str(result['status'])] = status_codes.get(str(result['status']), 0) + 1
+        if result['exception']:
+            exceptions[result['exception']] = exceptions.get(result['exception'], 0) + 1
+    streamed = [r for r in results if r['ttfb'] is not None]
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': sum(1 for r in results if r['status'] >= 400 or r['exception']),
+        'status_codes': status_codes,
+        'exceptions': exceptions,
+        'throughput_rps': requests / wall if wall else None,
+        'latency_ms': summarize([r['latency'] for r in results]),
+        'ttfb_ms': summarize([r['ttfb'] for r in streamed]),
+        'inter_chunk_ms': summarize([gap for r in streamed for gap in r['gaps']]),
+        'chunks_per_request': (sum(r['chunks'] for r in streamed) / len(streamed)) if streamed else None,
+        'db_queries': summarize([r['queries'] for r in results], scale=1),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_benchmark(endpoints: list, requests: int, concurrency: int, users: int, conversations: int,
+                  messages: int, message_length: int, seed: int = 0):
+    """データを作ってから各エンドポイントを順に計測し、結果を辞書で返す"""
+    started_at = timezone.now()
+    rss_before = peak_rss_kb()
+    tokens = seed_data(users, conversations, messages, message_length, seed)
+    results = {}
+    for name in endpoints:
+        results[name] = run_scenario(name, tokens, requests, concurrency, message_length, seed)
+    return {
+        'started_at': started_at.isoformat(),
+        'config': {
+            'endpoints': endpoints, 'requests': requests, 'concurrency': concurrency, 'users': users,
+            'conversations': conversations, 'messages': messages, 'message_length': message_length, 'seed': seed,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'llm_backend': settings.CHAT_LLM_BACKEND,
+            'simulated_llm': settings.CHAT_SIMULATED_LLM,
+            'async_stream': settings.CHAT_ASYNC_STREAM,
+        },
+        'endpoints': results,
+        'peak_rss_kb': {'before': rss_before, 'after': peak_rss_kb()},
+    }
@@ -0,0 +1,156 @@
+"""
+会話とメッセージのまとめての保存と、JSONLの会話履歴の取り込み
+
+Message.saveは一件ごとに直前の累計の読み出し・会話の集計の更新・台帳の加算をするので、
+まとめて保存する場合はそれらを先にPythonで計算してからbulk_createする。
+bulk_createはシグナルを通らないので、検索インデックスもここで更新する
+"""
+import json
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Conversation, Message, PREVIEW_LENGTH, TokenUsage
+from .search import get_search_backend
+from .summaries import maybe_enqueue_summary
+from .tokens import CHAT_MODEL, calc_token_batch
+from .topics import enqueue_topic, placeholder_topic
+
+# 取り込みの結果に含めるエラーの最大件数
+MAX_REPORTED_ERRORS = 100
+ROLES = {'user': False, 'assistant': True}
+
+
+class ConversationData:
+    """保存する会話。messagesは(本文, AIの返事かどうか)の列。topicがなければ生成を予約する"""
+
+    def __init__(self, messages: list, topic: str = None):
+        self.messages = messages
+        self.topic = topic
+
+
+def build_conversation(user_id: int, data: ConversationData, tokens, now):
+    """会話とメッセージのインスタンスを作り、累計トークン数と会話の集計値を埋める"""
+    cumulative = 0
+    messages = []
+    for text, is_bot in data.messages:
+        token = next(tokens)
+        cumulative += token
+        messages.append(Message(user_id=user_id, message=text, tokens=token, is_bot=is_bot,
+                                cumulative_tokens=cumulative))
+    first_prompt = next((text for text, is_bot in data.messages if not is_bot), '')
+    conversation = Conversation(
+        user_id=user_id,
+        topic=data.topic or placeholder_topic(first_prompt),
+        topic_status=Conversation.TOPIC_DONE if data.topic else Conversation.TOPIC_PENDING,
+        message_count=len(messages),
+        total_tokens=cumulative,
+        last_activity_at=now,
+        last_message_preview=messages[-1].message[:PREVIEW_LENGTH] if messages else '',
+    )
+    return conversation, messages
+
+
+def bulk_create_conversations(user_id: int, conversations: list, batch_size: int = None) -> list:
+    """
+    会話とメッセージを一つのトランザクションでまとめて保存し、会話のリストを返す
+    トークン数はcalc_token_batchで一度に数え、台帳はその日の行に一回だけ加算する
+    """
+    batch_size = batch_size or settings.CHAT_IMPORT_BATCH_SIZE
+    tokens = iter(calc_token_batch([text for data in conversations for text, _ in data.messages]))
+    now = timezone.now()
+    built = [build_conversation(user_id, data, tokens, now) for data in conversations]
+    instances = [conversation for conversation, _ in built]
+    with transaction.atomic():
+        if connection.features.can_return_rows_from_bulk_insert:
+            Conversation.objects.bulk_create(instances, batch_size=batch_size)
+        else:
+            for conversation in instances:
+                conversation.save()
+        all_messages = []
+        for conversation, messages in built:
+            for message in messages:
+                message.conversation = conversation
+            all_messages.extend(messages)
+        Message.objects.bulk_create(all_messages, batch_size=batch_size)
+        prompt_tokens = sum(message.tokens for message in all_messages if not message.is_bot)
+        completion_tokens = sum(message.tokens for message in all_messages if message.is_bot)
+        if prompt_tokens or completion_tokens:
+            TokenUsage.record(user_id, CHAT_MODEL, timezone.localdate(now),
+                              prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        backend = get_search_backend()
+        if backend is not None:
+            backend.index_conversations(instances)
+            backend.index_messages(all_messages)
+        for conversation in instances:
+            if conversation.topic_status == Conversation.TOPIC_PENDING:
+                enqueue_topic(conversation.id)
+            if conversation.total_tokens > settings.CHAT_SUMMARY_THRESHOLD:
+                maybe_enqueue_summary(conversation.id, conversation.total_tokens)
+    return instances
+
+
+def parse_record(line) -> ConversationData:
+    """
+    JSONLの一行を会話にする
+    {"topic": "...", "messages": [{"role": "user", "content": "..."}, {"role": "assistant", ...}]}
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('会話はオブジェクトで指定してください')
+    messages = record.get('messages')
+    if not isinstance(messages, list):
+        raise ValueError('messagesは配列で指定してください')
+    pairs = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get('role') not in ROLES:
+            raise ValueError('roleはuserかassistantで指定してください')
+        if not isinstance(message.get('content'), str):
+            raise ValueError('contentは文字列で指定してください')
+        pairs.append((message['content'], ROLES[message['role']]))
+    topic = record.get('topic')
+    if topic is not None and not isinstance(topic, str):
+        raise ValueError('topicは文字列で指定してください')
+    if not messages and not topic:
+        # メッセージのない会話はトピックを生成できない
+        raise ValueError('messagesが空の場合はtopicを指定してください')
+    return ConversationData(pairs, topic[:255] if topic else None)
+
+
+def import_jsonl(lines, user_id: int, batch_size: int = None) -> dict:
+    """
+    JSONLの会話履歴を一行ずつ読みながら取り込む
+    メッセージがbatch_size件溜まるごとに一つのトランザクションで保存するので、
+    途中で失敗しても保存済みのバッチは残る。不正な行は飛ばして結果のerrorsに行番号を返す
+    """
+    batch_size = batch_size or settings.CHAT_IMPORT_BATCH_SIZE
+    result = {'conversations': 0, 'messages': 0, 'skipped': 0, 'errors': []}
+    pending = []
+    pending_messages = 0
+
+    def flush():
+        bulk_create_conversations(user_id, pending, batch_size)
+        result['conversations'] += len(pending)
+        result['messages'] += sum(len(data.messages) for data in pending)
+        pending.clear()
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = parse_record(line)
+        except ValueError as e:
+            # json.JSONDecodeErrorとUnicodeDecodeErrorもValueError
+            result['skipped'] += 1
+            if len(result['errors']) < MAX_REPORTED_ERRORS:
+                result['errors'].append({'line': number, 'error': str(e)})
+            continue
+        pending.append(data)
+        pending_messages += len(data.messages)
+        if pending_messages >= batch_size:
+            flush()
+            pending_messages = 0
+    if pending:
+        flush()
+    return result
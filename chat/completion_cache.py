@@ -0,0 +1,46 @@
+"""
+コンプリーションのキャッシュ
+
+model、systemの指示、messages、max_tokensが同じリクエストには、
+前回ストリームしたdeltaをそのままSSEで返す
+保存先はCACHESのcompletionsエイリアスで切り替える(LocMemCacheはLRU、FileBasedCacheやDatabaseCacheも使える)
+"""
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import caches
+
+CACHE_ALIAS = 'completions'
+
+
+def make_key(model: str, system: str, messages: list, max_tokens: int) -> str:
+    payload = json.dumps({'model': model, 'system': system, 'messages': messages, 'max_tokens': max_tokens},
+                         ensure_ascii=False, sort_keys=True)
+    return 'completion:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def key_for(client, messages: list, max_tokens: int):
+    """キャッシュが無効な場合はNoneを返す"""
+    if not settings.CHAT_COMPLETION_CACHE_ENABLED:
+        return None
+    return make_key(client.model_name, client.base_system_order, messages, max_tokens)
+
+
+def load(key):
+    if key is None:
+        return None
+    return caches[CACHE_ALIAS].get(key)
+
+
+def store(key, deltas: list):
+    caches[CACHE_ALIAS].set(key, deltas)
+
+
+async def aload(key):
+    if key is None:
+        return None
+    return await caches[CACHE_ALIAS].aget(key)
+
+
+async def astore(key, deltas: list):
+    await caches[CACHE_ALIAS].aset(key, deltas)
@@ -0,0 +1,109 @@
+"""
+ユーザーの会話のNDJSONでのエクスポート
+
+会話とメッセージをそれぞれ.iterator()で読みながら会話IDで突き合わせ、
+一行に一つの会話を書き出す。メッセージも一件ずつ書き出すので、
+会話の件数やメッセージの件数によらず使うメモリは一定になる。
+形式はbulk.import_jsonlで取り込める形にそろえる。アーカイブされた会話は圧縮したメッセージを展開して書き出す
+"""
+import json
+import zlib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .archive import decode_messages, decompress
+from .models import ArchivedConversation, Conversation, Message
+
+ROLES = {False: 'user', True: 'assistant'}
+# 細かい書き込みを避けるため、この大きさまで溜めてから送る
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+def dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+def message_line(message: str, is_bot: bool, created_at) -> str:
+    return dumps({'role': ROLES[is_bot], 'content': message, 'created_at': created_at.isoformat()})
+
+
+def archived_messages(conversation_id: int) -> list:
+    archive = ArchivedConversation.objects.filter(conversation_id=conversation_id).first()
+    if archive is None:
+        return []
+    return decode_messages(conversation_id, decompress(bytes(archive.data), archive.codec))
+
+
+def export_lines(user_id: int, chunk_size: int = None):
+    """
+    会話ごとのNDJSONを少しずつ返す
+    {"id": 1, "topic": "...", "created_at": "...", "messages": [{"role": "user", "content": "...", ...}]}
+    """
+    chunk_size = chunk_size or settings.CHAT_EXPORT_CHUNK_SIZE
+    conversations = Conversation.objects.filter(user_id=user_id).order_by('id').values_list(
+        'id', 'topic', 'created_at', 'archived')
+    # message_user_conv_idxの順に読むので並べ替えが要らない
+    messages = Message.objects.filter(user_id=user_id).order_by('conversation_id', 'id').values_list(
+        'conversation_id', 'message', 'is_bot', 'created_at').iterator(chunk_size=chunk_size)
+    pending = next(messages, None)
+    for conversation_id, topic, created_at, archived in conversations.iterator(chunk_size=chunk_size):
+        yield (f'{{"id": {conversation_id}, "topic": {dumps(topic)}, '
+               f'"created_at": {dumps(created_at.isoformat())}, "messages": [')
+        separator = ''
+        if archived:
+            # アーカイブされた会話は戻さずに、圧縮したメッセージを展開して書き出す
+            for message in archived_messages(conversation_id):
+                yield separator + message_line(message.message, message.is_bot, message.created_at)
+                separator = ', '
+        while pending is not None and pending[0] <= conversation_id:
+            if pending[0] == conversation_id:
+                _, message, is_bot, message_created_at = pending
+                yield separator + message_line(message, is_bot, message_created_at)
+                separator = ', '
+            pending = next(messages, None)
+        yield ']}\n'
+
+
+def buffered(parts, size: int = WRITE_BUFFER_SIZE):
+    """文字列をsizeバイト程度ずつまとめてbytesで返す"""
+    buffer = []
+    length = 0
+    for part in parts:
+        data = part.encode('utf-8')
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzipped(chunks):
+    """チャンクをその場でgzipに圧縮する。チャンクごとにフラッシュして、届いた分から展開できるようにする"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def aiter_chunks(chunks):
+    """
+    同期のチャンクの列を一つずつスレッドで取り出して返す
+    StreamingHttpResponseは同期のイテレーターをASGIで流すとき全体をlistにしてしまうので、その代わりに使う
+    カーソルと同じスレッドで読むよう、thread_sensitiveのまま呼ぶ
+    """
+    chunks = iter(chunks)
+    done = object()
+    try:
+        while True:
+            chunk = await sync_to_async(next)(chunks, done)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
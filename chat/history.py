@@ -0,0 +1,105 @@
+from collections import deque
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Subquery
+from .archive import ensure_restored
+from .metrics import BUILD_HISTORY_DURATION, timed
+from .models import Conversation, Message
+from .summaries import summary_message
+from .tokens import calc_token, calc_token_batch
+from .write_behind import flush_conversation, has_unsaved
+
+# 実際は4097だが安全マージンをとって4000までとする
+# なんかcompletion用に1024確保しないといけないっぽい
+MAX_HISTORY_TOKEN = 4000 - 1024
+
+
+def _fill_missing_tokens(messages: list):
+    """
+    保存済みのtokensをそのまま使い、未計算(0)のメッセージだけまとめて計算する
+    """
+    missing = [m for m in messages if not m.tokens]
+    if missing:
+        for m, token in zip(missing, calc_token_batch([m.message for m in missing])):
+            m.tokens = token
+    return messages
+
+
+def _select_history(prompt: str, messages: list, summary: tuple = None):
+    """
+    新しい順に並んだメッセージから、MAX_HISTORY_TOKENに収まる履歴を組み立てる
+    summaryがあれば(要約, トークン数, 要約済みの累計)の要約を先頭に置く
+    """
+    # ユーザーが送信したメッセージを加える
+    ret = deque()
+    ret.append({'role': 'user', 'content': prompt})
+    num_tokens = calc_token(prompt) + (summary[1] if summary else 0)
+    for query in _fill_missing_tokens(messages):
+        role = 'user'
+        if query.is_bot:
+            role = 'assistant'
+        # メッセージを足してもmax_token以内なら履歴に加える
+        if num_tokens + query.tokens <= MAX_HISTORY_TOKEN:
+            num_tokens += query.tokens
+            ret.appendleft({'role': role, 'content': query.message})
+        else:
+            break
+
+    if summary:
+        ret.appendleft(summary_message(summary[0]))
+    return num_tokens, list(ret)
+
+
+def _summary_queryset(conversation_id: int):
+    """要約がある会話だけ(要約, トークン数, 要約済みの累計)を返すクエリ"""
+    return Conversation.objects.filter(id=conversation_id).exclude(summary='').values_list(
+        'summary', 'summary_tokens', 'summarized_until')
+
+
+def _history_queryset(conversation_id: int, prompt: str, summary: tuple = None):
+    """
+    予算内に収まる最新のメッセージを一回のクエリで取得する
+    最新の累計トークン数から予算を引いた値以上の累計を持つメッセージが候補になる
+    境界のメッセージが一件はみ出すことがあるので、最終的な判定は_select_historyで行う
+    要約がある場合は、要約の分を予算から引き、要約済みのメッセージは除く
+    """
+    budget = MAX_HISTORY_TOKEN - calc_token(prompt)
+    messages = Message.objects.filter(conversation_id=conversation_id)
+    if summary:
+        budget -= summary[1]
+        messages = messages.filter(cumulative_tokens__gt=summary[2])
+    latest = messages.order_by('-cumulative_tokens').values('cumulative_tokens')[:1]
+    queryset = messages.filter(cumulative_tokens__gte=Subquery(latest) - budget)
+    queryset = queryset.only('message', 'tokens', 'is_bot')
+    return queryset.order_by('-cumulative_tokens', '-id')
+
+
+@timed(BUILD_HISTORY_DURATION)
+def build_history(conversation_id: int, prompt: str):
+    """
+    履歴を構築する
+    トークンの予算に収まる直近の会話履歴＋新しいprompt
+    トークン数は書き込み時に保存したMessage.tokensを使う
+    CHAT_SUMMARY_ENABLEDなら、古いメッセージの代わりに会話の要約を先頭に置く
+    write-behindで未保存のこの会話のメッセージがあれば、先に書き込んでから読む
+    アーカイブされた会話はメッセージを戻してから読む
+    """
+    flush_conversation(conversation_id)
+    summary = _summary_queryset(conversation_id).first() if settings.CHAT_SUMMARY_ENABLED else None
+    messages = list(_history_queryset(conversation_id, prompt, summary))
+    if not messages and ensure_restored(conversation_id):
+        # アーカイブされていた会話は戻してから読み直す
+        messages = list(_history_queryset(conversation_id, prompt, summary))
+    return _select_history(prompt, messages, summary)
+
+
+@timed(BUILD_HISTORY_DURATION)
+async def abuild_history(conversation_id: int, prompt: str):
+    """build_historyの非同期版"""
+    if has_unsaved(conversation_id):
+        await sync_to_async(flush_conversation)(conversation_id)
+    summary = await _summary_queryset(conversation_id).afirst() if settings.CHAT_SUMMARY_ENABLED else None
+    messages = [query async for query in _history_queryset(conversation_id, prompt, summary)]
+    if not messages and await sync_to_async(ensure_restored)(conversation_id):
+        messages = [query async for query in _history_queryset(conversation_id, prompt, summary)]
+    return _select_history(prompt, messages, summary)
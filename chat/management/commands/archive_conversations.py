@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from chat.archive import archive_codec, archive_idle
+
+
+class Command(BaseCommand):
+    help = '更新のない会話のメッセージを圧縮してアーカイブに移す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='この日数以上更新のない会話を移す。省略時はCHAT_ARCHIVE["IDLE_DAYS"]')
+        parser.add_argument('--limit', type=int, help='一回に移す件数')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < 0:
+            raise CommandError('--days must not be negative')
+        done = archive_idle(options['days'], options['limit'])
+        self.stdout.write(f'{done}件の会話をアーカイブしました({archive_codec()})')
@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+from chat.benchmark import SCENARIOS, run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'シミュレーターのLLMを使って、使い捨てのテスト用DBでチャットAPIの負荷・レイテンシを計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+        parser.add_argument('--requests', type=int, default=50, help='エンドポイントごとのリクエスト数')
+        parser.add_argument('--concurrency', type=int, default=4, help='同時に送るリクエスト数(スレッド数)')
+        parser.add_argument('--users', type=int, default=4)
+        parser.add_argument('--conversations', type=int, default=50, help='ユーザーごとの会話数')
+        parser.add_argument('--messages', type=int, default=20, help='会話ごとのメッセージ数')
+        parser.add_argument('--message-length', type=int, default=200, help='メッセージの文字数')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--ttft', type=float, help='シミュレーターの最初のトークンまでの秒数')
+        parser.add_argument('--tokens-per-second', type=float)
+        parser.add_argument('--jitter', type=float)
+        parser.add_argument('--error-rate', type=float)
+        parser.add_argument('--with-limits', action='store_true', help='ストリームのユーザーごとの制限を有効にしたまま計測する')
+        parser.add_argument('--output', help='結果のJSONを書き出すファイル。省略時は標準出力')
+
+    def simulated_settings(self, options):
+        simulated = dict(settings.CHAT_SIMULATED_LLM)
+        for key in ('ttft', 'tokens_per_second', 'jitter', 'error_rate'):
+            if options[key] is not None:
+                simulated[key.upper()] = options[key]
+        simulated['SEED'] = options['seed']
+        return simulated
+
+    def limit_settings(self, options):
+        if options['with_limits']:
+            return {}
+        rest_framework = dict(settings.REST_FRAMEWORK)
+        rest_framework['DEFAULT_THROTTLE_RATES'] = {'stream': None, 'stream_tokens': None}
+        return {'REST_FRAMEWORK': rest_framework, 'CHAT_STREAM_MAX_CONCURRENT': 0}
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+        overrides = override_settings(
+            **self.limit_settings(options),
+            CHAT_LLM_BACKEND='simulated',
+            CHAT_SIMULATED_LLM=self.simulated_settings(options),
+            # 毎回同じ結果を返さないよう、キャッシュと共有はしない
+            CHAT_COMPLETION_CACHE_ENABLED=False,
+            CHAT_SINGLE_FLIGHT_ENABLED=False,
+            # トピック生成は計測対象のリクエストに含めない
+            CHAT_TOPIC_WORKER='db',
+        )
+        with tempfile.TemporaryDirectory() as tmp, overrides:
+            if connection.vendor == 'sqlite':
+                # インメモリのDBはスレッド間でテーブルロックが衝突するので、ファイルに作る
+                connection.settings_dict['TEST']['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+            setup_test_environment()
+            old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+            try:
+                result = run_benchmark(
+                    options['endpoints'], options['requests'], options['concurrency'], options['users'],
+                    options['conversations'], options['messages'], options['message_length'], options['seed'],
+                )
+            finally:
+                teardown_databases(old_config, verbosity=0)
+                teardown_test_environment()
+        data = json.dumps(result, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            for name, stats in result['endpoints'].items():
+                latency = stats['latency_ms']
+                self.stdout.write(f"{name}: p50={latency['p50']:.1f}ms p95={latency['p95']:.1f}ms "
+                                  f"p99={latency['p99']:.1f}ms errors={stats['errors']}")
+        else:
+            self.stdout.write(data)
@@ -0,0 +1,30 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from account.models import User
+from chat.bulk import import_jsonl
+
+
+class Command(BaseCommand):
+    help = 'JSONL(一行に一つの会話)の会話履歴をユーザーに取り込む'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSONLのファイル。-で標準入力')
+        parser.add_argument('--user', required=True, help='取り込み先のユーザーのメールアドレス')
+        parser.add_argument('--batch-size', type=int, help='一つのトランザクションで保存するメッセージの件数')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email=options['user']).first()
+        if user is None:
+            raise CommandError(f"ユーザーが見つかりません: {options['user']}")
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        if options['path'] == '-':
+            result = import_jsonl(sys.stdin, user.id, options['batch_size'])
+        else:
+            with open(options['path'], encoding='utf-8') as f:
+                result = import_jsonl(f, user.id, options['batch_size'])
+        for error in result['errors']:
+            self.stderr.write(f"{error['line']}行目: {error['error']}")
+        self.stdout.write(f"{result['conversations']}件の会話と{result['messages']}件のメッセージを取り込みました"
+                          f"(飛ばした行: {result['skipped']})")
+
@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from chat.topics import process_pending
+
+
+class Command(BaseCommand):
+    help = 'トピックが生成待ちの会話を処理する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='終了せずに待ちの会話を処理し続ける')
+        parser.add_argument('--interval', type=float, default=2.0, help='--loop時のポーリング間隔(秒)')
+        parser.add_argument('--limit', type=int, default=100, help='一回に処理する件数')
+
+    def handle(self, *args, **options):
+        while True:
+            done = process_pending(options['limit'])
+            if done:
+                self.stdout.write(f'{done}件のトピックを生成しました')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
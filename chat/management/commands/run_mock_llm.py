@@ -0,0 +1,98 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai
+from django.core.management.base import BaseCommand
+from chat.simulated_llm import SimulatedCompletions, SimulatedTiming
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI互換の /v1/chat/completions を返すハンドラ"""
+    protocol_version = 'HTTP/1.1'
+    completions = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') not in ('/v1/chat/completions', '/chat/completions'):
+            self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        try:
+            res = self.completions.create(model=body.get('model', ''), messages=body.get('messages', []),
+                                          max_tokens=body.get('max_tokens') or 1024,
+                                          stream=bool(body.get('stream')))
+            if body.get('stream'):
+                self.send_stream(res)
+            else:
+                self.send_json(200, res.model_dump())
+        except openai.APIError as e:
+            self.send_json(500, {'error': {'message': e.message, 'type': 'server_error'}})
+
+    def send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, chunks):
+        # 最初のチャンクが出るまで待ってからヘッダーを返す(本物と同じくTTFTが応答待ちになる)
+        chunks = iter(chunks)
+        first = next(chunks)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.write_chunk(f'data: {first.model_dump_json()}\n\n')
+        try:
+            for chunk in chunks:
+                self.write_chunk(f'data: {chunk.model_dump_json()}\n\n')
+        except openai.APIError:
+            # 途中で失敗した場合は接続を切る
+            self.close_connection = True
+            return
+        self.write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def build_server(host: str, port: int, timing: SimulatedTiming) -> ThreadingHTTPServer:
+    handler = type('Handler', (MockLLMHandler,), {'completions': SimulatedCompletions(timing)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = 'ai_mockの本文をストリームするOpenAI互換のモックサーバーを起動する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--ttft', type=float, help='最初のトークンまでの秒数')
+        parser.add_argument('--tokens-per-second', type=float)
+        parser.add_argument('--jitter', type=float, help='待ち時間を揺らす割合')
+        parser.add_argument('--error-rate', type=float)
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        timing = SimulatedTiming.from_settings(
+            ttft=options['ttft'], tokens_per_second=options['tokens_per_second'], jitter=options['jitter'],
+            error_rate=options['error_rate'], seed=options['seed'],
+        )
+        server = build_server(options['host'], options['port'], timing)
+        host, port = server.server_address[:2]
+        self.stdout.write(f'OPENAI_BASE_URL=http://{host}:{port}/v1 で待ち受けています')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,335 @@
+"""
+ホットパスの計測とPrometheusのテキスト形式での出力
+
+値はスレッドごとのシャードに書き込み、書き込み側ではロックを取らない
+(シャードを持つスレッドしか書き込まないので、GILの下で加算が競合しない)。
+ヒストグラムのバケットは最初の観測時にラベルごとに確保し、以降は配列の加算だけにする。
+出力時に全シャードを合計する。
+終わったスレッドのシャードはbaseに足し込んで捨てるので、短命なスレッドが多くてもシャードは増え続けない
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+# 秒単位のレイテンシのバケット
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# calc_tokenのような短い処理のバケット
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def add_collector(self, collector):
+        """出力時に呼ばれ、(名前, ヘルプ, 値)の列を返す関数を登録する。値はゲージとして出す"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, help_text, value in collector():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Shard:
+    """スレッドのローカルに置くシャードの持ち主。スレッドが終わると回収され、セルがbaseにまとめられる"""
+    __slots__ = ('cells', '__weakref__')
+
+    def __init__(self):
+        self.cells = {}
+
+
+def merge_cells(total: dict, cells: dict):
+    for labels, cell in cells.items():
+        merged = total.get(labels)
+        if merged is None:
+            total[labels] = list(cell)
+        else:
+            for i, value in enumerate(cell):
+                merged[i] += value
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels=(), registry=registry):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._local = threading.local()
+        # 生きているスレッドのセル(id(cells) -> cells)と、終わったスレッドの分の合計
+        self._shards = {}
+        self._base = {}
+        self._shards_lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def new_cell(self) -> list:
+        return [0.0]
+
+    def cell(self, labels: tuple) -> list:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = Shard()
+            # シャードの追加だけはロックを取る(スレッドごとに一回)
+            with self._shards_lock:
+                self._shards[id(shard.cells)] = shard.cells
+            weakref.finalize(shard, self.retire, shard.cells)
+        cells = shard.cells
+        cell = cells.get(labels)
+        if cell is None:
+            cell = cells[labels] = self.new_cell()
+        return cell
+
+    def retire(self, cells: dict):
+        """終わったスレッドのセルをbaseに足し込み、シャードから外す"""
+        with self._shards_lock:
+            merge_cells(self._base, cells)
+            self._shards.pop(id(cells), None)
+
+    def collect(self) -> dict:
+        """全シャードとbaseをラベルごとに合計する"""
+        # 足し込みと外すのは同じロックの中で行うので、baseとシャードの一覧を一緒に取れば二重に数えない
+        with self._shards_lock:
+            shards = list(self._shards.values())
+            total = {labels: list(cell) for labels, cell in self._base.items()}
+        for cells in shards:
+            merge_cells(total, cells.copy())
+        return total
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for labels, cell in sorted(self.collect().items()):
+            lines.extend(self.render_cell(labels, cell))
+        return lines
+
+    def render_cell(self, labels: tuple, cell: list) -> list:
+        return [f'{self.name}{format_labels(self.label_names, labels)} {format_value(cell[0])}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        self.cell(labels)[0] += amount
+
+
+class Gauge(Metric):
+    """シャードごとの増減を合計する。incとdecが別のスレッドでもよい"""
+    kind = 'gauge'
+
+    def inc(self, *labels, amount: float = 1):
+        self.cell(labels)[0] += amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.cell(labels)[0] -= amount
+
+
+class Histogram(Metric):
+    """
+    セルは[バケットごとの件数..., +Infの件数, 合計]
+    件数は累積でなくバケットごとに数え、出力時に累積にする
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS, registry=registry):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labels, registry)
+
+    def new_cell(self) -> list:
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float, *labels):
+        cell = self.cell(labels)
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def render_cell(self, labels: tuple, cell: list) -> list:
+        lines = []
+        count = 0
+        for bound, value in zip(self.buckets + ('+Inf',), cell):
+            count += value
+            le = f'le="{format_value(float(bound)) if bound != "+Inf" else bound}"'
+            lines.append(f'{self.name}_bucket{format_labels(self.label_names, labels, le)} {count}')
+        lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {format_value(cell[-1])}')
+        lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {count}')
+        return lines
+
+
+class Timer:
+    """withのブロックの秒数をヒストグラムに記録する"""
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def timed(histogram: Histogram):
+    """関数(コルーチン関数も可)の実行時間を記録するデコレータ"""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+
+    return decorator
+
+
+REQUEST_DURATION = Histogram('chat_http_request_duration_seconds',
+                             'Time until the response is returned (headers for streams).',
+                             ['endpoint', 'method', 'status'])
+DB_QUERIES = Histogram('chat_db_queries_per_request', 'Number of DB queries per request.', ['endpoint'],
+                       buckets=QUERY_COUNT_BUCKETS)
+DB_DURATION = Histogram('chat_db_query_duration_seconds', 'Total DB query time per request.', ['endpoint'])
+SSE_DURATION = Histogram('chat_sse_stream_duration_seconds', 'Time until an SSE stream is closed.', ['endpoint'])
+ACTIVE_STREAMS = Gauge('chat_sse_active_streams', 'Number of SSE streams currently open.', ['endpoint'])
+UPSTREAM_TTFT = Histogram('chat_upstream_ttft_seconds', 'Time from the upstream request to the first content.',
+                          ['model'])
+UPSTREAM_TOKENS_PER_SECOND = Histogram('chat_upstream_tokens_per_second',
+                                       'Content chunks per second after the first one.', ['model'],
+                                       buckets=TOKENS_PER_SECOND_BUCKETS)
+CALC_TOKEN_DURATION = Histogram('chat_calc_token_duration_seconds', 'Time spent in calc_token.',
+                                buckets=FAST_BUCKETS)
+BUILD_HISTORY_DURATION = Histogram('chat_build_history_duration_seconds', 'Time spent building the history.')
+
+
+class UpstreamTimer:
+    """
+    upstreamのストリームの最初の本文までの秒数と、その後の毎秒のチャンク数を記録する
+    チャンク数をトークン数の近似にする
+    """
+
+    def __init__(self, model: str, started: float = None):
+        self.model = model
+        self.started = time.perf_counter() if started is None else started
+        self.first = None
+        self.chunks = 0
+
+    def delta(self, delta: dict):
+        if not delta.get('content'):
+            return
+        if self.first is None:
+            self.first = time.perf_counter()
+            UPSTREAM_TTFT.observe(self.first - self.started, self.model)
+        self.chunks += 1
+
+    def finish(self):
+        if self.first is None or self.chunks < 2:
+            return
+        elapsed = time.perf_counter() - self.first
+        if elapsed > 0:
+            UPSTREAM_TOKENS_PER_SECOND.observe((self.chunks - 1) / elapsed, self.model)
+
+
+def time_stream(content, endpoint: str):
+    """ストリームを閉じるまでの秒数と、開いているストリームの数を記録する"""
+    started = time.perf_counter()
+    ACTIVE_STREAMS.inc(endpoint)
+    try:
+        yield from content
+    finally:
+        ACTIVE_STREAMS.dec(endpoint)
+        SSE_DURATION.observe(time.perf_counter() - started, endpoint)
+
+
+async def atime_stream(content, endpoint: str):
+    started = time.perf_counter()
+    ACTIVE_STREAMS.inc(endpoint)
+    try:
+        async for chunk in content:
+            yield chunk
+    finally:
+        ACTIVE_STREAMS.dec(endpoint)
+        SSE_DURATION.observe(time.perf_counter() - started, endpoint)
+
+
+class QueryTimer:
+    """リクエスト中のクエリの数と時間を数える。current_queriesに設定するとcount_queriesが数える"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - started
+
+
+# リクエストを処理中のQueryTimer。contextvarなのでsync_to_asyncのスレッドにも引き継がれる
+current_queries = contextvars.ContextVar('current_queries', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    """
+    スレッドごとの接続のexecute_wrappersに入れておくラッパー
+    connection.execute_wrapperは呼んだスレッドの接続にしか効かないので、こちらで全ての接続のクエリを拾う
+    """
+    queries = current_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    return queries(execute, sql, params, many, context)
@@ -0,0 +1,98 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connection
+from django.db.backends.signals import connection_created
+from . import metrics, singleflight
+from .open_ai_client import pool_stats
+
+
+def upstream_stats():
+    """upstreamの接続プールとsingle-flightの統計を出力に加える"""
+    for name, value in pool_stats.as_dict().items():
+        yield f'chat_upstream_pool_{name}', f'Upstream connection pool {name}.', value
+    for name, value in singleflight.stats.as_dict().items():
+        yield f'chat_single_flight_{name}', f'Single-flight {name}.', value
+
+
+metrics.registry.add_collector(upstream_stats)
+
+
+def install_query_counter(connection, **kwargs):
+    """接続にクエリを数えるラッパーを入れる。新しい接続にはconnection_createdで入れる"""
+    if metrics.count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(metrics.count_queries)
+
+
+def install_on_request_thread(**kwargs):
+    """
+    request_startedはビューを実行するスレッド(ASGIではthread_sensitiveのスレッド)で送られるので、
+    このモジュールより先に作られていた接続にもここで入れる
+    """
+    install_query_counter(connection)
+
+
+connection_created.connect(install_query_counter)
+request_started.connect(install_on_request_thread)
+
+
+def endpoint_of(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    エンドポイントごとのレイテンシ、DBのクエリ数と時間を記録する
+    クエリはsync_to_asyncのスレッドで実行した分も数えるが、レスポンスを返した後に
+    ストリームの本文の中で実行した分(履歴の取得や返事の保存など)は数えない
+    SSEのレスポンスはストリームを閉じるまでの時間と、開いている数も記録する
+    CHAT_METRICS_ENABLEDがFalseなら使わない
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.CHAT_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        queries = metrics.QueryTimer()
+        token = metrics.current_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_queries.reset(token)
+        return self.record(request, response, started, queries)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        queries = metrics.QueryTimer()
+        token = metrics.current_queries.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_queries.reset(token)
+        return self.record(request, response, started, queries)
+
+    def record(self, request, response, started: float, queries):
+        endpoint = endpoint_of(request)
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started, endpoint, request.method,
+                                         response.status_code)
+        metrics.DB_QUERIES.observe(queries.count, endpoint)
+        metrics.DB_DURATION.observe(queries.duration, endpoint)
+        if response.streaming and response.get('Content-Type', '').startswith('text/event-stream'):
+            if response.is_async:
+                response.streaming_content = metrics.atime_stream(response.streaming_content, endpoint)
+            else:
+                response.streaming_content = metrics.time_stream(response.streaming_content, endpoint)
+        return response
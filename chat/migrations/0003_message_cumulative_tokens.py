@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:04
+
+from django.db import migrations, models
+
+
+def fill_cumulative_tokens(apps, schema_editor):
+    """既存のメッセージの累計トークン数を会話ごとに埋める"""
+    Message = apps.get_model('chat', 'Message')
+    updated = []
+    conversation_id = None
+    total = 0
+    for message in Message.objects.order_by('conversation_id', 'created_at', 'id').iterator(chunk_size=2000):
+        if message.conversation_id != conversation_id:
+            conversation_id = message.conversation_id
+            total = 0
+        total += message.tokens
+        message.cumulative_tokens = total
+        updated.append(message)
+        if len(updated) >= 2000:
+            Message.objects.bulk_update(updated, ['cumulative_tokens'])
+            updated = []
+    if updated:
+        Message.objects.bulk_update(updated, ['cumulative_tokens'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_alter_message_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='cumulative_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'cumulative_tokens'], name='message_cumulative_idx'),
+        ),
+        migrations.RunPython(fill_cumulative_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:05
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# user_idもインデックスし、MATCHの中でユーザーを絞る。rank(bm25)はtermsの列だけで計算する
+SQLITE_TABLES = [
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5(terms, conversation_id UNINDEXED, user_id)",
+    "INSERT INTO chat_message_fts (chat_message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0, 0.0)')",
+    "CREATE VIRTUAL TABLE chat_conversation_fts USING fts5(terms, user_id)",
+    "INSERT INTO chat_conversation_fts (chat_conversation_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+]
+
+POSTGRES_TABLES = [
+    "CREATE TABLE chat_message_search ("
+    "message_id bigint PRIMARY KEY REFERENCES chat_message (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "conversation_id bigint NOT NULL, user_id bigint NOT NULL, terms tsvector NOT NULL)",
+    "CREATE INDEX chat_message_search_terms ON chat_message_search USING GIN (terms)",
+    "CREATE INDEX chat_message_search_user ON chat_message_search (user_id, conversation_id)",
+    "CREATE TABLE chat_conversation_search ("
+    "conversation_id bigint PRIMARY KEY REFERENCES chat_conversation (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "user_id bigint NOT NULL, terms tsvector NOT NULL)",
+    "CREATE INDEX chat_conversation_search_terms ON chat_conversation_search USING GIN (terms)",
+    "CREATE INDEX chat_conversation_search_user ON chat_conversation_search (user_id)",
+]
+
+
+def create_search_index(apps, schema_editor):
+    """
+    検索インデックスのテーブルを作り、既存のデータを登録する
+    FTS5が使えないSQLiteやその他のDBではicontainsの検索のままにする
+    """
+    from chat.search import SEARCH_BACKENDS
+
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            for sql in SQLITE_TABLES:
+                schema_editor.execute(sql)
+        except OperationalError:
+            return
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_TABLES:
+            schema_editor.execute(sql)
+    else:
+        return
+
+    backend = SEARCH_BACKENDS[vendor](schema_editor.connection)
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    for conversation in Conversation.objects.iterator(chunk_size=2000):
+        backend.index_conversation(conversation)
+    batch = []
+    for message in Message.objects.iterator(chunk_size=2000):
+        batch.append(message)
+        if len(batch) >= 2000:
+            backend.index_messages(batch)
+            batch = []
+    if batch:
+        backend.index_messages(batch)
+
+
+def drop_search_index(apps, schema_editor):
+    for table in ['chat_message_fts', 'chat_conversation_fts', 'chat_message_search', 'chat_conversation_search']:
+        schema_editor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_cumulative_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
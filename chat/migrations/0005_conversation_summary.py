@@ -0,0 +1,62 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:07
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_summary(apps, schema_editor):
+    """既存の会話の集計値をメッセージから埋める"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    updated = []
+    for conversation in Conversation.objects.iterator(chunk_size=2000):
+        messages = Message.objects.filter(conversation_id=conversation.id)
+        stats = messages.aggregate(count=models.Count('id'), tokens=models.Sum('tokens'))
+        last = messages.order_by('-created_at', '-id').first()
+        conversation.message_count = stats['count']
+        conversation.total_tokens = stats['tokens'] or 0
+        conversation.last_activity_at = last.created_at if last else conversation.created_at
+        conversation.last_message_preview = last.message[:100] if last else ''
+        updated.append(conversation)
+        if len(updated) >= 2000:
+            Conversation.objects.bulk_update(
+                updated, ['message_count', 'total_tokens', 'last_activity_at', 'last_message_preview'])
+            updated = []
+    if updated:
+        Conversation.objects.bulk_update(
+            updated, ['message_count', 'total_tokens', 'last_activity_at', 'last_message_preview'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='total_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-last_activity_at'], name='conversation_activity_idx'),
+        ),
+        migrations.RunPython(fill_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='topic_status',
+            field=models.CharField(choices=[('pending', '生成待ち'), ('running', '生成中'), ('done', '生成済み'), ('failed', '失敗')], default='done', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='topic_tokens',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='topic_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('topic_status', 'pending')), fields=['created_at'], name='conversation_topic_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('topic_status', 'running')), fields=['topic_claimed_at'], name='conversation_topic_running_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import TruncDate
+
+# 既存のメッセージはモデルを記録していないので、新しく記録する分と同じモデル名(chat.tokens.CHAT_MODEL)に寄せる
+BACKFILL_MODEL = 'gpt-3.5-turbo-0613'
+
+
+def fill_usage(apps, schema_editor):
+    """既存のメッセージとトピックのトークン数から台帳を作る"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    Message = apps.get_model('chat', 'Message')
+    TokenUsage = apps.get_model('chat', 'TokenUsage')
+    usage = {}
+
+    def row(user_id, date):
+        return usage.setdefault((user_id, date), TokenUsage(user_id=user_id, date=date, model=BACKFILL_MODEL))
+
+    messages = Message.objects.annotate(day=TruncDate('created_at')).values('user_id', 'day', 'is_bot')
+    for item in messages.annotate(tokens=models.Sum('tokens')).order_by():
+        usage_row = row(item['user_id'], item['day'])
+        if item['is_bot']:
+            usage_row.completion_tokens += item['tokens'] or 0
+        else:
+            usage_row.prompt_tokens += item['tokens'] or 0
+    topics = Conversation.objects.filter(topic_tokens__gt=0).annotate(day=TruncDate('created_at'))
+    for item in topics.values('user_id', 'day').annotate(tokens=models.Sum('topic_tokens')).order_by():
+        row(item['user_id'], item['day']).topic_tokens += item['tokens'] or 0
+    for usage_row in usage.values():
+        usage_row.total_tokens = usage_row.prompt_tokens + usage_row.completion_tokens + usage_row.topic_tokens
+    TokenUsage.objects.bulk_create(usage.values(), batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_conversation_topic_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('model', models.CharField(max_length=64)),
+                ('prompt_tokens', models.BigIntegerField(default=0)),
+                ('completion_tokens', models.BigIntegerField(default=0)),
+                ('topic_tokens', models.BigIntegerField(default=0)),
+                ('total_tokens', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='tokenusage',
+            constraint=models.UniqueConstraint(fields=('user', 'date', 'model'), name='token_usage_user_date_model_uniq'),
+        ),
+        migrations.RunPython(fill_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_token_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='summarized_until',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_status',
+            field=models.CharField(choices=[('idle', '待機中'), ('pending', '要約待ち'), ('running', '要約中'), ('failed', '失敗')], default='idle', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='summary_tokens',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='tokenusage',
+            name='summary_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('summary_status', 'pending')), fields=['last_activity_at'], name='conversation_summary_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('summary_status', 'running')), fields=['summary_claimed_at'], name='conversation_summary_run_idx'),
+        ),
+    ]
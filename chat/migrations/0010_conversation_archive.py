@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 12:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_conversation_summary_compaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedConversation',
+            fields=[
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='archive', serialize=False, to='chat.conversation')),
+                ('codec', models.CharField(choices=[('zlib', 'zlib'), ('zstd', 'zstd')], max_length=8)),
+                ('data', models.BinaryField()),
+                ('message_count', models.IntegerField()),
+                ('raw_size', models.IntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='archived',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('archived', False)), fields=['last_activity_at'], name='conversation_archive_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-17 14:10
+
+from django.db import migrations
+
+DROP_MESSAGE_FK = 'ALTER TABLE chat_message_search DROP CONSTRAINT IF EXISTS chat_message_search_message_id_fkey'
+ADD_MESSAGE_FK = (
+    'ALTER TABLE chat_message_search ADD CONSTRAINT chat_message_search_message_id_fkey '
+    'FOREIGN KEY (message_id) REFERENCES chat_message (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED'
+)
+
+
+def index_archived_messages(apps, schema_editor):
+    """
+    アーカイブした会話のメッセージも検索インデックスに残す
+    PostgreSQLではメッセージの行を消しても残るよう外部キーを外し、既にアーカイブした会話の分を入れ直す
+    """
+    from chat.archive import decode_messages, decompress
+    from chat.search import MESSAGE_TABLE, SEARCH_BACKENDS
+
+    connection = schema_editor.connection
+    vendor = connection.vendor
+    if vendor not in SEARCH_BACKENDS or MESSAGE_TABLE[vendor] not in connection.introspection.table_names():
+        return
+    if vendor == 'postgresql':
+        schema_editor.execute(DROP_MESSAGE_FK)
+
+    backend = SEARCH_BACKENDS[vendor](connection)
+    ArchivedConversation = apps.get_model('chat', 'ArchivedConversation')
+    for archive in ArchivedConversation.objects.iterator(chunk_size=100):
+        backend.index_messages(decode_messages(archive.conversation_id, decompress(bytes(archive.data), archive.codec)))
+
+
+def restore_message_fk(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql' \
+            and 'chat_message_search' in schema_editor.connection.introspection.table_names():
+        schema_editor.execute('DELETE FROM chat_message_search s '
+                              'WHERE NOT EXISTS (SELECT 1 FROM chat_message m WHERE m.id = s.message_id)')
+        schema_editor.execute(ADD_MESSAGE_FK)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_conversation_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(index_archived_messages, restore_message_fk),
+    ]
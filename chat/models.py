@@ -1,16 +1,94 @@
-from django.db import models
+import datetime
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import F
+from django.utils import timezone
 from account.models import User
+from .tokens import CHAT_MODEL
+
+# 一覧に表示する最後のメッセージの文字数
+PREVIEW_LENGTH = 100
 
 
 class Conversation(models.Model):
     """チャットトピック"""
+    TOPIC_PENDING = 'pending'
+    TOPIC_RUNNING = 'running'
+    TOPIC_DONE = 'done'
+    TOPIC_FAILED = 'failed'
+    TOPIC_STATUS_CHOICES = (
+        (TOPIC_PENDING, '生成待ち'),
+        (TOPIC_RUNNING, '生成中'),
+        (TOPIC_DONE, '生成済み'),
+        (TOPIC_FAILED, '失敗'),
+    )
+
+    SUMMARY_IDLE = 'idle'
+    SUMMARY_PENDING = 'pending'
+    SUMMARY_RUNNING = 'running'
+    SUMMARY_FAILED = 'failed'
+    SUMMARY_STATUS_CHOICES = (
+        (SUMMARY_IDLE, '待機中'),
+        (SUMMARY_PENDING, '要約待ち'),
+        (SUMMARY_RUNNING, '要約中'),
+        (SUMMARY_FAILED, '失敗'),
+    )
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     topic = models.CharField(max_length=255)
+    # トピックはバックグラウンドで生成する。生成されるまでは仮のトピックが入る
+    topic_status = models.CharField(max_length=16, choices=TOPIC_STATUS_CHOICES, default=TOPIC_DONE)
+    topic_tokens = models.IntegerField(default=0)
+    # ワーカーがトピックの生成を始めた日時。落ちたワーカーの処理中の会話を拾い直すのに使う
+    topic_claimed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # 一覧表示用の集計値。メッセージの追加時に更新する
+    message_count = models.IntegerField(default=0)
+    total_tokens = models.BigIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    # 古いメッセージの要約。cumulative_tokensがsummarized_until以下のメッセージを要約したもの
+    summary = models.TextField(blank=True, default='')
+    summary_tokens = models.IntegerField(default=0)
+    summarized_until = models.BigIntegerField(default=0)
+    summary_status = models.CharField(max_length=16, choices=SUMMARY_STATUS_CHOICES, default=SUMMARY_IDLE)
+    # ワーカーが要約を始めた日時。落ちたワーカーの要約中の会話を拾い直すのに使う
+    summary_claimed_at = models.DateTimeField(null=True, blank=True)
+    # メッセージをArchivedConversationに移したかどうか。集計値はそのまま残す
+    archived = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='conversation_user_created_idx'),
+            models.Index(fields=['user', '-last_activity_at'], name='conversation_activity_idx'),
+            # トピック生成のワーカーが待ちの会話を探すための部分インデックス
+            models.Index(fields=['created_at'], name='conversation_topic_pending_idx',
+                         condition=models.Q(topic_status='pending')),
+            models.Index(fields=['topic_claimed_at'], name='conversation_topic_running_idx',
+                         condition=models.Q(topic_status='running')),
+            models.Index(fields=['last_activity_at'], name='conversation_summary_idx',
+                         condition=models.Q(summary_status='pending')),
+            models.Index(fields=['summary_claimed_at'], name='conversation_summary_run_idx',
+                         condition=models.Q(summary_status='running')),
+            # アーカイブのコマンドが放置された会話を探すための部分インデックス
+            models.Index(fields=['last_activity_at'], name='conversation_archive_idx',
+                         condition=models.Q(archived=False)),
+        ]
 
     def __str__(self):
         return self.topic
 
+    @staticmethod
+    def lock(*conversation_ids):
+        """
+        会話の行をトランザクションの終わりまでロックする。デッドロックを避けるためIDの順に取る
+        SELECT FOR UPDATEのないSQLiteでは、書き込みのロックを取るため空のUPDATEを発行する
+        """
+        queryset = Conversation.objects.select_for_update().filter(pk__in=conversation_ids).order_by('pk')
+        if connections[queryset.db].features.has_select_for_update:
+            list(queryset.values_list('pk', flat=True))
+        else:
+            queryset.update(archived=F('archived'))
+
 
 class Message(models.Model):
     """チャットメッセージ"""
@@ -19,7 +97,131 @@ class Message(models.Model):
     message = models.TextField()
     tokens = models.IntegerField(default=0)
     is_bot = models.BooleanField(default=False)
+    # 会話の先頭からこのメッセージまでのtokensの累計
+    cumulative_tokens = models.BigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'cumulative_tokens'], name='message_cumulative_idx'),
+            models.Index(fields=['conversation', 'created_at'], name='message_conv_created_idx'),
+            models.Index(fields=['user', 'conversation'], name='message_user_conv_idx'),
+        ]
+
     def __str__(self):
         return self.message[:32]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get('using')):
+            # 追加時は直前のメッセージの累計にtokensを足す。渡された値は使わずに必ず計算し直す
+            # (累計を指定して保存するのはbulk_createを使うchat.bulkとchat.archiveだけ)
+            # 同じ会話への同時の追加が同じ累計を読まないよう、会話の行をロックしてから読む
+            Conversation.lock(self.conversation_id)
+            self.cumulative_tokens = Message.last_cumulative_tokens(self.conversation_id) + self.tokens
+            super().save(*args, **kwargs)
+            # 会話の集計値も同じトランザクションで更新する
+            Conversation.objects.filter(pk=self.conversation_id).update(
+                message_count=F('message_count') + 1,
+                total_tokens=F('total_tokens') + self.tokens,
+                last_activity_at=self.created_at,
+                last_message_preview=self.message[:PREVIEW_LENGTH],
+            )
+            TokenUsage.record(self.user_id, CHAT_MODEL, timezone.localdate(self.created_at),
+                              completion_tokens=self.tokens if self.is_bot else 0,
+                              prompt_tokens=0 if self.is_bot else self.tokens)
+
+    @staticmethod
+    def last_cumulative_tokens(conversation_id: int) -> int:
+        """会話の最新の累計トークン数を返す"""
+        queryset = Message.objects.filter(conversation_id=conversation_id).order_by('-cumulative_tokens')
+        return queryset.values_list('cumulative_tokens', flat=True).first() or 0
+
+
+class ArchivedConversation(models.Model):
+    """
+    アーカイブした会話のメッセージ
+    メッセージの一覧をJSONにしてcodecで圧縮し、一行にまとめて保存する
+    """
+    CODEC_ZLIB = 'zlib'
+    CODEC_ZSTD = 'zstd'
+    CODEC_CHOICES = (
+        (CODEC_ZLIB, 'zlib'),
+        (CODEC_ZSTD, 'zstd'),
+    )
+
+    conversation = models.OneToOneField(Conversation, primary_key=True, related_name='archive',
+                                        on_delete=models.CASCADE)
+    codec = models.CharField(max_length=8, choices=CODEC_CHOICES)
+    data = models.BinaryField()
+    message_count = models.IntegerField()
+    # 圧縮前のJSONのバイト数
+    raw_size = models.IntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.conversation_id} ({self.codec})'
+
+
+class TokenUsage(models.Model):
+    """
+    ユーザー・日・モデルごとのトークン使用量の台帳
+    メッセージとトピックの保存時に同じトランザクションで加算する
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    model = models.CharField(max_length=64)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    topic_tokens = models.BigIntegerField(default=0)
+    summary_tokens = models.BigIntegerField(default=0)
+    total_tokens = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date', 'model'], name='token_usage_user_date_model_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} {self.date} {self.model}'
+
+    @classmethod
+    def record(cls, user_id: int, model: str, date: datetime.date = None, prompt_tokens: int = 0,
+               completion_tokens: int = 0, topic_tokens: int = 0, summary_tokens: int = 0):
+        """その日の行に加算する。行がなければ作る"""
+        date = date or timezone.localdate()
+        total = prompt_tokens + completion_tokens + topic_tokens + summary_tokens
+        increments = {
+            'prompt_tokens': F('prompt_tokens') + prompt_tokens,
+            'completion_tokens': F('completion_tokens') + completion_tokens,
+            'topic_tokens': F('topic_tokens') + topic_tokens,
+            'summary_tokens': F('summary_tokens') + summary_tokens,
+            'total_tokens': F('total_tokens') + total,
+        }
+        rows = cls.objects.filter(user_id=user_id, date=date, model=model)
+        if rows.update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(user_id=user_id, date=date, model=model, prompt_tokens=prompt_tokens,
+                                   completion_tokens=completion_tokens, topic_tokens=topic_tokens,
+                                   summary_tokens=summary_tokens, total_tokens=total)
+        except IntegrityError:
+            # 同時に他のリクエストが行を作った
+            rows.update(**increments)
+
+    @staticmethod
+    def month_range(month: datetime.date = None):
+        """monthを含む月の初日と翌月の初日を返す"""
+        start = (month or timezone.localdate()).replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, end
+
+    @classmethod
+    def month_total(cls, user_id: int, month: datetime.date = None) -> int:
+        """月の合計。一月分(日数xモデル数)の行を足すだけで済む"""
+        start, end = cls.month_range(month)
+        total = cls.objects.filter(user_id=user_id, date__gte=start, date__lt=end).aggregate(
+            total=models.Sum('total_tokens'))['total']
+        return total or 0
@@ -1,24 +1,263 @@
-import openai
+import asyncio
+import importlib.util
 import os
+import threading
+import weakref
+import httpx
+import openai
+from django.conf import settings
+from django.test.signals import setting_changed
 from dotenv import load_dotenv
+from .simulated_llm import SimulatedBackend
+from .tokens import CHAT_MODEL
 
 load_dotenv()
 
 
+class PoolStats:
+    """
+    upstreamへの接続プールの使用状況
+    in_flightはレスポンスのストリームを閉じるまで数える
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        # 接続数の上限に達した状態でリクエストした(プールの空きを待った)回数
+        self.saturated = 0
+
+    def acquire(self, max_connections: int):
+        with self._lock:
+            if self.in_flight >= max_connections:
+                self.saturated += 1
+            self.in_flight += 1
+            self.requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'requests': self.requests,
+                'saturated': self.saturated,
+                'max_connections': settings.OPENAI_HTTP['MAX_CONNECTIONS'],
+            }
+
+
+pool_stats = PoolStats()
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    def __init__(self, stream, stats: PoolStats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._stats.release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, stats: PoolStats):
+        self._stream = stream
+        self._stats = stats
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._stats.release()
+
+
+class InstrumentedTransport(httpx.BaseTransport):
+    """リクエストの開始からレスポンスを閉じるまでをpool_statsに数えるトランスポート"""
+
+    def __init__(self, transport: httpx.BaseTransport, stats: PoolStats, max_connections: int):
+        self._transport = transport
+        self._stats = stats
+        self._max_connections = max_connections
+
+    def handle_request(self, request):
+        self._stats.acquire(self._max_connections)
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            self._stats.release()
+            raise
+        response.stream = _ReleasingStream(response.stream, self._stats)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncInstrumentedTransport(httpx.AsyncBaseTransport):
+    """InstrumentedTransportの非同期版"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: PoolStats, max_connections: int):
+        self._transport = transport
+        self._stats = stats
+        self._max_connections = max_connections
+
+    async def handle_async_request(self, request):
+        self._stats.acquire(self._max_connections)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._stats.release()
+            raise
+        response.stream = _AsyncReleasingStream(response.stream, self._stats)
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def http2_available() -> bool:
+    """HTTP/2はh2パッケージが入っている場合だけ使う"""
+    return settings.OPENAI_HTTP['HTTP2'] and importlib.util.find_spec('h2') is not None
+
+
+def http_timeout():
+    config = settings.OPENAI_HTTP
+    return httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT'])
+
+
+def http_limits():
+    config = settings.OPENAI_HTTP
+    return httpx.Limits(max_connections=config['MAX_CONNECTIONS'],
+                        max_keepalive_connections=config['MAX_KEEPALIVE_CONNECTIONS'],
+                        keepalive_expiry=config['KEEPALIVE_EXPIRY'])
+
+
+def build_http_client(transport=None):
+    """設定に従った接続プールを持つhttpx.Clientを作る"""
+    limits = http_limits()
+    if transport is None:
+        transport = httpx.HTTPTransport(limits=limits, http2=http2_available())
+    transport = InstrumentedTransport(transport, pool_stats, limits.max_connections)
+    return httpx.Client(transport=transport, timeout=http_timeout())
+
+
+def build_async_http_client(transport=None):
+    """build_http_clientの非同期版"""
+    limits = http_limits()
+    if transport is None:
+        transport = httpx.AsyncHTTPTransport(limits=limits, http2=http2_available())
+    transport = AsyncInstrumentedTransport(transport, pool_stats, limits.max_connections)
+    return httpx.AsyncClient(transport=transport, timeout=http_timeout())
+
+
+_client = None
+_client_lock = threading.Lock()
+# イベントループごとの非同期クライアント。ループが破棄されると一緒に消える
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_openai_client() -> openai.OpenAI:
+    """プロセスで共有する同期クライアントを返す"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = openai.OpenAI(api_key=os.getenv('API_KEY'), base_url=settings.OPENAI_BASE_URL,
+                                        http_client=build_http_client(), timeout=http_timeout())
+    return _client
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """実行中のイベントループで共有する非同期クライアントを返す"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = openai.AsyncOpenAI(api_key=os.getenv('API_KEY'), base_url=settings.OPENAI_BASE_URL,
+                                    http_client=build_async_http_client(), timeout=http_timeout())
+        _async_clients[loop] = client
+    return client
+
+
+class OpenAIBackend:
+    """本物のOpenAI API。OPENAI_BASE_URLで互換サーバーにも向けられる"""
+
+    def client(self):
+        # 接続プールを使い回すため、クライアントはプロセス(非同期ではイベントループ)で共有する
+        return get_openai_client()
+
+    def async_client(self):
+        return get_async_openai_client()
+
+
+LLM_BACKENDS = {'openai': OpenAIBackend, 'simulated': SimulatedBackend}
+
+# シミュレーターの乱数の状態を共有するため、バックエンドは使い回す
+_backends = {}
+
+
+def get_llm_backend():
+    """CHAT_LLM_BACKENDで選んだバックエンドを返す"""
+    name = settings.CHAT_LLM_BACKEND
+    backend = _backends.get(name)
+    if backend is None:
+        backend_class = LLM_BACKENDS.get(name)
+        if backend_class is None:
+            raise ValueError(f'Unknown CHAT_LLM_BACKEND: {name}')
+        backend = _backends.setdefault(name, backend_class())
+    return backend
+
+
+def reset_llm_backends(*, setting, **kwargs):
+    if setting in ('CHAT_LLM_BACKEND', 'CHAT_SIMULATED_LLM', 'OPENAI_BASE_URL'):
+        global _client
+        _backends.clear()
+        _client = None
+        _async_clients.clear()
+
+
+setting_changed.connect(reset_llm_backends)
+
+
 class OpenAIClient:
-    def __init__(self, model_name='gpt-3.5-turbo-0613'):
+    def __init__(self, model_name=CHAT_MODEL):
         self.model_name = model_name
-        self.api_key = os.getenv('API_KEY')  # 環境変数からAPIキーを取得
-        openai.api_key = self.api_key  # openaiライブラリにAPIキーをセット
         self.base_system_order = 'マークダウン形式で返してください'
 
+    @property
+    def client(self):
+        return get_llm_backend().client()
+
+    @property
+    def async_client(self):
+        return get_llm_backend().async_client()
+
     def generate_response_single_prompt(self, prompt: str, max_tokens: int = 1024):
         """
         チャットの単発のコンプリーションを生成する。
         """
         messages = [{'role': "system", "content": self.base_system_order},
                     {"role": "user", "content": prompt}]
-        res = openai.chat.completions.create(
+        res = self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
             max_tokens=max_tokens
@@ -31,7 +270,20 @@ class OpenAIClient:
         """
         messages = [{'role': "system", "content": '以下のチャットのやり取りからトピックを20文字以内で返しなさい'},
                     {"role": "user", "content": prompt}]
-        res = openai.chat.completions.create(
+        res = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=max_tokens
+        )
+        return res
+
+    def generate_summary_response(self, text: str, max_tokens: int = 512):
+        """
+        会話の要約をAIに作ってもらう
+        """
+        messages = [{'role': "system", "content": '以下の会話を、続きの会話の文脈として使えるように要点を残して要約しなさい'},
+                    {"role": "user", "content": text}]
+        res = self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
             max_tokens=max_tokens
@@ -45,7 +297,7 @@ class OpenAIClient:
         _messages = [{'role': "system", "content": self.base_system_order}]
         for elm in messages:
             _messages.append(elm)
-        res = openai.chat.completions.create(
+        res = self.client.chat.completions.create(
             model=self.model_name,
             messages=_messages,
             max_tokens=max_tokens
@@ -56,7 +308,23 @@ class OpenAIClient:
         _messages = [{'role': "system", "content": self.base_system_order}]
         for elm in messages:
             _messages.append(elm)
-        response = openai.chat.completions.create(
+        response = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=_messages,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        return response
+
+    async def agenerate_stream_response(self, messages: list, max_tokens: int = 1024):
+        """
+        generate_stream_responseの非同期版
+        ASGI上でイベントループをブロックせずにストリームを受け取る
+        """
+        _messages = [{'role': "system", "content": self.base_system_order}]
+        for elm in messages:
+            _messages.append(elm)
+        response = await self.async_client.chat.completions.create(
             model=self.model_name,
             messages=_messages,
             max_tokens=max_tokens,
@@ -0,0 +1,65 @@
+"""
+読み取り専用のエンドポイントをレプリカに振り分けるDBルーター
+
+ReplicaReadMixinを付けたビューの中の読み取りだけをCHAT_READ_REPLICASのいずれかに送る。
+それ以外の読み取り(build_historyなど、書き込み直後に読む処理)と書き込みはすべてdefaultに送る
+"""
+import random
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# ReplicaReadMixinのビューの中で使うレプリカ
+_replica = ContextVar('replica', default=None)
+
+
+def choose_replica():
+    """レプリカを一つ選ぶ。一つのリクエストの中では同じレプリカから読む"""
+    replicas = settings.CHAT_READ_REPLICAS
+    return random.choice(replicas) if replicas else None
+
+
+def read_alias() -> str:
+    """今の読み取りに使うエイリアス"""
+    return _replica.get() or DEFAULT_DB_ALIAS
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # 関連の読み取りは元のオブジェクトと同じDBから読む
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはdefaultの複製なので、どのDBから読んだオブジェクト同士でも関連付けてよい
+        databases = {DEFAULT_DB_ALIAS, *settings.CHAT_READ_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカのスキーマはdefaultから複製される
+        return db not in settings.CHAT_READ_REPLICAS
+
+
+class ReplicaReadMixin:
+    """
+    認証・権限・制限の確認が済んでから、レスポンスを返すまでの読み取りをレプリカに送る
+    認証はトークンを消した直後でも通らないよう、defaultで行う
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.replica_token = _replica.set(choose_replica())
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, 'replica_token', None)
+        if token is not None:
+            _replica.reset(token)
+            self.replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
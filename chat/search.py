@@ -0,0 +1,240 @@
+"""
+会話のキーワード検索用の転置インデックス
+
+日本語は単語の区切りがないため、本文をbigramに分割してインデックスする
+SQLiteではFTS5、PostgreSQLではtsvector+GINを使う。
+SQLiteではuser_idの列もインデックスし、他のユーザーの行を読まないようMATCHの中でユーザーを絞る
+どちらも使えない場合はsearch_conversation_idsがNoneを返し、呼び出し側でicontainsにフォールバックする
+"""
+import re
+import unicodedata
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+WORD_RE = re.compile(r'\w+')
+
+MESSAGE_TABLE = {'sqlite': 'chat_message_fts', 'postgresql': 'chat_message_search'}
+CONVERSATION_TABLE = {'sqlite': 'chat_conversation_fts', 'postgresql': 'chat_conversation_search'}
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def word_terms(word: str) -> list:
+    """
+    単語をbigramに分割する
+    一文字の検索語にも当たるように、末尾の一文字も加える
+    """
+    if len(word) == 1:
+        return [word]
+    terms = [word[i:i + 2] for i in range(len(word) - 1)]
+    terms.append(word[-1])
+    return terms
+
+
+def ngram_text(text: str) -> str:
+    """インデックスに保存するbigramの列を返す"""
+    terms = []
+    for word in WORD_RE.findall(normalize(text)):
+        terms.extend(word_terms(word))
+    return ' '.join(terms)
+
+
+def query_words(keyword: str) -> list:
+    """検索キーワードを単語に分割する"""
+    return WORD_RE.findall(normalize(keyword))
+
+
+class SqliteSearch:
+    """FTS5を使ったインデックス"""
+
+    vendor = 'sqlite'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index_message(self, message):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO chat_message_fts (rowid, terms, conversation_id, user_id) '
+                'VALUES (%s, %s, %s, %s)',
+                [message.id, ngram_text(message.message), message.conversation_id, message.user_id])
+
+    def index_messages(self, messages):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO chat_message_fts (rowid, terms, conversation_id, user_id) '
+                'VALUES (%s, %s, %s, %s)',
+                [(m.id, ngram_text(m.message), m.conversation_id, m.user_id) for m in messages])
+
+    def delete_message(self, message_id: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_message_fts WHERE rowid = %s', [message_id])
+
+    def delete_conversation_messages(self, conversation_id: int, user_id: int):
+        """アーカイブした会話のメッセージの分を消す。conversation_idは索引がないので、ユーザーの行から探す"""
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_message_fts WHERE rowid IN ('
+                           'SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s AND conversation_id = %s)',
+                           [self.user_filter(user_id), conversation_id])
+
+    def index_conversation(self, conversation):
+        self.index_conversations([conversation])
+
+    def index_conversations(self, conversations):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO chat_conversation_fts (rowid, terms, user_id) VALUES (%s, %s, %s)',
+                [(c.id, ngram_text(c.topic), c.user_id) for c in conversations])
+
+    def delete_conversation(self, conversation_id: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_conversation_fts WHERE rowid = %s', [conversation_id])
+
+    @staticmethod
+    def match_expression(word: str) -> str:
+        """termsの列だけに当てる(user_idの列の数字に当たらないように)"""
+        if len(word) == 1:
+            return f'terms : "{word}"*'
+        return 'terms : "' + ' '.join(word_terms(word)[:-1]) + '"'
+
+    @staticmethod
+    def user_filter(user_id: int) -> str:
+        return f'user_id : "{int(user_id)}"'
+
+    def search(self, user_id: int, words: list, limit: int) -> list:
+        """
+        topicに全てのキーワードを含む会話と、
+        紐づくメッセージ全体で全てのキーワードを含む会話を、bm25(rank列)の順に一回のクエリで上位limit件返す
+        """
+        user = self.user_filter(user_id)
+        expressions = [self.match_expression(word) for word in words]
+        message_selects = []
+        params = [' AND '.join([user] + expressions)]
+        for i, expression in enumerate(expressions):
+            message_selects.append(
+                f'SELECT conversation_id, {i} AS word, rank AS score '
+                'FROM chat_message_fts WHERE chat_message_fts MATCH %s')
+            params.append(f'{user} AND {expression}')
+        params += [len(expressions), limit]
+        sql = (
+            'SELECT conversation_id, MIN(score) AS score FROM ('
+            'SELECT rowid AS conversation_id, rank AS score '
+            'FROM chat_conversation_fts WHERE chat_conversation_fts MATCH %s '
+            'UNION ALL '
+            'SELECT conversation_id, SUM(score) AS score FROM (' + ' UNION ALL '.join(message_selects) + ') '
+            'GROUP BY conversation_id HAVING COUNT(DISTINCT word) = %s'
+            ') GROUP BY conversation_id ORDER BY score, conversation_id DESC LIMIT %s'
+        )
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearch:
+    """tsvectorとGINインデックスを使ったインデックス"""
+
+    vendor = 'postgresql'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index_message(self, message):
+        self.index_messages([message])
+
+    def index_messages(self, messages):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO chat_message_search (message_id, conversation_id, user_id, terms) '
+                "VALUES (%s, %s, %s, to_tsvector('simple', %s)) "
+                'ON CONFLICT (message_id) DO UPDATE SET terms = EXCLUDED.terms',
+                [(m.id, m.conversation_id, m.user_id, ngram_text(m.message)) for m in messages])
+
+    def delete_message(self, message_id: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_message_search WHERE message_id = %s', [message_id])
+
+    def delete_conversation_messages(self, conversation_id: int, user_id: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_message_search WHERE conversation_id = %s', [conversation_id])
+
+    def index_conversation(self, conversation):
+        self.index_conversations([conversation])
+
+    def index_conversations(self, conversations):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO chat_conversation_search (conversation_id, user_id, terms) '
+                "VALUES (%s, %s, to_tsvector('simple', %s)) "
+                'ON CONFLICT (conversation_id) DO UPDATE SET terms = EXCLUDED.terms',
+                [(c.id, c.user_id, ngram_text(c.topic)) for c in conversations])
+
+    def delete_conversation(self, conversation_id: int):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM chat_conversation_search WHERE conversation_id = %s', [conversation_id])
+
+    @staticmethod
+    def tsquery(word: str) -> str:
+        if len(word) == 1:
+            return f"to_tsquery('simple', %s || ':*')", word
+        return "phraseto_tsquery('simple', %s)", ' '.join(word_terms(word)[:-1])
+
+    def search(self, user_id: int, words: list, limit: int) -> list:
+        """SqliteSearch.searchと同じ条件で、ts_rankの順に上位limit件返す"""
+        queries = [self.tsquery(word) for word in words]
+        topic_query = ' && '.join(q for q, _ in queries)
+        params = [p for _, p in queries] + [p for _, p in queries] + [user_id]
+        message_selects = []
+        for i, (query, param) in enumerate(queries):
+            message_selects.append(
+                f'SELECT conversation_id, {i} AS word, ts_rank(terms, {query}) AS score '
+                f'FROM chat_message_search WHERE terms @@ {query} AND user_id = %s')
+            params += [param, param, user_id]
+        params += [len(queries), limit]
+        sql = (
+            'SELECT conversation_id, MAX(score) AS score FROM ('
+            f'SELECT conversation_id, ts_rank(terms, {topic_query}) AS score '
+            f'FROM chat_conversation_search WHERE terms @@ ({topic_query}) AND user_id = %s '
+            'UNION ALL '
+            'SELECT conversation_id, SUM(score) AS score FROM (' + ' UNION ALL '.join(message_selects) + ') w '
+            'GROUP BY conversation_id HAVING COUNT(DISTINCT word) = %s'
+            ') hits GROUP BY conversation_id ORDER BY score DESC, conversation_id DESC LIMIT %s'
+        )
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+SEARCH_BACKENDS = {'sqlite': SqliteSearch, 'postgresql': PostgresSearch}
+
+# エイリアスごとにインデックスのテーブルがあるかどうかを覚えておく
+_available = {}
+
+
+def get_search_backend(using: str = DEFAULT_DB_ALIAS):
+    """インデックスが使えるバックエンドを返す。使えなければNone"""
+    connection = connections[using]
+    backend_class = SEARCH_BACKENDS.get(connection.vendor)
+    if backend_class is None:
+        return None
+    if using not in _available:
+        tables = connection.introspection.table_names()
+        _available[using] = MESSAGE_TABLE[connection.vendor] in tables
+    if not _available[using]:
+        return None
+    return backend_class(connection)
+
+
+def search_conversation_ids(user_id: int, keyword: str, using: str = DEFAULT_DB_ALIAS, limit: int = None):
+    """
+    キーワードにヒットした会話IDをランク順に、上位limit件(デフォルトはCHAT_SEARCH_MAX_RESULTS)返す
+    インデックスが使えない場合はNoneを返す
+    """
+    words = query_words(keyword)
+    backend = get_search_backend(using)
+    if backend is None:
+        return None
+    if not words:
+        return []
+    return backend.search(user_id, words, limit or settings.CHAT_SEARCH_MAX_RESULTS)
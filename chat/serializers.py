@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Conversation, Message
+from .models import Conversation, Message, TokenUsage
 
 
 class DynamicFieldsModelSerializer(serializers.ModelSerializer):
@@ -38,16 +38,46 @@ class ConversationSerializer(DynamicFieldsModelSerializer):
 
     class Meta:
         model = Conversation
-        fields = ('id', 'topic', 'created_at', 'messages')
+        fields = ('id', 'topic', 'topic_status', 'created_at', 'messages')
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # 一覧ではアーカイブから展開したメッセージを付けている(chat.archive.attach_archived_messages)
+        archived_messages = getattr(instance, 'archived_messages', None)
+        if archived_messages is not None and 'messages' in self.fields:
+            data['messages'] = MessageSerializer(archived_messages, many=True).data
+        return data
+
+
+class ConversationSummarySerializer(DynamicFieldsModelSerializer):
+    """一覧のサイドバー向けに、メッセージを含めず集計値だけを返す"""
+
+    class Meta:
+        model = Conversation
+        fields = ('id', 'topic', 'topic_status', 'created_at', 'message_count', 'total_tokens',
+                  'last_activity_at', 'last_message_preview')
 
 
 class ConversationCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Conversation
         fields = '__all__'
+        # 集計値やバックグラウンド処理の状態はサーバー側で更新するので、クライアントからは書かせない
+        read_only_fields = ('topic_status', 'topic_tokens', 'topic_claimed_at', 'message_count', 'total_tokens',
+                            'last_activity_at', 'last_message_preview', 'summary', 'summary_tokens',
+                            'summarized_until', 'summary_status', 'summary_claimed_at', 'archived')
 
 
 class MessageCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__'
+        # 累計トークン数はMessage.saveで会話の行をロックして計算する
+        read_only_fields = ('cumulative_tokens',)
+
+
+class TokenUsageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TokenUsage
+        fields = ('date', 'model', 'prompt_tokens', 'completion_tokens', 'topic_tokens', 'summary_tokens',
+                  'total_tokens')
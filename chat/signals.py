@@ -0,0 +1,37 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Conversation, Message
+from .search import get_search_backend
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, raw=False, using=None, **kwargs):
+    """メッセージの保存時に検索インデックスを更新する"""
+    backend = get_search_backend(using)
+    if backend is not None and not raw:
+        backend.index_message(instance)
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, using=None, **kwargs):
+    backend = get_search_backend(using)
+    if backend is not None:
+        backend.delete_message(instance.id)
+
+
+@receiver(post_save, sender=Conversation)
+def index_conversation(sender, instance, raw=False, using=None, **kwargs):
+    """会話の保存時にtopicの検索インデックスを更新する"""
+    backend = get_search_backend(using)
+    if backend is not None and not raw:
+        backend.index_conversation(instance)
+
+
+@receiver(post_delete, sender=Conversation)
+def unindex_conversation(sender, instance, using=None, **kwargs):
+    backend = get_search_backend(using)
+    if backend is not None:
+        backend.delete_conversation(instance.id)
+        if instance.archived:
+            # アーカイブした会話のメッセージは行がないので、シグナルでは消えない分をまとめて消す
+            backend.delete_conversation_messages(instance.id, instance.user_id)
@@ -0,0 +1,183 @@
+import asyncio
+import random
+import re
+import time
+import uuid
+import httpx
+import openai
+from django.conf import settings
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from .ai_mock import get_mock_response
+
+# 英数字はまとめて、それ以外は1文字を1トークンとみなす
+TOKEN_RE = re.compile(r'[A-Za-z0-9]+|\s+|.', re.S)
+SIMULATED_URL = 'http://simulated.invalid/v1/chat/completions'
+
+
+def split_tokens(text: str) -> list:
+    """本文をおおよそのトークンに分割する"""
+    return TOKEN_RE.findall(text)
+
+
+def count_prompt_tokens(messages: list) -> int:
+    return sum(len(split_tokens(message.get('content') or '')) for message in messages)
+
+
+class SimulatedTiming:
+    """
+    シミュレーションのレイテンシ設定
+    ttftは最初のトークンまでの秒数、jitterは待ち時間を揺らす割合(0.2なら±20%)
+    """
+
+    def __init__(self, ttft=0.3, tokens_per_second=50.0, jitter=0.2, error_rate=0.0, seed=None):
+        self.ttft = float(ttft)
+        self.tokens_per_second = float(tokens_per_second)
+        self.jitter = float(jitter)
+        self.error_rate = float(error_rate)
+        self.random = random.Random(seed)
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        options = {key.lower(): value for key, value in settings.CHAT_SIMULATED_LLM.items()}
+        options.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**options)
+
+    def delay(self, seconds: float) -> float:
+        if self.jitter:
+            seconds *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        return max(seconds, 0.0)
+
+    def first_token_delay(self) -> float:
+        return self.delay(self.ttft)
+
+    def token_delay(self) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return self.delay(1 / self.tokens_per_second)
+
+    def error_at(self, n_tokens: int):
+        """何トークン目で失敗させるかを返す。失敗させなければNone"""
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.random.randint(0, n_tokens)
+        return None
+
+
+def simulated_error() -> openai.APIError:
+    return openai.APIError('simulated upstream error', httpx.Request('POST', SIMULATED_URL), body=None)
+
+
+class Completion:
+    """1回分のコンプリーションの内容と、各チャンクを送るまでの待ち時間"""
+
+    def __init__(self, timing: SimulatedTiming, model: str, messages: list, max_tokens: int):
+        self.model = model
+        self.id = f'chatcmpl-sim-{uuid.uuid4().hex[:24]}'
+        self.created = int(time.time())
+        self.tokens = split_tokens(get_mock_response())[:max_tokens]
+        self.finish_reason = 'stop' if len(self.tokens) < max_tokens else 'length'
+        self.prompt_tokens = count_prompt_tokens(messages)
+        self.error_at = timing.error_at(len(self.tokens))
+        self.timing = timing
+
+    def steps(self):
+        """(待ち時間, チャンク)の列を返す。失敗させる位置ではチャンクの代わりにNone"""
+        yield self.timing.first_token_delay(), self.chunk({'role': 'assistant', 'content': ''})
+        for i, token in enumerate(self.tokens):
+            if i == self.error_at:
+                yield 0.0, None
+                return
+            delay = self.timing.token_delay() if i else 0.0
+            yield delay, self.chunk({'content': token})
+        if self.error_at == len(self.tokens):
+            yield 0.0, None
+            return
+        yield 0.0, self.chunk({}, self.finish_reason)
+
+    def total_delay(self) -> float:
+        delay = self.timing.first_token_delay()
+        delay += sum(self.timing.token_delay() for _ in self.tokens[1:])
+        return delay
+
+    def chunk(self, delta: dict, finish_reason=None) -> ChatCompletionChunk:
+        return ChatCompletionChunk(
+            id=self.id, created=self.created, model=self.model, object='chat.completion.chunk',
+            choices=[{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        )
+
+    def response(self) -> ChatCompletion:
+        completion_tokens = len(self.tokens)
+        return ChatCompletion(
+            id=self.id, created=self.created, model=self.model, object='chat.completion',
+            choices=[{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(self.tokens)},
+                      'finish_reason': self.finish_reason}],
+            usage={'prompt_tokens': self.prompt_tokens, 'completion_tokens': completion_tokens,
+                   'total_tokens': self.prompt_tokens + completion_tokens},
+        )
+
+
+class _Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SimulatedCompletions:
+    """openai.OpenAI().chat.completionsと同じ呼び出し方をするシミュレーター"""
+
+    def __init__(self, timing: SimulatedTiming):
+        self.timing = timing
+
+    def create(self, *, model: str, messages: list, max_tokens: int = 1024, stream: bool = False, **kwargs):
+        completion = Completion(self.timing, model, messages, max_tokens)
+        if stream:
+            return self._stream(completion)
+        if completion.error_at is not None:
+            time.sleep(completion.timing.first_token_delay())
+            raise simulated_error()
+        time.sleep(completion.total_delay())
+        return completion.response()
+
+    @staticmethod
+    def _stream(completion: Completion):
+        for delay, chunk in completion.steps():
+            if delay:
+                time.sleep(delay)
+            if chunk is None:
+                raise simulated_error()
+            yield chunk
+
+
+class AsyncSimulatedCompletions(SimulatedCompletions):
+    """SimulatedCompletionsの非同期版。待ち時間でイベントループを止めない"""
+
+    async def create(self, *, model: str, messages: list, max_tokens: int = 1024, stream: bool = False,
+                     **kwargs):
+        completion = Completion(self.timing, model, messages, max_tokens)
+        if stream:
+            return self._astream(completion)
+        if completion.error_at is not None:
+            await asyncio.sleep(completion.timing.first_token_delay())
+            raise simulated_error()
+        await asyncio.sleep(completion.total_delay())
+        return completion.response()
+
+    @staticmethod
+    async def _astream(completion: Completion):
+        for delay, chunk in completion.steps():
+            if delay:
+                await asyncio.sleep(delay)
+            if chunk is None:
+                raise simulated_error()
+            yield chunk
+
+
+class SimulatedBackend:
+    """ai_mockの本文を、設定したレイテンシでストリームするローカルのバックエンド"""
+
+    def __init__(self, timing: SimulatedTiming = None):
+        self.timing = timing or SimulatedTiming.from_settings()
+
+    def client(self):
+        return _Namespace(chat=_Namespace(completions=SimulatedCompletions(self.timing)))
+
+    def async_client(self):
+        return _Namespace(chat=_Namespace(completions=AsyncSimulatedCompletions(self.timing)))
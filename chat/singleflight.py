@@ -0,0 +1,186 @@
+"""
+同じリクエストのストリームをまとめる(single-flight)
+
+生成中のリクエストと同じものが届いた場合、upstreamへ新しくストリームを開かずに
+最初のストリームを共有する。後から来たリクエストはそれまでに受け取ったdeltaを受け取り、
+その後は最初のストリームに追従する
+upstreamの読み出しはリクエストとは別のスレッド(非同期ではタスク)で行うので、
+最初のクライアントが切断しても他のクライアントへの配信は続く
+"""
+import asyncio
+import threading
+import weakref
+
+
+class FlightStats:
+    """single-flightの統計。followersが重複してまとめられたリクエストの数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.in_flight = 0
+
+    def start(self):
+        with self._lock:
+            self.leaders += 1
+            self.in_flight += 1
+
+    def join(self):
+        with self._lock:
+            self.followers += 1
+
+    def finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'leaders': self.leaders, 'followers': self.followers, 'in_flight': self.in_flight}
+
+
+stats = FlightStats()
+
+
+class Flight:
+    """一つのupstreamストリームの受信済みdeltaと、それを待つ購読者"""
+
+    def __init__(self):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def publish(self, delta: dict):
+        with self.cond:
+            self.deltas.append(delta)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def subscribe(self):
+        """受信済みのdeltaを返し、その後は新しいdeltaを待って返す"""
+        i = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: i < len(self.deltas) or self.done)
+                batch = self.deltas[i:]
+                i += len(batch)
+                finished = self.done and i >= len(self.deltas)
+            yield from batch
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _pump(key: str, flight: Flight, start):
+    try:
+        for delta in start():
+            flight.publish(delta)
+    except Exception as e:
+        flight.finish(e)
+    else:
+        flight.finish()
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        stats.finish()
+
+
+def stream(key: str, start):
+    """
+    keyが同じ生成中のストリームがあればそれを購読し、なければstartでストリームを開始する
+    startはdeltaの辞書を返すイテレータを返す関数
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            _flights[key] = flight
+    if leader:
+        stats.start()
+        threading.Thread(target=_pump, args=(key, flight, start), daemon=True, name='single-flight').start()
+    else:
+        stats.join()
+    return flight.subscribe()
+
+
+class AsyncFlight:
+    """Flightの非同期版"""
+
+    def __init__(self):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self.cond = asyncio.Condition()
+        self.task = None
+
+    async def publish(self, delta: dict):
+        async with self.cond:
+            self.deltas.append(delta)
+            self.cond.notify_all()
+
+    async def finish(self, error=None):
+        async with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            async with self.cond:
+                await self.cond.wait_for(lambda: i < len(self.deltas) or self.done)
+                batch = self.deltas[i:]
+                i += len(batch)
+                finished = self.done and i >= len(self.deltas)
+            for delta in batch:
+                yield delta
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+# イベントループごとの生成中のストリーム
+_async_flights = weakref.WeakKeyDictionary()
+
+
+async def _apump(flights: dict, key: str, flight: AsyncFlight, start):
+    try:
+        async for delta in await start():
+            await flight.publish(delta)
+    except Exception as e:
+        await flight.finish(e)
+    else:
+        await flight.finish()
+    finally:
+        flights.pop(key, None)
+        stats.finish()
+
+
+def astream(key: str, start):
+    """
+    streamの非同期版
+    startはdeltaの辞書を返す非同期イテレータを返すコルーチン関数
+    """
+    flights = _async_flights.setdefault(asyncio.get_running_loop(), {})
+    flight = flights.get(key)
+    if flight is None:
+        flight = AsyncFlight()
+        flights[key] = flight
+        stats.start()
+        flight.task = asyncio.create_task(_apump(flights, key, flight, start))
+    else:
+        stats.join()
+    return flight.subscribe()
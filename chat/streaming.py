@@ -0,0 +1,260 @@
+import json
+import time
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from . import completion_cache, metrics, singleflight
+
+
+def sse_frame(delta: dict) -> str:
+    """OpenAIのdeltaをSSEのフレームに変換する"""
+    data = json.dumps(delta)
+    return f'data: {data}\n\n'
+
+
+def sse_event(event: str, payload: dict) -> str:
+    """名前付きのSSEイベントを返す"""
+    data = json.dumps(payload)
+    return f'event: {event}\ndata: {data}\n\n'
+
+
+def compact_frame(delta: dict) -> str:
+    """本文だけを運ぶ軽量なフレーム。本文のないdeltaは送らない"""
+    if not delta.get('content'):
+        return ''
+    data = json.dumps(delta['content'], ensure_ascii=False)
+    return f'data: {data}\n\n'
+
+
+def mergeable(delta: dict) -> bool:
+    """本文以外の値を持たないdeltaだけをまとめる"""
+    return all(value is None for key, value in delta.items() if key != 'content')
+
+
+def merge_deltas(deltas: list) -> dict:
+    merged = dict(deltas[0])
+    merged['content'] = ''.join(delta.get('content') or '' for delta in deltas)
+    return merged
+
+
+class Coalescer:
+    """
+    続けて届いたdeltaを一つにまとめる
+    溜め始めてからwindow秒経つか、本文がmax_bytesを超えたら送り出す。
+    次のdeltaを待たないと送り出せないので、到着間隔の移動平均がwindowより長い
+    (upstreamが遅い)間は溜めずにすぐ送る。最初の本文も体感速度のためにすぐ送る
+    """
+    ALPHA = 0.3
+
+    def __init__(self, window: float, max_bytes: int, clock=time.monotonic):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.buffer = []
+        self.size = 0
+        self.started = None
+        self.last = None
+        self.gap = None
+        self.sent_content = False
+
+    def push(self, delta: dict) -> list:
+        """deltaを受け取り、いま送り出すdeltaのリストを返す"""
+        now = self.clock()
+        if self.last is not None:
+            gap = now - self.last
+            self.gap = gap if self.gap is None else self.gap + (gap - self.gap) * self.ALPHA
+        self.last = now
+        if not mergeable(delta):
+            return self.flush() + [delta]
+        if not self.buffer:
+            self.started = now
+        self.buffer.append(delta)
+        self.size += len((delta.get('content') or '').encode())
+        if (not self.sent_content or self.size >= self.max_bytes or now - self.started >= self.window
+                or (self.gap is not None and self.gap >= self.window)):
+            return self.flush()
+        return []
+
+    def flush(self) -> list:
+        if not self.buffer:
+            return []
+        merged = merge_deltas(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if merged.get('content'):
+            self.sent_content = True
+        return [merged]
+
+
+def coalescer_from_settings():
+    """設定の窓が0ならNone(まとめない)"""
+    options = settings.CHAT_SSE_COALESCE
+    if not options['WINDOW_MS'] and not options['MAX_BYTES']:
+        return None
+    return Coalescer(options['WINDOW_MS'] / 1000, options['MAX_BYTES'])
+
+
+def coalesce(deltas, coalescer=None):
+    """deltaの列をCoalescerでまとめる"""
+    coalescer = coalescer or coalescer_from_settings()
+    if coalescer is None:
+        yield from deltas
+        return
+    for delta in deltas:
+        yield from coalescer.push(delta)
+    yield from coalescer.flush()
+
+
+async def acoalesce(deltas, coalescer=None):
+    coalescer = coalescer or coalescer_from_settings()
+    async for delta in deltas:
+        if coalescer is None:
+            yield delta
+            continue
+        for merged in coalescer.push(delta):
+            yield merged
+    if coalescer is not None:
+        for merged in coalescer.flush():
+            yield merged
+
+
+def iter_deltas(stream_response, timer: metrics.UpstreamTimer = None):
+    """
+    OpenAIのストリームからdeltaの辞書を取り出す
+    timerを渡すと、最初の本文までの秒数と毎秒のトークン数を記録する
+    """
+    for chunk in stream_response:
+        delta = dict(chunk.choices[0].delta)
+        if timer is not None:
+            timer.delta(delta)
+        yield delta
+    if timer is not None:
+        timer.finish()
+
+
+async def aiter_deltas(stream_response, timer: metrics.UpstreamTimer = None):
+    async for chunk in stream_response:
+        delta = dict(chunk.choices[0].delta)
+        if timer is not None:
+            timer.delta(delta)
+        yield delta
+    if timer is not None:
+        timer.finish()
+
+
+async def aiter_list(items: list):
+    for item in items:
+        yield item
+
+
+def iter_sse(deltas, on_complete=None, cache_key=None, compact: bool = False):
+    """
+    deltaの列からSSEフレームを生成する
+    on_completeを渡すと、ストリームが最後まで流れたところで
+    連結した本文を渡して呼び出す。戻り値があればsavedイベントとして送る
+    cache_keyを渡すと、最後まで流れたdeltaをキャッシュに保存する
+    compactなら本文だけのフレームにする
+    """
+    frame_of = compact_frame if compact else sse_frame
+    contents = []
+    received = []
+    for delta in deltas:
+        if delta.get('content'):
+            contents.append(delta['content'])
+        if cache_key is not None:
+            received.append(delta)
+        frame = frame_of(delta)
+        if frame:
+            yield frame
+    if cache_key is not None:
+        completion_cache.store(cache_key, received)
+    if on_complete is not None:
+        saved = on_complete(''.join(contents))
+        if saved:
+            yield sse_event('saved', saved)
+
+
+async def aiter_sse(deltas, on_complete=None, cache_key=None, compact: bool = False):
+    """
+    iter_sseの非同期版
+    on_completeはコルーチン関数を渡す
+    """
+    frame_of = compact_frame if compact else sse_frame
+    contents = []
+    received = []
+    async for delta in deltas:
+        if delta.get('content'):
+            contents.append(delta['content'])
+        if cache_key is not None:
+            received.append(delta)
+        frame = frame_of(delta)
+        if frame:
+            yield frame
+    if cache_key is not None:
+        await completion_cache.astore(cache_key, received)
+    if on_complete is not None:
+        saved = await on_complete(''.join(contents))
+        if saved:
+            yield sse_event('saved', saved)
+
+
+def stream_completion(client, messages: list, on_complete=None, max_tokens: int = 1024, compact: bool = False):
+    """
+    コンプリーションをSSEフレームでストリームする
+    同じリクエストのキャッシュがあればupstreamを呼ばずにそれを返す
+    deltaはCHAT_SSE_COALESCEの窓でまとめてからフレームにする
+    """
+    cache_key = completion_cache.key_for(client, messages, max_tokens)
+    cached = completion_cache.load(cache_key)
+    if cached is not None:
+        yield from iter_sse(coalesce(cached), on_complete, compact=compact)
+        return
+
+    def start():
+        timer = metrics.UpstreamTimer(client.model_name)
+        return iter_deltas(client.generate_stream_response(messages, max_tokens), timer)
+
+    if settings.CHAT_SINGLE_FLIGHT_ENABLED:
+        # 生成中の同じリクエストがあれば、そのストリームを共有する
+        key = completion_cache.make_key(client.model_name, client.base_system_order, messages, max_tokens)
+        deltas = singleflight.stream(key, start)
+    else:
+        deltas = start()
+    yield from iter_sse(coalesce(deltas), on_complete, cache_key, compact)
+
+
+async def astream_completion(client, messages: list, on_complete=None, max_tokens: int = 1024,
+                             compact: bool = False):
+    """stream_completionの非同期版"""
+    cache_key = completion_cache.key_for(client, messages, max_tokens)
+    cached = await completion_cache.aload(cache_key)
+    if cached is not None:
+        deltas = aiter_list(cached)
+        cache_key = None
+    else:
+        async def start():
+            timer = metrics.UpstreamTimer(client.model_name)
+            return aiter_deltas(await client.agenerate_stream_response(messages, max_tokens), timer)
+
+        if settings.CHAT_SINGLE_FLIGHT_ENABLED:
+            key = completion_cache.make_key(client.model_name, client.base_system_order, messages, max_tokens)
+            deltas = singleflight.astream(key, start)
+        else:
+            deltas = await start()
+    async for frame in aiter_sse(acoalesce(deltas), on_complete, cache_key, compact):
+        yield frame
+
+
+def wants_compact(request) -> bool:
+    """?frames=compactで本文だけのフレームにする(formatはDRFのURL_FORMAT_OVERRIDEが使うため別名)"""
+    return request.query_params.get('frames') == 'compact'
+
+
+def sse_response(content):
+    """
+    SSE用のStreamingHttpResponseを返す
+    contentは同期・非同期どちらのイテレータでもよい
+    """
+    r = StreamingHttpResponse(content, content_type='text/event-stream')
+    r['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
+    r['Cache-Control'] = 'no-cache'  # Ensure clients don't cache the data
+    return r
@@ -0,0 +1,168 @@
+"""
+長い会話の要約(コンパクション)
+
+要約されていないメッセージのトークン数がCHAT_SUMMARY_THRESHOLDを超えたら、
+直近のCHAT_SUMMARY_KEEP_TOKENS分を残して古いメッセージをバックグラウンドで要約する。
+build_historyは要約を先頭に置き、要約済みより後のメッセージだけを履歴に使う。
+実行方法はトピック生成と同じく CHAT_SUMMARY_WORKER (thread / db / inline) で切り替え、
+dbモードではmanage.py process_summary_jobsが待ちの会話を処理する
+要約中のままCHAT_SUMMARY_CLAIM_TIMEOUT秒が過ぎた会話は、ワーカーが落ちたものとして拾い直す
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Conversation, Message, TokenUsage
+from .open_ai_client import OpenAIClient
+from .tokens import calc_token
+from .topics import get_executor
+
+logger = logging.getLogger(__name__)
+
+# 一回の要約に渡す会話のトークン数の上限。超える分は次の回に回す
+SUMMARY_INPUT_TOKENS = 3000
+
+
+def summary_message(summary: str) -> dict:
+    """履歴の先頭に置く要約のメッセージ"""
+    return {'role': 'system', 'content': f'これまでの会話の要約:\n{summary}'}
+
+
+def summary_prompt_of(summary: str, messages: list) -> str:
+    lines = []
+    if summary:
+        lines.append(f'[これまでの要約]\n{summary}\n')
+    for message in messages:
+        lines.append(f"[{'ai' if message.is_bot else 'user'}]\n{message.message}\n")
+    return '\n'.join(lines)
+
+
+def stale_before():
+    """この日時より前に要約中になった会話は、ワーカーが落ちたものとみなす"""
+    return timezone.now() - timedelta(seconds=settings.CHAT_SUMMARY_CLAIM_TIMEOUT)
+
+
+def stale_running():
+    return Q(summary_status=Conversation.SUMMARY_RUNNING, summary_claimed_at__lt=stale_before())
+
+
+def maybe_enqueue_summary(conversation_id: int, cumulative_tokens: int) -> bool:
+    """
+    要約されていない分が閾値を超えていれば要約を予約する
+    条件付きのUPDATE一回で判定するので、同じ会話を二重に予約しない
+    """
+    if not settings.CHAT_SUMMARY_ENABLED:
+        return False
+    queueable = Q(summary_status__in=[Conversation.SUMMARY_IDLE, Conversation.SUMMARY_FAILED]) | stale_running()
+    queued = Conversation.objects.filter(
+        queueable,
+        id=conversation_id,
+        summarized_until__lt=cumulative_tokens - settings.CHAT_SUMMARY_THRESHOLD,
+    ).update(summary_status=Conversation.SUMMARY_PENDING)
+    if queued:
+        enqueue_summary(conversation_id)
+    return queued == 1
+
+
+def claim(conversation_id: int):
+    """要約待ちか、要約中のまま放置された会話を要約中にし、始めた日時を返す。取れなければNone"""
+    claimed_at = timezone.now()
+    claimed = Conversation.objects.filter(Q(summary_status=Conversation.SUMMARY_PENDING) | stale_running(),
+                                          id=conversation_id).update(
+        summary_status=Conversation.SUMMARY_RUNNING, summary_claimed_at=claimed_at)
+    return claimed_at if claimed == 1 else None
+
+
+def messages_to_summarize(conversation: Conversation, latest: int) -> list:
+    """要約済みより後で、直近KEEP_TOKENS分より前のメッセージを古い順に一回分返す"""
+    keep_from = latest - settings.CHAT_SUMMARY_KEEP_TOKENS
+    queryset = Message.objects.filter(conversation_id=conversation.id,
+                                      cumulative_tokens__gt=conversation.summarized_until,
+                                      cumulative_tokens__lte=keep_from)
+    queryset = queryset.filter(cumulative_tokens__lte=conversation.summarized_until + SUMMARY_INPUT_TOKENS)
+    messages = list(queryset.only('message', 'tokens', 'is_bot', 'cumulative_tokens').order_by('cumulative_tokens'))
+    if not messages:
+        # 一件で上限を超えるメッセージは、それだけで一回分にする
+        first = Message.objects.filter(conversation_id=conversation.id,
+                                       cumulative_tokens__gt=conversation.summarized_until,
+                                       cumulative_tokens__lte=keep_from).order_by('cumulative_tokens').first()
+        messages = [first] if first else []
+    return messages
+
+
+def summarize(conversation_id: int) -> bool:
+    """
+    会話の古いメッセージを要約して保存する
+    前回の要約と新しいメッセージを合わせて要約し直すので、要約は一つだけ持てばよい
+    時間がかかりすぎて他のワーカーに拾い直された場合は、その時点で止める
+    """
+    claimed_at = claim(conversation_id)
+    if claimed_at is None:
+        return False
+    # 自分が要約中にした会話だけを更新する
+    own = Conversation.objects.filter(id=conversation_id, summary_status=Conversation.SUMMARY_RUNNING,
+                                      summary_claimed_at=claimed_at)
+    conversation = own.first()
+    if conversation is None:
+        # 要約を予約してから実行するまでに会話が削除された
+        return False
+    client = OpenAIClient()
+    latest = Message.last_cumulative_tokens(conversation_id)
+    try:
+        while True:
+            messages = messages_to_summarize(conversation, latest)
+            if not messages:
+                break
+            res = client.generate_summary_response(summary_prompt_of(conversation.summary, messages),
+                                                   max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS)
+            conversation.summary = res.choices[0].message.content.strip()
+            conversation.summary_tokens = calc_token(conversation.summary)
+            conversation.summarized_until = messages[-1].cumulative_tokens
+            with transaction.atomic():
+                updated = own.update(
+                    summary=conversation.summary,
+                    summary_tokens=conversation.summary_tokens,
+                    summarized_until=conversation.summarized_until,
+                    total_tokens=F('total_tokens') + res.usage.total_tokens,
+                )
+                if not updated:
+                    return False
+                TokenUsage.record(conversation.user_id, client.model_name, summary_tokens=res.usage.total_tokens)
+    except Exception:
+        logger.exception('会話の要約に失敗しました conversation=%s', conversation_id)
+        own.update(summary_status=Conversation.SUMMARY_FAILED)
+        return False
+    own.update(summary_status=Conversation.SUMMARY_IDLE)
+    return True
+
+
+def _run_in_thread(conversation_id: int):
+    try:
+        summarize(conversation_id)
+    finally:
+        close_old_connections()
+
+
+def enqueue_summary(conversation_id: int):
+    """要約を予約する。メッセージの保存がコミットされてから実行する"""
+    mode = settings.CHAT_SUMMARY_WORKER
+    if mode == 'thread':
+        transaction.on_commit(lambda: get_executor().submit(_run_in_thread, conversation_id))
+    elif mode == 'inline':
+        transaction.on_commit(lambda: summarize(conversation_id))
+
+
+def process_pending(limit: int = 100) -> int:
+    """要約待ちの会話と、要約中のまま放置された会話を処理し、要約できた件数を返す"""
+    pending = Conversation.objects.filter(summary_status=Conversation.SUMMARY_PENDING).order_by('last_activity_at')
+    stale = Conversation.objects.filter(stale_running()).order_by('summary_claimed_at')
+    # ORでまとめると部分インデックスが使えないので、別々に読む
+    conversation_ids = list(stale.values_list('id', flat=True)[:limit])
+    conversation_ids += list(pending.values_list('id', flat=True)[:limit - len(conversation_ids)])
+    done = 0
+    for conversation_id in conversation_ids:
+        if summarize(conversation_id):
+            done += 1
+    return done
@@ -0,0 +1,118 @@
+import json
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from django.utils import timezone
+from chat.archive import archive_idle
+from chat.export import export_lines
+from chat.history import build_history
+from account.models import User
+from chat.models import ArchivedConversation, Conversation, Message
+from chat.search import search_conversation_ids
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+
+@override_settings(CHAT_ARCHIVE={'IDLE_DAYS': 30, 'CODEC': 'zlib', 'LEVEL': 6})
+class ArchiveTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.old = Conversation.objects.create(user=self.user, topic='古い会話')
+        self.recent = Conversation.objects.create(user=self.user, topic='最近の会話')
+        for conversation in (self.old, self.recent):
+            Message.objects.create(conversation=conversation, user=self.user, message='東京タワーの高さは', tokens=10)
+            Message.objects.create(conversation=conversation, user=self.user, message='333メートル', tokens=20,
+                                   is_bot=True)
+        Conversation.objects.filter(id=self.old.id).update(last_activity_at=timezone.now() - timedelta(days=40))
+        self.messages = list(Message.objects.filter(conversation=self.old).order_by('id').values_list(
+            'id', 'message', 'cumulative_tokens', 'created_at'))
+
+    def assert_restored(self):
+        self.assertEqual(list(Message.objects.filter(conversation=self.old).order_by('id').values_list(
+            'id', 'message', 'cumulative_tokens', 'created_at')), self.messages)
+        self.assertFalse(ArchivedConversation.objects.exists())
+        self.assertCountEqual(search_conversation_ids(self.user.id, 'タワー'), [self.old.id, self.recent.id])
+
+    def test_archive_idle(self):
+        """放置された会話だけが圧縮して移され、集計値は残ることをテスト"""
+        self.assertEqual(archive_idle(), 1)
+        self.assertFalse(Message.objects.filter(conversation=self.old).exists())
+        self.assertEqual(Message.objects.filter(conversation=self.recent).count(), 2)
+        archive = ArchivedConversation.objects.get(conversation=self.old)
+        self.assertEqual((archive.codec, archive.message_count), ('zlib', 2))
+        self.old.refresh_from_db()
+        self.assertTrue(self.old.archived)
+        self.assertEqual((self.old.message_count, self.old.total_tokens), (2, 30))
+        # アーカイブ中もメッセージの検索インデックスは残る
+        self.assertCountEqual(search_conversation_ids(self.user.id, 'タワー'), [self.old.id, self.recent.id])
+        self.assertEqual(archive_idle(), 0)
+
+    def test_detail_restores(self):
+        archive_idle()
+        response = self.client.get(reverse('chat:conversation_detail', kwargs={'pk': self.old.pk}))
+        self.assertEqual([m['message'] for m in response.data['messages']], ['東京タワーの高さは', '333メートル'])
+        self.assert_restored()
+        self.old.refresh_from_db()
+        self.assertFalse(self.old.archived)
+
+    def test_other_user_cannot_restore(self):
+        """他のユーザーの詳細やメッセージの追加では、アーカイブを戻さないことをテスト"""
+        archive_idle()
+        other = User.objects.create_user(email='other@example.com', password='password')
+        self.client.force_authenticate(other)
+        detail = self.client.get(reverse('chat:conversation_detail', kwargs={'pk': self.old.pk}))
+        self.assertEqual(detail.status_code, status.HTTP_404_NOT_FOUND)
+        create = self.client.post(reverse('chat:message_create', kwargs={'conversation_id': self.old.pk}),
+                                  {'message': 'こんにちは'}, format='json')
+        self.assertEqual(create.status_code, status.HTTP_404_NOT_FOUND)
+        messages = self.client.get(reverse('chat:message_list', kwargs={'conversation_id': self.old.pk}))
+        self.assertEqual(messages.data['results'], [])
+        self.assertTrue(ArchivedConversation.objects.filter(conversation=self.old).exists())
+        self.assertFalse(Message.objects.filter(conversation=self.old).exists())
+
+    def test_message_list_restores(self):
+        archive_idle()
+        response = self.client.get(reverse('chat:message_list', kwargs={'conversation_id': self.old.pk}))
+        self.assertEqual([m['message'] for m in response.data['results']], ['333メートル', '東京タワーの高さは'])
+        self.assert_restored()
+
+    def test_list_serves_archived_messages(self):
+        """会話の一覧ではアーカイブを戻さずに、展開したメッセージを返すことをテスト"""
+        archive_idle()
+        response = self.client.get(reverse('chat:conversation_list'))
+        messages = {row['id']: [m['message'] for m in row['messages']] for row in response.data['results']}
+        self.assertEqual(messages[self.old.id], ['東京タワーの高さは', '333メートル'])
+        self.assertEqual(messages[self.recent.id], ['東京タワーの高さは', '333メートル'])
+        self.assertTrue(ArchivedConversation.objects.filter(conversation=self.old).exists())
+
+    def test_delete_archived_conversation_clears_search(self):
+        """アーカイブした会話を削除すると、残していた検索インデックスも消えることをテスト"""
+        archive_idle()
+        self.old.refresh_from_db()
+        self.old.delete()
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワー'), [self.recent.id])
+
+    def test_build_history_restores(self):
+        archive_idle()
+        _, messages = build_history(self.old.id, 'next')
+        self.assertEqual([m['content'] for m in messages], ['東京タワーの高さは', '333メートル', 'next'])
+        self.assert_restored()
+
+    def test_export_includes_archived(self):
+        archive_idle()
+        rows = [json.loads(line) for line in ''.join(export_lines(self.user.id)).splitlines()]
+        self.assertEqual([len(row['messages']) for row in rows], [2, 2])
+        self.assertTrue(ArchivedConversation.objects.exists())
+
+    @override_settings(CHAT_ARCHIVE={'IDLE_DAYS': 30, 'CODEC': 'zstd', 'LEVEL': 3})
+    @patch('chat.archive.zstandard', None)
+    def test_zstd_falls_back_to_zlib(self):
+        """zstandardが入っていなければzlibで圧縮することをテスト"""
+        out = StringIO()
+        call_command('archive_conversations', stdout=out)
+        self.assertIn('1件の会話をアーカイブしました(zlib)', out.getvalue())
+        self.assertEqual(ArchivedConversation.objects.get().codec, 'zlib')
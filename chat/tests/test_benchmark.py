@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from chat.benchmark import SCENARIOS, percentile, run_benchmark, summarize
+from chat.models import Conversation
+from chat.tests.test_simulated_llm import NO_LATENCY
+from chat.tests.test_tokens import FakeEncodingMixin
+
+
+class PercentileTestCase(SimpleTestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50.5)
+        self.assertAlmostEqual(percentile(values, 99), 99.01)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize_in_ms(self):
+        self.assertEqual(summarize([0.1, 0.1])['p95'], 100.0)
+        self.assertIsNone(summarize([]))
+
+
+@override_settings(CHAT_LLM_BACKEND='simulated', CHAT_SIMULATED_LLM=NO_LATENCY, CHAT_TOPIC_WORKER='db',
+                   CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_SINGLE_FLIGHT_ENABLED=False, CHAT_STREAM_PERSIST=True)
+class RunBenchmarkTestCase(FakeEncodingMixin, TransactionTestCase):
+    def test_run_all_endpoints(self):
+        """全エンドポイントを計測し、結果がJSONにできる形で返ることをテスト"""
+        result = run_benchmark(list(SCENARIOS), requests=2, concurrency=1, users=1, conversations=3, messages=4,
+                               message_length=30)
+        self.assertEqual(set(result['endpoints']), set(SCENARIOS))
+        for name, stats in result['endpoints'].items():
+            self.assertEqual(stats['errors'], 0, name)
+            self.assertEqual(stats['requests'], 2)
+            self.assertGreater(stats['db_queries']['p50'], 0)
+        stream = result['endpoints']['chat_stream']
+        self.assertIsNotNone(stream['ttfb_ms'])
+        self.assertIsNotNone(stream['inter_chunk_ms'])
+        self.assertIsNone(result['endpoints']['conversation_list']['ttfb_ms'])
+        # seedの3件 + chat_streamとconversation_createで2件ずつ
+        self.assertEqual(Conversation.objects.count(), 7)
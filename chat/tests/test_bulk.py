@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from chat.bulk import ConversationData, bulk_create_conversations, import_jsonl
+from chat.models import Conversation, Message, TokenUsage
+from chat.search import search_conversation_ids
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+
+def jsonl(*records) -> str:
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def record(topic, *contents):
+    roles = ['user', 'assistant']
+    return {'topic': topic, 'messages': [{'role': roles[i % 2], 'content': c} for i, c in enumerate(contents)]}
+
+
+@override_settings(CHAT_TOPIC_WORKER='db')
+class BulkCreateTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def test_counters_match_message_save(self):
+        """累計トークン数・会話の集計・台帳がMessage.saveと同じになることをテスト"""
+        conversation, = bulk_create_conversations(self.user.id, [ConversationData([('東京タワー', False), ('はい', True)])])
+        messages = list(Message.objects.filter(conversation=conversation).order_by('id'))
+        self.assertEqual([(m.tokens, m.cumulative_tokens) for m in messages], [(13, 13), (10, 23)])
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.topic, '東京タワー')
+        self.assertEqual(conversation.topic_status, Conversation.TOPIC_PENDING)
+        self.assertEqual((conversation.message_count, conversation.total_tokens), (2, 23))
+        self.assertEqual(conversation.last_message_preview, 'はい')
+        usage = TokenUsage.objects.get(user=self.user)
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens), (13, 10))
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワー'), [conversation.id])
+        # 後から追加したメッセージも累計の続きになる
+        reply = Message.objects.create(conversation=conversation, user=self.user, message='m', tokens=9)
+        self.assertEqual(reply.cumulative_tokens, 32)
+
+    def test_create_view_is_atomic(self):
+        """会話の作成でメッセージ二件がまとめて保存され、必須項目がなければ何も保存しないことをテスト"""
+        url = reverse('chat:conversation_create')
+        with self.captureOnCommitCallbacks():
+            response = self.client.post(url, {'prompt': 'こんにちは', 'ai_res': 'どうも'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['message_count'], 2)
+        self.assertEqual(Message.objects.filter(conversation_id=response.data['id']).count(), 2)
+        response = self.client.post(url, {'prompt': 'こんにちは'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('ai_res', response.data)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    def test_import_jsonl_in_batches(self):
+        lines = jsonl(record('一', 'a', 'b'), record('二', 'c', 'd', 'e')) + 'not json\n\n' + jsonl({'messages': []})
+        result = import_jsonl(StringIO(lines), self.user.id, batch_size=2)
+        self.assertEqual((result['conversations'], result['messages'], result['skipped']), (2, 5, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [3, 5])
+        second = Conversation.objects.get(topic='二')
+        self.assertEqual(second.topic_status, Conversation.TOPIC_DONE)
+        self.assertEqual(second.total_tokens, 27)
+        self.assertEqual(TokenUsage.objects.get(user=self.user).total_tokens, 45)
+
+    def test_import_endpoint(self):
+        body = jsonl(record('一', 'a', 'b'), record(None, '質問', '答え'))
+        response = self.client.generic('POST', reverse('chat:conversation_import'), body,
+                                       content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['conversations'], 2)
+        pending = Conversation.objects.get(user=self.user, topic_status=Conversation.TOPIC_PENDING)
+        self.assertEqual(pending.topic, '質問')
+
+    def test_import_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'history.jsonl')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(jsonl(*[record(f'topic{i}', 'q', 'a') for i in range(5)]))
+            out = StringIO()
+            call_command('import_conversations', path, user=self.user.email, batch_size=3, stdout=out)
+        self.assertIn('5件の会話', out.getvalue())
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 10)
@@ -0,0 +1,75 @@
+import gzip
+import json
+from io import BytesIO
+from django.test import AsyncClient, override_settings
+from django.urls import reverse
+from chat.bulk import import_jsonl
+from chat.export import aiter_chunks, buffered, export_lines
+from chat.models import Conversation, Message
+from chat.tests.test_bulk import jsonl, record
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+from account.models import User
+
+
+@override_settings(CHAT_TOPIC_WORKER='db')
+class ExportTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        import_jsonl([jsonl(record('一', 'a', 'b')), jsonl(record('二', '質問', '答え', '続き'))], self.user.id)
+        self.empty = Conversation.objects.create(user=self.user, topic='空')
+        other = User.objects.create_user(email='other@example.com', password='password')
+        import_jsonl([jsonl(record('他人', 'x', 'y'))], other.id)
+
+    def exported(self, body: bytes) -> list:
+        return [json.loads(line) for line in body.decode('utf-8').splitlines()]
+
+    @override_settings(CHAT_EXPORT_CHUNK_SIZE=1)
+    def test_lines(self):
+        """カーソルのチャンクの境界をまたいでも、会話ごとにメッセージが順に並ぶことをテスト"""
+        rows = self.exported(b''.join(buffered(export_lines(self.user.id), size=1)))
+        self.assertEqual([row['topic'] for row in rows], ['一', '二', '空'])
+        self.assertEqual([(m['role'], m['content']) for m in rows[1]['messages']],
+                         [('user', '質問'), ('assistant', '答え'), ('user', '続き')])
+        self.assertEqual(rows[2]['messages'], [])
+
+    def test_endpoint_round_trip(self):
+        """エクスポートした内容をそのまま取り込めることをテスト"""
+        response = self.client.get(reverse('chat:conversation_export'))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join(response.streaming_content)
+        Conversation.objects.filter(user=self.user).delete()
+        result = import_jsonl(BytesIO(body), self.user.id)
+        self.assertEqual((result['conversations'], result['messages']), (3, 5))
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 5)
+
+    def test_gzip(self):
+        response = self.client.get(reverse('chat:conversation_export'), {'compress': 'gzip'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('conversations.ndjson.gz', response['Content-Disposition'])
+        rows = self.exported(gzip.decompress(b''.join(response.streaming_content)))
+        self.assertEqual(len(rows), 3)
+
+    @override_settings(CHAT_ASYNC_STREAM=True)
+    async def test_async_export(self):
+        """ASGIでは非同期のイテレーターで、チャンクを一つずつ流すことをテスト"""
+        response = await AsyncClient().get(reverse('chat:conversation_export'),
+                                           headers={'Authorization': 'Token ' + self.token.key})
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        rows = self.exported(b''.join(chunks))
+        self.assertEqual([row['topic'] for row in rows], ['一', '二', '空'])
+
+    async def test_aiter_chunks_is_lazy(self):
+        """全体を先に読まず、求められた分だけ取り出すことをテスト"""
+        pulled = []
+
+        def chunks():
+            for i in range(3):
+                pulled.append(i)
+                yield bytes([i])
+
+        iterator = aiter_chunks(chunks())
+        self.assertEqual(await iterator.__anext__(), b'\x00')
+        self.assertEqual(pulled, [0])
+        await iterator.aclose()
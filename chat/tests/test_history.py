@@ -0,0 +1,92 @@
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from django.test.utils import CaptureQueriesContext
+from account.models import User
+from chat.models import Conversation, Message
+from chat.history import build_history, MAX_HISTORY_TOKEN
+from chat.tokens import calc_token
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+
+class BuildHistoryTestCase(FakeEncodingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(email='testuser@example.com', password='password')
+        self.conversation = Conversation.objects.create(topic="Topic", user=self.user)
+
+    def test_build_history_trusts_stored_tokens(self):
+        """保存済みのtokensを使い、本文を再エンコードしないことをテスト"""
+        Message.objects.create(conversation=self.conversation, user=self.user, message='Hi', tokens=10)
+        Message.objects.create(conversation=self.conversation, user=self.user, message='Hello', tokens=13,
+                               is_bot=True)
+        num_tokens, messages = build_history(self.conversation.id, 'Bye')
+        self.assertEqual(num_tokens, 10 + 13 + calc_token('Bye'))
+        self.assertEqual(messages, [{'role': 'user', 'content': 'Hi'},
+                                    {'role': 'assistant', 'content': 'Hello'},
+                                    {'role': 'user', 'content': 'Bye'}])
+        self.assertEqual(self.encoding.encoded, ['Bye'])
+
+    def test_build_history_counts_legacy_messages(self):
+        """tokensが未保存(0)のメッセージはまとめて計算することをテスト"""
+        Message.objects.create(conversation=self.conversation, user=self.user, message='Hi')
+        num_tokens, messages = build_history(self.conversation.id, 'Bye')
+        self.assertEqual(num_tokens, calc_token('Hi') + calc_token('Bye'))
+        self.assertEqual(len(messages), 2)
+
+    def test_cumulative_tokens_on_insert(self):
+        """追加時に累計トークン数が保存されることをテスト"""
+        first = Message.objects.create(conversation=self.conversation, user=self.user, message='Hi', tokens=10)
+        second = Message.objects.create(conversation=self.conversation, user=self.user, message='Yo', tokens=12)
+        self.assertEqual(first.cumulative_tokens, 10)
+        self.assertEqual(second.cumulative_tokens, 22)
+
+    def test_cumulative_tokens_are_read_under_lock(self):
+        """会話の行をロックしてから、同じトランザクションで直前の累計を読むことをテスト"""
+        Message.objects.create(conversation=self.conversation, user=self.user, message='Hi', tokens=10)
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.create(conversation=self.conversation, user=self.user, message='Yo', tokens=12)
+        sqls = [query['sql'] for query in queries.captured_queries]
+        lock = next(i for i, sql in enumerate(sqls) if sql.startswith('UPDATE "chat_conversation"'))
+        read = next(i for i, sql in enumerate(sqls) if 'ORDER BY "chat_message"."cumulative_tokens" DESC' in sql)
+        self.assertLess(lock, read)
+        self.assertEqual(Message.objects.get(message='Yo').cumulative_tokens, 22)
+
+    def test_cumulative_tokens_ignores_given_value(self):
+        """渡された累計は使わず、直前の累計から計算し直すことをテスト"""
+        Message.objects.create(conversation=self.conversation, user=self.user, message='Hi', tokens=10)
+        message = Message.objects.create(conversation=self.conversation, user=self.user, message='Yo', tokens=13,
+                                         cumulative_tokens=999999)
+        self.assertEqual(message.cumulative_tokens, 23)
+
+    def test_build_history_uses_whole_budget(self):
+        """4件を超えても予算に収まる限り履歴に含めることをテスト"""
+        for i in range(10):
+            Message.objects.create(conversation=self.conversation, user=self.user, message=f'm{i}', tokens=100)
+        with self.assertNumQueries(1):
+            num_tokens, messages = build_history(self.conversation.id, 'Bye')
+        self.assertEqual(len(messages), 11)
+        self.assertEqual(messages[0]['content'], 'm0')
+        self.assertEqual(num_tokens, 1000 + calc_token('Bye'))
+
+    def test_build_history_stops_at_budget(self):
+        """予算を超える古いメッセージは取得しないことをテスト"""
+        for i in range(5):
+            Message.objects.create(conversation=self.conversation, user=self.user, message=f'm{i}', tokens=1000)
+        num_tokens, messages = build_history(self.conversation.id, 'Bye')
+        self.assertEqual([m['content'] for m in messages], ['m3', 'm4', 'Bye'])
+        self.assertLessEqual(num_tokens, MAX_HISTORY_TOKEN)
+
+
+class MessageCreateCumulativeTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def test_client_cannot_set_cumulative_tokens(self):
+        """MessageCreateに送られた累計トークン数は無視することをテスト"""
+        conversation = Conversation.objects.create(topic='Topic', user=self.user)
+        Message.objects.create(conversation=conversation, user=self.user, message='Hi', tokens=10)
+        url = reverse('chat:message_create', kwargs={'conversation_id': conversation.id})
+        response = self.client.post(url, {'message': 'Yo', 'cumulative_tokens': 999999}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message = Message.objects.get(message='Yo')
+        self.assertEqual(message.cumulative_tokens, 10 + message.tokens)
@@ -0,0 +1,146 @@
+import gc
+import threading
+from unittest.mock import patch
+from django.test import AsyncClient, SimpleTestCase, override_settings
+from django.urls import reverse
+from chat import metrics
+from chat.models import Conversation
+from chat.tests.test_stream import mock_client
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+
+def sample(name: str, labels: str = '') -> str:
+    """出力から一つのサンプルの値を取り出す"""
+    prefix = f'{name}{labels} '
+    for line in metrics.registry.render().splitlines():
+        if line.startswith(prefix):
+            return line[len(prefix):]
+    return None
+
+
+class HistogramTestCase(SimpleTestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['endpoint'], buckets=(0.1, 1), registry=None)
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value, 'a')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{endpoint="a",le="0.1"} 2',
+            'test_seconds_bucket{endpoint="a",le="1"} 3',
+            'test_seconds_bucket{endpoint="a",le="+Inf"} 4',
+            'test_seconds_sum{endpoint="a"} 5.65',
+            'test_seconds_count{endpoint="a"} 4',
+        ])
+
+    def test_shards_are_merged(self):
+        """スレッドごとのシャードが出力時に合計されることをテスト"""
+        counter = metrics.Counter('test_total', 'Test.', registry=None)
+        gauge = metrics.Gauge('test_active', 'Test.', registry=None)
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+            gauge.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gauge.dec(amount=4)
+        self.assertEqual(counter.collect(), {(): [4000.0]})
+        self.assertEqual(gauge.collect(), {(): [0.0]})
+
+    def test_dead_thread_shards_are_folded(self):
+        """終わったスレッドのシャードはbaseにまとめられ、値は残ることをテスト"""
+        counter = metrics.Counter('test_total', 'Test.', registry=None)
+        for _ in range(200):
+            thread = threading.Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertLessEqual(len(counter._shards), 1)
+        counter.inc()
+        self.assertEqual(counter.collect(), {(): [201.0]})
+
+    def test_label_escape(self):
+        counter = metrics.Counter('test_total', 'Test.', ['name'], registry=None)
+        counter.inc('a"b\\')
+        self.assertEqual(counter.render()[-1], 'test_total{name="a\\"b\\\\"} 1')
+
+    def test_upstream_timer(self):
+        before = metrics.UPSTREAM_TTFT.collect().get(('test-model',), [0] * 20)[-2]
+        timer = metrics.UpstreamTimer('test-model')
+        for delta in ({'role': 'assistant'}, {'content': 'a'}, {'content': 'b'}):
+            timer.delta(delta)
+        timer.finish()
+        ttft = metrics.UPSTREAM_TTFT.collect()[('test-model',)]
+        self.assertEqual(sum(ttft[:-1]) - before, 1)
+        self.assertIn(('test-model',), metrics.UPSTREAM_TOKENS_PER_SECOND.collect())
+
+
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=False)
+class MetricsEndpointTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def test_request_is_recorded(self):
+        self.user.is_staff = True
+        self.user.save()
+        labels = '{endpoint="chat:conversation_list",method="GET",status="200"}'
+        before = int(sample('chat_http_request_duration_seconds_count', labels) or 0)
+        self.client.get(reverse('chat:conversation_list'))
+        response = self.client.get(reverse('chat:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertEqual(int(sample('chat_http_request_duration_seconds_count', labels)), before + 1)
+        self.assertIsNotNone(sample('chat_db_queries_per_request_count', '{endpoint="chat:conversation_list"}'))
+        self.assertIsNotNone(sample('chat_upstream_pool_in_flight'))
+        self.assertIsNotNone(sample('chat_single_flight_leaders'))
+
+    @override_settings(CHAT_STREAM_PERSIST=True)
+    @patch('chat.views.OpenAIClient')
+    def test_stream_is_recorded(self, mock_openai):
+        """SSEの時間と開いているストリームの数、upstreamの最初の本文までの秒数をテスト"""
+        mock_client(mock_openai, 'He', 'llo')
+        labels = '{endpoint="chat:chat_stream"}'
+        before = int(sample('chat_sse_stream_duration_seconds_count', labels) or 0)
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+        content = iter(response.streaming_content)
+        next(content)
+        self.assertEqual(sample('chat_sse_active_streams', labels), '1')
+        b''.join(content)
+        response.close()
+        self.assertEqual(sample('chat_sse_active_streams', labels), '0')
+        self.assertEqual(int(sample('chat_sse_stream_duration_seconds_count', labels)), before + 1)
+        self.assertIsNotNone(sample('chat_upstream_ttft_seconds_count', '{model="gpt-3.5-turbo-0613"}'))
+        self.assertIsNotNone(sample('chat_build_history_duration_seconds_count') or
+                             sample('chat_calc_token_duration_seconds_count'))
+        self.assertTrue(Conversation.objects.exists())
+
+    @override_settings(CHAT_METRICS_TOKEN='secret')
+    def test_token(self):
+        self.client.credentials()
+        self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 403)
+        response = self.client.get(reverse('chat:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    def test_staff_only_without_token(self):
+        """トークンを設定していない場合は、スタッフ以外には見せないことをテスト"""
+        self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 403)
+        self.client.credentials()
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('chat:metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 401)
+
+    async def test_queries_in_sync_to_async_threads_are_counted(self):
+        """ASGIでsync_to_asyncのスレッドで実行したクエリも数えることをテスト"""
+        labels = '{endpoint="chat:conversation_list"}'
+        before = float(sample('chat_db_queries_per_request_sum', labels) or 0)
+        response = await AsyncClient().get(reverse('chat:conversation_list'),
+                                           headers={'Authorization': 'Token ' + self.token.key})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(float(sample('chat_db_queries_per_request_sum', labels)), before)
+
+    @override_settings(CHAT_METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 404)
@@ -0,0 +1,75 @@
+import asyncio
+from unittest.mock import patch
+import httpx
+from django.test import TestCase, override_settings
+from chat import open_ai_client
+from chat.open_ai_client import PoolStats, build_http_client, build_async_http_client, get_openai_client, \
+    get_async_openai_client
+
+
+def handler(request):
+    return httpx.Response(200, stream=httpx.ByteStream(b'data: ok\n\n'))
+
+
+class SharedClientTestCase(TestCase):
+    def setUp(self):
+        open_ai_client._client = None
+        self.addCleanup(setattr, open_ai_client, '_client', None)
+
+    @patch.dict('os.environ', {'API_KEY': 'test'})
+    def test_client_is_shared(self):
+        """同期クライアントがプロセスで一つだけ作られることをテスト"""
+        self.assertIs(get_openai_client(), get_openai_client())
+
+    @override_settings(OPENAI_HTTP={'MAX_CONNECTIONS': 7, 'MAX_KEEPALIVE_CONNECTIONS': 3, 'KEEPALIVE_EXPIRY': 30,
+                                    'HTTP2': False, 'CONNECT_TIMEOUT': 2, 'READ_TIMEOUT': 40})
+    @patch.dict('os.environ', {'API_KEY': 'test'})
+    def test_client_uses_settings(self):
+        """設定のタイムアウトが使われることをテスト"""
+        client = get_openai_client()
+        self.assertEqual(client.timeout, httpx.Timeout(40, connect=2))
+
+    @patch.dict('os.environ', {'API_KEY': 'test'})
+    def test_async_client_per_loop(self):
+        """非同期クライアントはイベントループごとに共有されることをテスト"""
+        async def pair():
+            return get_async_openai_client(), get_async_openai_client()
+
+        first, second = asyncio.run(pair())
+        other, _ = asyncio.run(pair())
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+
+class PoolStatsTestCase(TestCase):
+    def setUp(self):
+        self.stats = PoolStats()
+        patcher = patch.object(open_ai_client, 'pool_stats', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stream_is_counted_until_closed(self):
+        """レスポンスのストリームを閉じるまで使用中として数えることをテスト"""
+        client = build_http_client(transport=httpx.MockTransport(handler))
+        with client.stream('GET', 'https://example.com/') as response:
+            self.assertEqual(self.stats.in_flight, 1)
+            list(response.iter_bytes())
+        self.assertEqual(self.stats.in_flight, 0)
+        self.assertEqual(self.stats.requests, 1)
+
+    def test_async_stream_is_counted_until_closed(self):
+        async def request():
+            client = build_async_http_client(transport=httpx.MockTransport(handler))
+            async with client.stream('GET', 'https://example.com/') as response:
+                self.assertEqual(self.stats.in_flight, 1)
+                await response.aread()
+
+        asyncio.run(request())
+        self.assertEqual(self.stats.in_flight, 0)
+
+    def test_saturation(self):
+        """上限に達した状態でのリクエストを数えることをテスト"""
+        self.stats.acquire(max_connections=1)
+        self.stats.acquire(max_connections=1)
+        self.assertEqual(self.stats.saturated, 1)
+        self.assertEqual(self.stats.peak_in_flight, 2)
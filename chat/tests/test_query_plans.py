@@ -0,0 +1,103 @@
+import re
+from unittest import skipUnless
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from account.models import User
+from chat.history import build_history
+from chat.models import Conversation, Message
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+# chatのテーブルを全件走査している行、インデックスを使わずにソートしている行
+FULL_SCAN_RE = re.compile(r'\bSCAN (chat_message|chat_conversation|U\d+)\b(?! VIRTUAL TABLE)')
+TEMP_SORT_RE = re.compile(r'USE TEMP B-TREE FOR ORDER BY')
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLANの形式はSQLiteに合わせている')
+class QueryPlanTestCase(FakeEncodingMixin, LoggedInTestCase):
+    """
+    大きめのデータを入れた状態で、主要なクエリがインデックスを使うことを確認する
+    インデックスを消したり、クエリの形を変えてテーブルの全件走査に戻った場合に失敗する
+    """
+    conversations_per_user = 200
+    messages_per_conversation = 10
+
+    def setUp(self):
+        super().setUp()
+        others = [User.objects.create_user(email=f'other{i}@example.com', password='password') for i in range(3)]
+        for user in [self.user] + others:
+            conversations = Conversation.objects.bulk_create([
+                Conversation(user=user, topic=f'Topic{i}', message_count=self.messages_per_conversation)
+                for i in range(self.conversations_per_user)
+            ])
+            messages = []
+            for conversation in conversations:
+                for i in range(self.messages_per_conversation):
+                    messages.append(Message(conversation=conversation, user=user, message=f'message{i}',
+                                            tokens=100, cumulative_tokens=100 * (i + 1), is_bot=i % 2 == 1))
+            Message.objects.bulk_create(messages, batch_size=1000)
+        self.conversation = Conversation.objects.filter(user=self.user).latest('id')
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def query_plans(self, queries):
+        plans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plans.append((query['sql'], '\n'.join(row[-1] for row in cursor.fetchall())))
+        return plans
+
+    def assertIndexScans(self, queries, ordered=True):
+        for sql, plan in self.query_plans(queries):
+            if 'chat_' not in sql:
+                continue
+            self.assertIsNone(FULL_SCAN_RE.search(plan), f'{sql}\n{plan}')
+            if ordered:
+                self.assertIsNone(TEMP_SORT_RE.search(plan), f'{sql}\n{plan}')
+
+    def test_build_history(self):
+        with CaptureQueriesContext(connection) as context:
+            build_history(self.conversation.id, 'Hello')
+        self.assertIndexScans(context.captured_queries)
+
+    def test_conversation_list(self):
+        url = reverse('chat:conversation_list')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIndexScans(context.captured_queries)
+
+    def test_conversation_list_summary(self):
+        url = reverse('chat:conversation_list')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, {'view': 'summary'}, format='json')
+        self.assertIndexScans(context.captured_queries)
+
+    def test_conversation_list_cursor(self):
+        url = reverse('chat:conversation_list')
+        response = self.client.get(url, {'pagination': 'cursor'}, format='json')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(response.data['next'], format='json')
+        self.assertIndexScans(context.captured_queries)
+
+    def test_conversation_list_search(self):
+        url = reverse('chat:conversation_list')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, {'q': 'message1'}, format='json')
+        # 検索結果はランク順に並べるのでソートは許容する
+        self.assertIndexScans(context.captured_queries, ordered=False)
+
+    def test_conversation_detail(self):
+        url = reverse('chat:conversation_detail', kwargs={'pk': self.conversation.pk})
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, format='json')
+        self.assertIndexScans(context.captured_queries)
+
+    def test_message_list(self):
+        url = reverse('chat:message_list', kwargs={'conversation_id': self.conversation.pk})
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url, format='json')
+        self.assertIndexScans(context.captured_queries)
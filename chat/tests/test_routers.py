@@ -0,0 +1,88 @@
+import os
+import tempfile
+from unittest.mock import patch
+from django.core.management import call_command
+from django.db import connections
+from django.test import override_settings
+from django.urls import reverse
+from account.models import User
+from chat.history import build_history
+from chat.models import Conversation, Message
+from chat.routers import read_alias
+from chat.search import get_search_backend
+from chat.tests.test_stream import mock_client
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+REPLICA = 'replica_test'
+
+
+class ReplicaRoutingTestCase(FakeEncodingMixin, LoggedInTestCase):
+    """
+    レプリカの代わりに二つ目のSQLiteのファイルを使う
+    レプリカにだけある会話が返れば、その読み取りはレプリカに送られている
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+        databases = {'default': dict(connections.settings['default']),
+                     REPLICA: {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': os.path.join(cls.tmp.name, 'replica.sqlite3')}}
+        connections.settings[REPLICA] = connections.configure_settings(databases)[REPLICA]
+        call_command('migrate', database=REPLICA, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        User.objects.using(REPLICA).all().delete()
+        User.objects.using(REPLICA).create(id=self.user.id, email=self.user.email)
+        self.primary = Conversation.objects.create(user=self.user, topic='プライマリの会話')
+        self.replica = Conversation.objects.using(REPLICA).create(user_id=self.user.id, topic='レプリカの会話')
+        # Message.saveは集計をdefaultに書くので、レプリカにはbulk_createで入れて索引を作る
+        messages = Message.objects.using(REPLICA).bulk_create([
+            Message(conversation_id=self.replica.id, user_id=self.user.id, message='東京タワー', tokens=10)])
+        get_search_backend(REPLICA).index_messages(messages)
+
+    def topics(self, response):
+        return [conversation['topic'] for conversation in response.data['results']]
+
+    @override_settings(CHAT_READ_REPLICAS=[REPLICA])
+    def test_list_detail_and_search_read_replica(self):
+        response = self.client.get(reverse('chat:conversation_list'))
+        self.assertEqual(self.topics(response), ['レプリカの会話'])
+        # プライマリにもヒットするメッセージを置き、レプリカの索引で検索していることを確かめる
+        Message.objects.create(conversation=self.primary, user=self.user, message='スカイツリーとタワー', tokens=10)
+        response = self.client.get(reverse('chat:conversation_list'), {'q': 'タワー'})
+        self.assertEqual(self.topics(response), ['レプリカの会話'])
+        response = self.client.get(reverse('chat:conversation_list'), {'q': 'スカイツリー'})
+        self.assertEqual(self.topics(response), [])
+        response = self.client.get(reverse('chat:conversation_detail', kwargs={'pk': self.replica.pk}))
+        self.assertEqual(response.data['topic'], 'レプリカの会話')
+        self.assertEqual(read_alias(), 'default')
+
+    def test_without_replicas(self):
+        response = self.client.get(reverse('chat:conversation_list'))
+        self.assertEqual(self.topics(response), ['プライマリの会話'])
+
+    @override_settings(CHAT_READ_REPLICAS=[REPLICA], CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=True)
+    @patch('chat.views.OpenAIClient')
+    def test_writes_and_history_stay_on_primary(self, mock_openai):
+        """書き込みと、書き込んだ直後に読む履歴はプライマリを使うことをテスト"""
+        mock_client(mock_openai, 'ok')
+        Message.objects.create(conversation=self.primary, user=self.user, message='前の質問', tokens=10)
+        url = reverse('chat:chat_stream_with_history', kwargs={'pk': self.primary.pk})
+        response = self.client.post(url, {'prompt': 'Hi'}, format='json')
+        b''.join(response.streaming_content)
+        self.assertEqual(Message.objects.filter(conversation=self.primary).count(), 3)
+        _, messages = build_history(self.primary.id, 'next')
+        self.assertEqual([m['content'] for m in messages], ['前の質問', 'Hi', 'ok', 'next'])
+        self.assertFalse(Message.objects.using(REPLICA).filter(message='Hi').exists())
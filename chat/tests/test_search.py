@@ -0,0 +1,74 @@
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from chat.models import Conversation, Message
+from chat.search import ngram_text, search_conversation_ids, get_search_backend
+from chat.tests.test_views import LoggedInTestCase
+
+
+class NgramTestCase(TestCase):
+    def test_ngram_text(self):
+        """本文がbigramと末尾の一文字に分割されることをテスト"""
+        self.assertEqual(ngram_text('東京タワー'), '東京 京タ タワ ワー ー')
+        self.assertEqual(ngram_text('Hi, ＡＢ'), 'hi i ab b')
+
+
+class SearchIndexTestCase(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tokyo = Conversation.objects.create(topic="旅行の相談", user=self.user)
+        self.python = Conversation.objects.create(topic="Pythonの質問", user=self.user)
+        Message.objects.create(conversation=self.tokyo, message="東京タワーの高さは？", user=self.user)
+        Message.objects.create(conversation=self.tokyo, message="333メートルです", user=self.user)
+        Message.objects.create(conversation=self.python, message="リスト内包表記とは", user=self.user)
+
+    def test_index_is_available(self):
+        self.assertIsNotNone(get_search_backend())
+
+    def test_search_japanese(self):
+        """日本語の部分一致でヒットすることをテスト"""
+        self.assertEqual(search_conversation_ids(self.user.id, '東京'), [self.tokyo.id])
+        self.assertEqual(search_conversation_ids(self.user.id, '内包'), [self.python.id])
+        self.assertEqual(search_conversation_ids(self.user.id, '京都'), [])
+
+    def test_search_all_words_across_messages(self):
+        """キーワードが別々のメッセージに含まれていてもヒットすることをテスト"""
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワー メートル'), [self.tokyo.id])
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワー 内包'), [])
+
+    def test_search_topic(self):
+        """topicに含まれるキーワードでヒットすることをテスト"""
+        self.assertEqual(search_conversation_ids(self.user.id, 'python'), [self.python.id])
+        self.assertEqual(search_conversation_ids(self.user.id, '旅'), [self.tokyo.id])
+
+    def test_index_follows_writes(self):
+        """更新・削除がインデックスに反映されることをテスト"""
+        self.python.topic = 'Djangoの質問'
+        self.python.save()
+        self.assertEqual(search_conversation_ids(self.user.id, 'python'), [])
+        self.tokyo.delete()
+        self.assertEqual(search_conversation_ids(self.user.id, '東京'), [])
+
+    def test_search_is_scoped_to_user(self):
+        """他のユーザーの会話はヒットしないことをテスト"""
+        self.assertEqual(search_conversation_ids(self.user.id + 1, '東京'), [])
+
+    def test_user_id_is_not_matched_as_text(self):
+        """インデックスしたuser_idの列は本文の検索に当たらないことをテスト"""
+        self.assertEqual(search_conversation_ids(self.user.id, str(self.user.id)), [])
+        self.assertEqual(search_conversation_ids(self.user.id, '333'), [self.tokyo.id])
+
+    def test_results_are_capped(self):
+        """ランク順の上位limit件だけを返すことをテスト"""
+        Message.objects.create(conversation=self.python, message="東京の天気", user=self.user)
+        self.assertEqual(len(search_conversation_ids(self.user.id, '東京')), 2)
+        self.assertEqual(len(search_conversation_ids(self.user.id, '東京', limit=1)), 1)
+        with self.settings(CHAT_SEARCH_MAX_RESULTS=1):
+            self.assertEqual(len(search_conversation_ids(self.user.id, '東京')), 1)
+
+    def test_list_view_uses_index(self):
+        url = reverse('chat:conversation_list')
+        response = self.client.get(url, {'q': '東京'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], self.tokyo.id)
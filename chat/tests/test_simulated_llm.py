@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import httpx
+import openai
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from chat.ai_mock import get_mock_response
+from chat.management.commands.run_mock_llm import build_server
+from chat.models import Message
+from chat.open_ai_client import OpenAIClient, get_llm_backend
+from chat.simulated_llm import SimulatedBackend, SimulatedTiming, split_tokens
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+
+MESSAGES = [{'role': 'user', 'content': 'Hi'}]
+NO_LATENCY = {'TTFT': 0, 'TOKENS_PER_SECOND': 0, 'JITTER': 0, 'ERROR_RATE': 0, 'SEED': 1}
+
+
+def contents_of(chunks) -> str:
+    return ''.join(chunk.choices[0].delta.content or '' for chunk in chunks)
+
+
+class SimulatedBackendTestCase(SimpleTestCase):
+    def completions(self, **options):
+        timing = SimulatedTiming(**{'ttft': 0, 'tokens_per_second': 0, 'jitter': 0, **options})
+        return SimulatedBackend(timing).client().chat.completions
+
+    def test_stream_mock_response(self):
+        """ai_mockの本文がチャンクに分かれて流れることをテスト"""
+        chunks = list(self.completions().create(model='m', messages=MESSAGES, stream=True))
+        self.assertEqual(chunks[0].choices[0].delta.role, 'assistant')
+        self.assertEqual(chunks[-1].choices[0].finish_reason, 'stop')
+        self.assertEqual(contents_of(chunks), get_mock_response())
+
+    def test_max_tokens(self):
+        """max_tokensで打ち切られることをテスト"""
+        res = self.completions().create(model='m', messages=MESSAGES, max_tokens=5)
+        self.assertEqual(res.choices[0].message.content, ''.join(split_tokens(get_mock_response())[:5]))
+        self.assertEqual(res.choices[0].finish_reason, 'length')
+        self.assertEqual(res.usage.total_tokens, 5 + len(split_tokens('Hi')))
+
+    def test_error_rate(self):
+        """エラー率1ならAPIErrorになることをテスト"""
+        completions = self.completions(error_rate=1)
+        with self.assertRaises(openai.APIError):
+            list(completions.create(model='m', messages=MESSAGES, stream=True))
+        with self.assertRaises(openai.APIError):
+            completions.create(model='m', messages=MESSAGES)
+
+    def test_latency(self):
+        """最初のトークンまでとトークン間の待ち時間が設定どおりになることをテスト"""
+        timing = SimulatedTiming(ttft=1, tokens_per_second=10, jitter=0.5, seed=1)
+        delays = [timing.first_token_delay()] + [timing.token_delay() for _ in range(100)]
+        self.assertTrue(0.5 <= delays[0] <= 1.5)
+        self.assertTrue(all(0.05 <= delay <= 0.15 for delay in delays[1:]))
+
+    def test_async_stream(self):
+        async def collect():
+            completions = SimulatedBackend(SimulatedTiming(0, 0, 0)).async_client().chat.completions
+            stream = await completions.create(model='m', messages=MESSAGES, stream=True)
+            return [chunk async for chunk in stream]
+
+        self.assertEqual(contents_of(asyncio.run(collect())), get_mock_response())
+
+    @override_settings(CHAT_LLM_BACKEND='simulated', CHAT_SIMULATED_LLM=NO_LATENCY)
+    def test_openai_client_uses_backend(self):
+        """OpenAIClientがCHAT_LLM_BACKENDのバックエンドを使うことをテスト"""
+        self.assertIsInstance(get_llm_backend(), SimulatedBackend)
+        res = OpenAIClient().generate_topic_response('Hi')
+        self.assertEqual(res.choices[0].message.content, get_mock_response()[:len(res.choices[0].message.content)])
+
+    @override_settings(CHAT_LLM_BACKEND='unknown')
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            get_llm_backend()
+
+
+class MockServerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = build_server('127.0.0.1', 0, SimulatedTiming(0, 0, 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        host, port = self.server.server_address[:2]
+        self.client = openai.OpenAI(api_key='test', base_url=f'http://{host}:{port}/v1',
+                                    http_client=httpx.Client())
+
+    def test_stream(self):
+        """OpenAIのSDKでモックサーバーからストリームを受け取れることをテスト"""
+        chunks = list(self.client.chat.completions.create(model='m', messages=MESSAGES, stream=True))
+        self.assertEqual(contents_of(chunks), get_mock_response())
+
+    def test_completion(self):
+        res = self.client.chat.completions.create(model='m', messages=MESSAGES, max_tokens=3)
+        self.assertEqual(res.usage.completion_tokens, 3)
+
+
+@override_settings(CHAT_LLM_BACKEND='simulated', CHAT_SIMULATED_LLM=NO_LATENCY,
+                   CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=True)
+class SimulatedStreamViewTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def test_stream(self):
+        """シミュレーターでストリームのエンドポイントが最後まで動くことをテスト"""
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn('event: saved', body)
+        self.assertEqual(Message.objects.get(is_bot=True).message, get_mock_response())
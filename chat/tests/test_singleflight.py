@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from chat import singleflight
+
+
+class GatedStream:
+    """releaseされるまでdeltaを一つずつ止めて返すストリーム"""
+
+    def __init__(self, *contents):
+        self.contents = contents
+        self.gates = [threading.Event() for _ in contents]
+        self.started = 0
+
+    def __call__(self):
+        self.started += 1
+        for content, gate in zip(self.contents, self.gates):
+            gate.wait(5)
+            yield {'content': content}
+
+
+class SingleFlightTestCase(TestCase):
+    def setUp(self):
+        self.stats = singleflight.FlightStats()
+        patcher = patch.object(singleflight, 'stats', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_late_joiner_gets_buffered_then_live(self):
+        """後から来た購読者が受信済みのdeltaを受け取り、その後も追従することをテスト"""
+        start = GatedStream('a', 'b', 'c')
+        first = singleflight.stream('key', start)
+        start.gates[0].set()
+        self.assertEqual(next(first), {'content': 'a'})
+
+        second = singleflight.stream('key', start)
+        self.assertEqual(next(second), {'content': 'a'})
+        start.gates[1].set()
+        start.gates[2].set()
+        self.assertEqual(list(first), [{'content': 'b'}, {'content': 'c'}])
+        self.assertEqual(list(second), [{'content': 'b'}, {'content': 'c'}])
+        self.assertEqual(start.started, 1)
+        self.assertEqual(self.stats.as_dict(), {'leaders': 1, 'followers': 1, 'in_flight': 0})
+
+    def test_finished_flight_is_not_reused(self):
+        """終了したストリームは共有せず、新しく開始することをテスト"""
+        start = GatedStream('a')
+        start.gates[0].set()
+        self.assertEqual(list(singleflight.stream('key2', start)), [{'content': 'a'}])
+        # ポンプのスレッドが登録を外すまで待つ
+        for thread in threading.enumerate():
+            if thread.name == 'single-flight':
+                thread.join(5)
+        self.assertEqual(list(singleflight.stream('key2', start)), [{'content': 'a'}])
+        self.assertEqual(start.started, 2)
+
+    def test_error_is_raised_to_all_subscribers(self):
+        def start():
+            yield {'content': 'a'}
+            raise RuntimeError('upstream error')
+
+        with self.assertRaises(RuntimeError):
+            list(singleflight.stream('key3', start))
+
+    def test_async_subscribers_share_stream(self):
+        """非同期でも一つのストリームを共有することをテスト"""
+        started = []
+
+        async def deltas():
+            for content in ['a', 'b']:
+                await asyncio.sleep(0.01)
+                yield {'content': content}
+
+        async def start():
+            started.append(1)
+            return deltas()
+
+        async def collect():
+            async def read(stream):
+                return [delta async for delta in stream]
+
+            first = singleflight.astream('key', start)
+            second = singleflight.astream('key', start)
+            return await asyncio.gather(read(first), read(second))
+
+        first, second = asyncio.run(collect())
+        self.assertEqual(first, [{'content': 'a'}, {'content': 'b'}])
+        self.assertEqual(second, first)
+        self.assertEqual(len(started), 1)
+        self.assertEqual(self.stats.followers, 1)
@@ -0,0 +1,239 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.test import AsyncClient, SimpleTestCase, override_settings
+from django.urls import reverse
+from account.models import User
+from chat.models import Conversation, Message
+from chat.streaming import Coalescer, coalesce
+from chat.tests.test_views import LoggedInTestCase
+from chat.tests.test_tokens import FakeEncodingMixin
+
+
+def make_chunks(*contents):
+    """OpenAIのストリームチャンクを模したオブジェクトを返す"""
+    return [SimpleNamespace(choices=[SimpleNamespace(delta={'role': None, 'content': c})]) for c in contents]
+
+
+class AsyncChunks:
+    """非同期ストリームのモック"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+
+def mock_client(mock_openai, *contents):
+    """OpenAIClientのモックにストリームのチャンクを設定する"""
+    client = mock_openai.return_value
+    client.model_name = 'gpt-3.5-turbo-0613'
+    client.base_system_order = 'マークダウン形式で返してください'
+    client.generate_stream_response.return_value = iter(make_chunks(*contents))
+    return client
+
+
+def fake_calc_token(s: str):
+    return 8 + len(s)
+
+
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=True)
+class ChatGPTStreamTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation = Conversation.objects.create(topic="Stream Topic", user=self.user)
+
+    @patch('chat.views.OpenAIClient')
+    def test_stream(self, mock_openai):
+        """同期モードでSSEのフレームが返り、最後に会話が保存されることをテスト"""
+        mock_client(mock_openai, 'He', 'llo')
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode()
+        conversation = Conversation.objects.get(topic='Hi', topic_status=Conversation.TOPIC_PENDING)
+        ai_message = Message.objects.get(conversation=conversation, is_bot=True)
+        self.assertEqual(ai_message.message, 'Hello')
+        self.assertEqual(ai_message.tokens, fake_calc_token('Hello'))
+        self.assertEqual(Message.objects.get(conversation=conversation, is_bot=False).tokens, fake_calc_token('Hi'))
+        self.assertEqual(body, 'data: {"role": null, "content": "He"}\n\n'
+                               'data: {"role": null, "content": "llo"}\n\n'
+                               'event: saved\n'
+                               f'data: {{"conversation": {conversation.id}, "message": {ai_message.id}, '
+                               '"topic": "Hi", "topic_status": "pending"}\n\n')
+
+    @override_settings(CHAT_STREAM_PERSIST=False)
+    @patch('chat.views.OpenAIClient')
+    def test_stream_without_persist(self, mock_openai):
+        """CHAT_STREAM_PERSISTが無効なら保存しないことをテスト"""
+        mock_client(mock_openai, 'He', 'llo')
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+        body = b''.join(response.streaming_content).decode()
+        self.assertNotIn('event: saved', body)
+        self.assertEqual(Conversation.objects.count(), 1)
+
+    @patch('chat.views.OpenAIClient')
+    def test_stream_with_history_saves_prompt(self, mock_openai):
+        """履歴付きストリームでpromptが保存されることをテスト"""
+        mock_client(mock_openai, 'ok')
+        url = reverse('chat:chat_stream_with_history', kwargs={'pk': self.conversation.pk})
+        response = self.client.post(url, {'prompt': 'Hi'}, format='json')
+        b''.join(response.streaming_content)
+        self.assertTrue(Message.objects.filter(conversation=self.conversation, message='Hi', is_bot=False).exists())
+        self.assertTrue(Message.objects.filter(conversation=self.conversation, message='ok', is_bot=True).exists())
+
+
+@override_settings(CHAT_ASYNC_STREAM=True, CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=True)
+class AsyncChatGPTStreamTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation = Conversation.objects.create(topic="Stream Topic", user=self.user)
+        self.async_client = AsyncClient()
+        self.auth_headers = {'Authorization': 'Token ' + self.token.key}
+
+    @patch('chat.views.OpenAIClient')
+    async def test_async_stream_with_history(self, mock_openai):
+        """非同期モードで履歴付きストリームが流れ、promptが保存されることをテスト"""
+        async def fake_stream(messages, max_tokens):
+            self.assertEqual(messages[-1], {'role': 'user', 'content': 'Hi'})
+            return AsyncChunks(make_chunks('He', 'llo'))
+
+        mock_client(mock_openai).agenerate_stream_response = fake_stream
+        url = reverse('chat:chat_stream_with_history', kwargs={'pk': self.conversation.pk})
+        response = await self.async_client.post(url, {'prompt': 'Hi'}, content_type='application/json',
+                                               headers=self.auth_headers)
+        body = ''.join([chunk.decode() async for chunk in response.streaming_content])
+        self.assertIn('"content": "llo"', body)
+        self.assertTrue(await Message.objects.filter(conversation=self.conversation, message='Hi').aexists())
+        ai_message = await Message.objects.aget(conversation=self.conversation, is_bot=True)
+        self.assertEqual(ai_message.message, 'Hello')
+        self.assertIn(f'"message": {ai_message.id}', body)
+
+    @patch('chat.views.OpenAIClient')
+    async def test_missing_or_other_users_conversation_is_404(self, mock_openai):
+        """存在しない会話や他のユーザーの会話は、ストリームを始める前に404を返すことをテスト"""
+        other = await sync_to_async(User.objects.create_user)(email='other@example.com', password='password')
+        others = await Conversation.objects.acreate(topic='Other', user=other)
+        for pk in (others.pk, others.pk + 1000):
+            url = reverse('chat:chat_stream_with_history', kwargs={'pk': pk})
+            response = await self.async_client.post(url, {'prompt': 'Hi'}, content_type='application/json',
+                                                   headers=self.auth_headers)
+            self.assertEqual(response.status_code, 404)
+            self.assertFalse(response.streaming)
+        self.assertFalse(await Message.objects.filter(message='Hi').aexists())
+        mock_openai.return_value.agenerate_stream_response.assert_not_called()
+
+
+class CompletionCacheTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        caches['completions'].clear()
+        self.addCleanup(caches['completions'].clear)
+
+    def stream(self, prompt):
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': prompt}, format='json')
+        return b''.join(response.streaming_content).decode()
+
+    @override_settings(CHAT_STREAM_PERSIST=False)
+    @patch('chat.views.OpenAIClient')
+    def test_cache_hit_replays_frames(self, mock_openai):
+        """同じリクエストはupstreamを呼ばずに同じフレームを返すことをテスト"""
+        client = mock_client(mock_openai, 'He', 'llo')
+        first = self.stream('Hi')
+        second = self.stream('Hi')
+        self.assertEqual(first, second)
+        self.assertEqual(client.generate_stream_response.call_count, 1)
+
+    @override_settings(CHAT_STREAM_PERSIST=False)
+    @patch('chat.views.OpenAIClient')
+    def test_different_prompt_is_not_cached(self, mock_openai):
+        client = mock_client(mock_openai, 'He', 'llo')
+        self.stream('Hi')
+        client.generate_stream_response.return_value = iter(make_chunks('Yo'))
+        self.assertIn('"Yo"', self.stream('Hey'))
+        self.assertEqual(client.generate_stream_response.call_count, 2)
+
+    @override_settings(CHAT_STREAM_PERSIST=True)
+    @patch('chat.views.OpenAIClient')
+    def test_cache_hit_is_persisted(self, mock_openai):
+        """キャッシュから返した場合も会話が保存されることをテスト"""
+        mock_client(mock_openai, 'He', 'llo')
+        self.stream('Hi')
+        body = self.stream('Hi')
+        self.assertIn('event: saved', body)
+        self.assertEqual(Message.objects.filter(message='Hello', is_bot=True).count(), 2)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CoalescerTestCase(SimpleTestCase):
+    def push_all(self, coalescer, clock, arrivals):
+        """(到着時刻, 本文)の列を流し、送り出した本文のリストを返す"""
+        sent = []
+        for at, content in arrivals:
+            clock.now = at
+            sent += [d['content'] for d in coalescer.push({'role': None, 'content': content})]
+        sent += [d['content'] for d in coalescer.flush()]
+        return sent
+
+    def test_fast_deltas_are_joined_within_window(self):
+        """窓の中で届いたdeltaがまとめられ、最初の本文はすぐ送られることをテスト"""
+        clock = FakeClock()
+        coalescer = Coalescer(0.03, 256, clock)
+        arrivals = [(i * 0.005, c) for i, c in enumerate('abcdefghij')]
+        self.assertEqual(self.push_all(coalescer, clock, arrivals), ['a', 'bcdefgh', 'ij'])
+
+    def test_max_bytes(self):
+        clock = FakeClock()
+        coalescer = Coalescer(1, 4, clock)
+        self.assertEqual(self.push_all(coalescer, clock, [(0, 'a')] + [(0, 'bb')] * 4), ['a', 'bbbb', 'bbbb'])
+
+    def test_slow_stream_is_not_held(self):
+        """到着間隔が窓より長い場合は溜めずにすぐ送ることをテスト"""
+        clock = FakeClock()
+        coalescer = Coalescer(0.03, 256, clock)
+        arrivals = [(i * 0.1, c) for i, c in enumerate('abcd')]
+        sent = []
+        for at, content in arrivals:
+            clock.now = at
+            sent.append([d['content'] for d in coalescer.push({'role': None, 'content': content})])
+        self.assertEqual(sent, [['a'], ['b'], ['c'], ['d']])
+
+    def test_non_content_delta_passes_through(self):
+        """roleなど本文以外の値を持つdeltaはまとめずに順序を保つことをテスト"""
+        deltas = [{'role': 'assistant', 'content': ''}, {'role': None, 'content': 'a'},
+                  {'role': None, 'content': 'b'}, {'role': None, 'content': 'c'}]
+        with override_settings(CHAT_SSE_COALESCE={'WINDOW_MS': 1000, 'MAX_BYTES': 256}):
+            self.assertEqual(list(coalesce(deltas)), [deltas[0], deltas[1], {'role': None, 'content': 'bc'}])
+
+    @override_settings(CHAT_SSE_COALESCE={'WINDOW_MS': 0, 'MAX_BYTES': 0})
+    def test_disabled(self):
+        deltas = [{'content': c} for c in 'abc']
+        self.assertEqual(list(coalesce(deltas)), deltas)
+
+
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=False)
+class CompactFrameTestCase(FakeEncodingMixin, LoggedInTestCase):
+    @patch('chat.views.OpenAIClient')
+    def test_compact_frames(self, mock_openai):
+        """?frames=compactで本文だけのフレームになることをテスト"""
+        client = mock_client(mock_openai)
+        client.generate_stream_response.return_value = iter(
+            [SimpleNamespace(choices=[SimpleNamespace(delta={'role': 'assistant', 'content': ''})])]
+            + make_chunks('こん', 'にちは', None))
+        url = reverse('chat:chat_stream') + '?frames=compact'
+        response = self.client.post(url, {'prompt': 'Hi'}, format='json')
+        body = b''.join(response.streaming_content).decode()
+        self.assertEqual(body, 'data: "こん"\n\ndata: "にちは"\n\n')
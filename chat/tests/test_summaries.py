@@ -0,0 +1,174 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from account.models import User
+from chat.history import abuild_history, build_history
+from chat.models import Conversation, Message, TokenUsage
+from chat.summaries import claim, maybe_enqueue_summary, process_pending, summarize
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_topics import topic_response
+from chat.tokens import calc_token
+
+
+def mock_summary_client(mock_openai, summary: str = '要約', total_tokens: int = 30):
+    client = mock_openai.return_value
+    client.model_name = 'gpt-3.5-turbo-0613'
+    client.generate_summary_response.return_value = topic_response(summary, total_tokens)
+    return client
+
+
+@override_settings(CHAT_SUMMARY_ENABLED=True, CHAT_SUMMARY_THRESHOLD=500, CHAT_SUMMARY_KEEP_TOKENS=200,
+                   CHAT_SUMMARY_WORKER='db')
+@patch('chat.summaries.OpenAIClient')
+class SummaryTestCase(FakeEncodingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(email='testuser@example.com', password='password')
+        self.conversation = Conversation.objects.create(topic='Topic', user=self.user)
+
+    def add_messages(self, n: int, tokens: int = 100):
+        return [Message.objects.create(conversation=self.conversation, user=self.user, message=f'm{i}',
+                                       tokens=tokens, is_bot=bool(i % 2)) for i in range(n)]
+
+    def test_enqueue_over_threshold(self, mock_openai):
+        """要約されていない分が閾値を超えたときだけ一度だけ予約されることをテスト"""
+        messages = self.add_messages(6)
+        self.assertFalse(maybe_enqueue_summary(self.conversation.id, messages[4].cumulative_tokens))
+        self.assertTrue(maybe_enqueue_summary(self.conversation.id, messages[5].cumulative_tokens))
+        self.assertFalse(maybe_enqueue_summary(self.conversation.id, messages[5].cumulative_tokens))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_PENDING)
+
+    @override_settings(CHAT_SUMMARY_ENABLED=False)
+    def test_disabled(self, mock_openai):
+        messages = self.add_messages(10)
+        self.assertFalse(maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens))
+
+    def test_summarize_keeps_recent_messages(self, mock_openai):
+        """直近KEEP_TOKENS分を残して要約し、使用量も記録されることをテスト"""
+        client = mock_summary_client(mock_openai)
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        self.assertTrue(summarize(self.conversation.id))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, '要約')
+        self.assertEqual(self.conversation.summary_tokens, calc_token('要約'))
+        self.assertEqual(self.conversation.summarized_until, 800)
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_IDLE)
+        prompt = client.generate_summary_response.call_args[0][0]
+        self.assertIn('[user]\nm0', prompt)
+        self.assertNotIn('m8', prompt)
+        self.assertEqual(TokenUsage.objects.get(user=self.user, model='gpt-3.5-turbo-0613').summary_tokens, 30)
+
+    def test_previous_summary_is_folded_in(self, mock_openai):
+        client = mock_summary_client(mock_openai, '二回目の要約')
+        Conversation.objects.filter(id=self.conversation.id).update(
+            summary='一回目の要約', summary_status=Conversation.SUMMARY_PENDING)
+        self.add_messages(10)
+        summarize(self.conversation.id)
+        self.assertIn('[これまでの要約]\n一回目の要約', client.generate_summary_response.call_args[0][0])
+
+    def test_long_backlog_is_summarized_in_chunks(self, mock_openai):
+        """一回の入力の上限を超える分は何回かに分けて要約することをテスト"""
+        client = mock_summary_client(mock_openai)
+        messages = self.add_messages(40, tokens=200)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        summarize(self.conversation.id)
+        self.assertEqual(client.generate_summary_response.call_count, 3)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summarized_until, 200 * 39)
+
+    def test_deleted_conversation_is_skipped(self, mock_openai):
+        """予約の後に削除された会話は、例外を出さずに飛ばすことをテスト"""
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+
+        def claim_then_delete(conversation_id):
+            claimed_at = claim(conversation_id)
+            Conversation.objects.filter(id=conversation_id).delete()
+            return claimed_at
+
+        with patch('chat.summaries.claim', side_effect=claim_then_delete):
+            self.assertEqual(process_pending(), 0)
+        mock_openai.return_value.generate_summary_response.assert_not_called()
+
+    def test_failed_summary(self, mock_openai):
+        mock_openai.return_value.generate_summary_response.side_effect = RuntimeError('upstream error')
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        with self.assertLogs('chat.summaries', 'ERROR'):
+            self.assertFalse(summarize(self.conversation.id))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_FAILED)
+        # 失敗した会話は次のメッセージで予約し直せる
+        self.assertTrue(maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens))
+
+    def test_build_history_prepends_summary(self, mock_openai):
+        """要約を先頭に置き、要約済みのメッセージは履歴に含めないことをテスト"""
+        mock_summary_client(mock_openai)
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        summarize(self.conversation.id)
+        with self.assertNumQueries(2):
+            num_tokens, history = build_history(self.conversation.id, 'Bye')
+        self.assertEqual(history[0], {'role': 'system', 'content': 'これまでの会話の要約:\n要約'})
+        self.assertEqual([m['content'] for m in history[1:]], ['m8', 'm9', 'Bye'])
+        self.assertEqual(num_tokens, calc_token('要約') + 200 + calc_token('Bye'))
+        self.assertEqual(async_to_sync(abuild_history)(self.conversation.id, 'Bye'), (num_tokens, history))
+
+    def test_process_summary_jobs_command(self, mock_openai):
+        mock_summary_client(mock_openai)
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        call_command('process_summary_jobs', stdout=StringIO())
+        self.assertEqual(Conversation.objects.get(id=self.conversation.id).summary, '要約')
+
+    @override_settings(CHAT_SUMMARY_CLAIM_TIMEOUT=60)
+    def test_stale_running_job_is_reclaimed(self, mock_openai):
+        """要約中のままタイムアウトを過ぎた会話は、次のメッセージとprocess_summary_jobsで拾い直すことをテスト"""
+        mock_summary_client(mock_openai)
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+        # ワーカーが要約中に落ちた
+        self.assertIsNotNone(claim(self.conversation.id))
+        self.assertFalse(maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens))
+        self.assertEqual(process_pending(), 0)
+
+        Conversation.objects.filter(id=self.conversation.id).update(
+            summary_claimed_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(process_pending(), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, '要約')
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_IDLE)
+
+    @override_settings(CHAT_SUMMARY_CLAIM_TIMEOUT=60)
+    def test_stale_running_job_is_requeued_by_new_message(self, mock_openai):
+        messages = self.add_messages(10)
+        Conversation.objects.filter(id=self.conversation.id).update(
+            summary_status=Conversation.SUMMARY_RUNNING, summary_claimed_at=timezone.now() - timedelta(seconds=61))
+        self.assertTrue(maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_PENDING)
+
+    @override_settings(CHAT_SUMMARY_CLAIM_TIMEOUT=60)
+    def test_result_of_reclaimed_job_is_discarded(self, mock_openai):
+        """拾い直された後に終わった遅いワーカーの要約は保存しないことをテスト"""
+        messages = self.add_messages(10)
+        maybe_enqueue_summary(self.conversation.id, messages[-1].cumulative_tokens)
+
+        def slow_worker(text, max_tokens):
+            Conversation.objects.filter(id=self.conversation.id).update(
+                summary_claimed_at=timezone.now() - timedelta(seconds=61))
+            self.assertIsNotNone(claim(self.conversation.id))
+            return topic_response('遅い要約', 30)
+
+        mock_summary_client(mock_openai).generate_summary_response.side_effect = slow_worker
+        self.assertFalse(summarize(self.conversation.id))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary, '')
+        self.assertEqual(self.conversation.summary_status, Conversation.SUMMARY_RUNNING)
+        self.assertFalse(TokenUsage.objects.filter(summary_tokens__gt=0).exists())
@@ -0,0 +1,142 @@
+import os
+import tempfile
+from unittest.mock import patch
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.settings import api_settings
+from chat.tests.test_stream import mock_client
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+from chat.throttling import LocalLimitStore, SqliteLimitStore, get_limit_store
+
+
+def rates(**kwargs):
+    return {'REST_FRAMEWORK': {**api_settings.user_settings,
+                               'DEFAULT_THROTTLE_RATES': {'stream': None, 'stream_tokens': None, **kwargs}}}
+
+
+class LimitStoreTestMixin:
+    def test_take_until_empty(self):
+        """容量分は通し、足りなくなったら溜まるまでの秒数を返すことをテスト"""
+        self.assertEqual(self.store.take('k', 2, 1, 1), 0)
+        self.assertEqual(self.store.take('k', 2, 1, 1), 0)
+        self.assertAlmostEqual(self.store.take('k', 2, 1, 1), 1, places=1)
+
+    def test_force_take_goes_negative(self):
+        self.store.take('k', 10, 1, 25, force=True)
+        self.assertAlmostEqual(self.store.take('k', 10, 1, 1), 16, places=1)
+
+    def test_slots(self):
+        """上限までスロットを確保でき、返せばまた確保できることをテスト"""
+        first = self.store.acquire('k', 2, 60)
+        self.assertIsNotNone(self.store.acquire('k', 2, 60))
+        self.assertIsNone(self.store.acquire('k', 2, 60))
+        self.store.release('k', first)
+        self.assertIsNotNone(self.store.acquire('k', 2, 60))
+
+    def test_expired_slot_is_freed(self):
+        self.store.acquire('k', 1, -1)
+        self.assertIsNotNone(self.store.acquire('k', 1, 60))
+
+
+class LocalLimitStoreTestCase(LimitStoreTestMixin, SimpleTestCase):
+    def setUp(self):
+        self.store = LocalLimitStore()
+
+
+class SqliteLimitStoreTestCase(LimitStoreTestMixin, SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = SqliteLimitStore(os.path.join(tmp.name, 'limits.sqlite3'))
+
+    def test_shared_between_instances(self):
+        """同じファイルを使う別のストア(別ワーカー)とカウンタを共有することをテスト"""
+        other = SqliteLimitStore(self.store.path)
+        self.store.acquire('k', 1, 60)
+        self.assertIsNone(other.acquire('k', 1, 60))
+
+
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=False, CHAT_STREAM_PERSIST=False)
+class StreamThrottleTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def stream(self):
+        return self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+
+    @override_settings(**rates(stream='2/min'))
+    @patch('chat.views.OpenAIClient')
+    def test_rate_limit(self, mock_openai):
+        """リクエスト数の制限を超えると429とRetry-Afterを返すことをテスト"""
+        mock_client(mock_openai, 'Hello')
+        for _ in range(2):
+            b''.join(self.stream().streaming_content)
+            mock_client(mock_openai, 'Hello')
+        response = self.stream()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), 30)
+
+    @override_settings(**rates(stream_tokens='30/min'))
+    @patch('chat.views.OpenAIClient')
+    def test_token_limit_counts_completion(self, mock_openai):
+        """AIの返事のトークン数もストリームの終了時に計上されることをテスト"""
+        mock_client(mock_openai, 'x' * 40)
+        b''.join(self.stream().streaming_content)
+        response = self.stream()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    @override_settings(CHAT_STREAM_MAX_CONCURRENT=1, **rates())
+    @patch('chat.views.OpenAIClient')
+    def test_concurrency_released_at_end(self, mock_openai):
+        """同時接続数の枠はストリームを流し終えると返されることをテスト"""
+        mock_client(mock_openai, 'Hello')
+        first = self.stream()
+        self.assertEqual(self.stream().status_code, 429)
+        b''.join(first.streaming_content)
+        mock_client(mock_openai, 'Hello')
+        self.assertEqual(self.stream().status_code, 200)
+
+    @override_settings(CHAT_STREAM_MAX_CONCURRENT=1, **rates())
+    @patch('chat.views.OpenAIClient')
+    def test_concurrency_released_on_disconnect(self, mock_openai):
+        """途中で切断された場合もスロットが返されることをテスト"""
+        mock_client(mock_openai, 'He', 'llo')
+        first = self.stream()
+        next(iter(first.streaming_content))
+        first.close()
+        self.assertEqual(get_limit_store().slots[f'stream_concurrency:{self.user.pk}'], {})
+
+    @override_settings(CHAT_STREAM_MAX_CONCURRENT=1, **rates(stream='1/min'))
+    @patch('chat.views.OpenAIClient')
+    def test_slot_released_when_other_limit_rejects(self, mock_openai):
+        """他の制限で断った場合は確保したスロットをすぐ返すことをテスト"""
+        mock_client(mock_openai, 'Hello')
+        b''.join(self.stream().streaming_content)
+        self.assertEqual(self.stream().status_code, 429)
+        self.assertEqual(get_limit_store().slots[f'stream_concurrency:{self.user.pk}'], {})
+
+    @override_settings(CHAT_STREAM_MAX_CONCURRENT=1, **rates(stream='3/min'))
+    @patch('chat.views.OpenAIClient')
+    def test_rejected_request_does_not_drain_later_buckets(self, mock_openai):
+        """同時接続数で断ったリクエストは、リクエスト数のバケットから取り出さないことをテスト"""
+        mock_client(mock_openai, 'Hello')
+        first = self.stream()
+        for _ in range(5):
+            self.assertEqual(self.stream().status_code, 429)
+        b''.join(first.streaming_content)
+        for _ in range(2):
+            mock_client(mock_openai, 'Hello')
+            response = self.stream()
+            self.assertEqual(response.status_code, 200)
+            b''.join(response.streaming_content)
+
+    @override_settings(**rates(stream='5/min', stream_tokens='20/min'))
+    @patch('chat.views.OpenAIClient')
+    def test_earlier_bucket_is_refunded(self, mock_openai):
+        """後ろの制限で断られた場合は、先に取り出したリクエスト数を戻すことをテスト"""
+        mock_client(mock_openai, 'Hello')
+        b''.join(self.stream().streaming_content)
+        # トークン数のバケットを空にする
+        get_limit_store().take(f'stream_tokens:{self.user.pk}', 20, 20 / 60, 100, force=True)
+        self.assertEqual(self.stream().status_code, 429)
+        tokens, _ = get_limit_store().buckets[f'stream:{self.user.pk}']
+        self.assertAlmostEqual(tokens, 4, delta=0.1)
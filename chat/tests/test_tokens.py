@@ -0,0 +1,74 @@
+from unittest.mock import patch
+from django.test import TestCase
+from chat import tokens
+from chat.tokens import TokenCountCache, token_count_cache, calc_token, calc_token_batch
+
+
+class FakeEncoding:
+    """
+    1文字1トークンとして数える偽のエンコーダー
+    tiktokenはBPEファイルのダウンロードが必要なためテストではこちらを使う
+    """
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return list(text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+class FakeEncodingMixin:
+    """get_encodingをFakeEncodingに差し替える"""
+
+    def setUp(self):
+        super().setUp()
+        token_count_cache.clear()
+        self.encoding = FakeEncoding()
+        patcher = patch('chat.tokens.get_encoding', return_value=self.encoding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(token_count_cache.clear)
+
+
+class EncodingRegistryTestCase(TestCase):
+    def tearDown(self):
+        tokens._encodings.clear()
+
+    @patch('chat.tokens.tiktoken.encoding_for_model')
+    def test_encoding_is_loaded_once_per_model(self, mock_encoding_for_model):
+        """エンコーダーはモデルごとに一度だけ読み込まれることをテスト"""
+        tokens._encodings.clear()
+        first = tokens.get_encoding('gpt-3.5-turbo')
+        second = tokens.get_encoding('gpt-3.5-turbo')
+        tokens.get_encoding('gpt-4')
+        self.assertIs(first, second)
+        self.assertEqual(mock_encoding_for_model.call_count, 2)
+
+
+class TokenCountCacheTestCase(FakeEncodingMixin, TestCase):
+    def test_lru_eviction(self):
+        """上限を超えると最も古いキーから捨てられることをテスト"""
+        cache = TokenCountCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+    def test_calc_token_uses_cache(self):
+        """同じ本文は一度しかエンコードしないことをテスト"""
+        self.assertEqual(calc_token('Hello'), 13)
+        self.assertEqual(calc_token('Hello'), 13)
+        self.assertEqual(self.encoding.encoded, ['Hello'])
+
+    def test_batch_encodes_only_missing(self):
+        """まとめて計算する際、キャッシュにない本文だけをエンコードすることをテスト"""
+        calc_token('Hello')
+        self.assertEqual(calc_token_batch(['Hello', 'World!', 'Hello']), [13, 14, 13])
+        self.assertEqual(self.encoding.encoded, ['Hello', 'World!'])
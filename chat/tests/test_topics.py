@@ -0,0 +1,129 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from chat.models import Conversation, Message, TokenUsage
+from chat.search import search_conversation_ids
+from chat.topics import claim, generate_topic, placeholder_topic, process_pending
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase, Response
+
+
+def mock_topic_client(mock_openai, topic: str, total_tokens: int = 10):
+    """OpenAIClientのモックにトピックの返事を設定する"""
+    client = mock_openai.return_value
+    client.model_name = 'gpt-3.5-turbo-0613'
+    client.generate_topic_response.return_value = topic_response(topic, total_tokens)
+    return client
+
+
+def topic_response(topic: str, total_tokens: int = 10):
+    return Response(**{
+        'usage': {'total_tokens': total_tokens},
+        'choices': [{'message': {'content': topic}}]
+    })
+
+
+@patch('chat.topics.OpenAIClient')
+class TopicJobTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def create_conversation(self):
+        url = reverse('chat:conversation_create')
+        return self.client.post(url, {'prompt': 'Pythonのリスト内包表記について', 'ai_res': '説明します'},
+                                format='json')
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    def test_create_does_not_wait_for_topic(self, mock_openai):
+        """作成時はupstreamを呼ばず、仮のトピックで保存することをテスト"""
+        response = self.create_conversation()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['topic'], 'Pythonのリスト内包表記について'[:20])
+        self.assertEqual(response.data['topic_status'], Conversation.TOPIC_PENDING)
+        self.assertEqual(Message.objects.filter(conversation_id=response.data['id']).count(), 2)
+        mock_openai.return_value.generate_topic_response.assert_not_called()
+
+    @override_settings(CHAT_TOPIC_WORKER='inline')
+    def test_topic_is_filled_after_commit(self, mock_openai):
+        """コミット後にトピックとトークン数が保存されることをテスト"""
+        mock_topic_client(mock_openai, '内包表記', 12)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.create_conversation()
+        conversation = Conversation.objects.get(id=response.data['id'])
+        self.assertEqual(conversation.topic, '内包表記')
+        self.assertEqual(conversation.topic_status, Conversation.TOPIC_DONE)
+        self.assertEqual(conversation.topic_tokens, 12)
+        self.assertEqual(conversation.total_tokens, sum(Message.objects.values_list('tokens', flat=True)) + 12)
+
+        detail = self.client.get(reverse('chat:conversation_detail', kwargs={'pk': conversation.id}))
+        self.assertEqual(detail.data['topic_status'], Conversation.TOPIC_DONE)
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    def test_process_topic_jobs_command(self, mock_openai):
+        """DBキューの待ちをコマンドで処理できることをテスト"""
+        mock_topic_client(mock_openai, '内包表記')
+        response = self.create_conversation()
+        call_command('process_topic_jobs', stdout=StringIO())
+        self.assertEqual(Conversation.objects.get(id=response.data['id']).topic, '内包表記')
+        # 処理済みの会話は二重に処理しない
+        self.assertFalse(generate_topic(response.data['id']))
+        self.assertEqual(mock_openai.return_value.generate_topic_response.call_count, 1)
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    def test_failed_topic(self, mock_openai):
+        mock_openai.return_value.generate_topic_response.side_effect = RuntimeError('upstream error')
+        response = self.create_conversation()
+        with self.assertLogs('chat.topics', 'ERROR'):
+            self.assertFalse(generate_topic(response.data['id']))
+        conversation = Conversation.objects.get(id=response.data['id'])
+        self.assertEqual(conversation.topic_status, Conversation.TOPIC_FAILED)
+
+    def test_placeholder_topic(self, mock_openai):
+        self.assertEqual(placeholder_topic('  \n'), '新しいチャット')
+        self.assertEqual(placeholder_topic('一行目\n二行目'), '一行目')
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    def test_generated_topic_is_searchable(self, mock_openai):
+        """生成したトピックが検索インデックスにも入ることをテスト"""
+        mock_topic_client(mock_openai, 'タワーの高さ')
+        conversation_id = self.create_conversation().data['id']
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワーの高さ'), [])
+        self.assertTrue(generate_topic(conversation_id))
+        self.assertEqual(search_conversation_ids(self.user.id, 'タワーの高さ'), [conversation_id])
+
+    @override_settings(CHAT_TOPIC_WORKER='db', CHAT_TOPIC_CLAIM_TIMEOUT=60)
+    def test_stale_running_job_is_reclaimed(self, mock_openai):
+        """処理中のままタイムアウトを過ぎた会話は、process_topic_jobsで拾い直すことをテスト"""
+        mock_topic_client(mock_openai, '内包表記')
+        conversation_id = self.create_conversation().data['id']
+        self.assertIsNotNone(claim(conversation_id))
+        # 処理中になったばかりの会話は他のワーカーが取らない
+        self.assertEqual(process_pending(), 0)
+        Conversation.objects.filter(id=conversation_id).update(
+            topic_claimed_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(process_pending(), 1)
+        conversation = Conversation.objects.get(id=conversation_id)
+        self.assertEqual(conversation.topic, '内包表記')
+        self.assertEqual(conversation.topic_status, Conversation.TOPIC_DONE)
+
+    @override_settings(CHAT_TOPIC_WORKER='db', CHAT_TOPIC_CLAIM_TIMEOUT=60)
+    def test_result_of_reclaimed_job_is_discarded(self, mock_openai):
+        """拾い直された後に終わった遅いワーカーの結果は保存しないことをテスト"""
+        conversation_id = self.create_conversation().data['id']
+
+        def slow_worker(prompt):
+            # 生成中にタイムアウトし、他のワーカーが拾い直した
+            Conversation.objects.filter(id=conversation_id).update(
+                topic_claimed_at=timezone.now() - timedelta(seconds=61))
+            self.assertIsNotNone(claim(conversation_id))
+            return topic_response('遅い', 10)
+
+        mock_openai.return_value.model_name = 'gpt-3.5-turbo-0613'
+        mock_openai.return_value.generate_topic_response.side_effect = slow_worker
+        self.assertFalse(generate_topic(conversation_id))
+        conversation = Conversation.objects.get(id=conversation_id)
+        self.assertEqual(conversation.topic_status, Conversation.TOPIC_RUNNING)
+        self.assertEqual(conversation.topic_tokens, 0)
+        self.assertFalse(TokenUsage.objects.filter(topic_tokens__gt=0).exists())
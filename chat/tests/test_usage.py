@@ -0,0 +1,101 @@
+import datetime
+from unittest.mock import patch
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from chat.models import Conversation, Message, TokenUsage
+from chat.open_ai_client import OpenAIClient
+from chat.tests.test_stream import mock_client
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_topics import topic_response
+from chat.tests.test_views import LoggedInTestCase
+from chat.tokens import CHAT_MODEL
+from chat.topics import generate_topic
+
+
+class TokenUsageTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation = Conversation.objects.create(topic='Usage', user=self.user)
+
+    def add_message(self, tokens: int, is_bot: bool = False):
+        return Message.objects.create(conversation=self.conversation, user=self.user, message='m', tokens=tokens,
+                                      is_bot=is_bot)
+
+    def test_message_write_updates_ledger(self):
+        """メッセージの保存で、その日の行に加算されることをテスト"""
+        self.add_message(10)
+        self.add_message(25, is_bot=True)
+        self.add_message(5)
+        usage = TokenUsage.objects.get(user=self.user)
+        self.assertEqual(usage.date, timezone.localdate())
+        self.assertEqual(usage.model, CHAT_MODEL)
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens, usage.total_tokens), (15, 25, 40))
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    @patch('chat.topics.OpenAIClient')
+    def test_topic_tokens_are_recorded(self, mock_openai):
+        """トピックの生成に使ったトークンがクライアントのモデルで記録されることをテスト"""
+        mock_openai.return_value.model_name = 'gpt-topic'
+        mock_openai.return_value.generate_topic_response.return_value = topic_response('トピック', 12)
+        self.conversation.topic_status = Conversation.TOPIC_PENDING
+        self.conversation.save()
+        self.assertTrue(generate_topic(self.conversation.id))
+        usage = TokenUsage.objects.get(user=self.user, model='gpt-topic')
+        self.assertEqual((usage.topic_tokens, usage.total_tokens), (12, 12))
+
+    def test_month_total(self):
+        today = timezone.localdate()
+        last_month = today.replace(day=1) - datetime.timedelta(days=1)
+        TokenUsage.record(self.user.id, CHAT_MODEL, last_month, prompt_tokens=100)
+        TokenUsage.record(self.user.id, CHAT_MODEL, today, prompt_tokens=7)
+        TokenUsage.record(self.user.id, 'other', today, completion_tokens=3)
+        self.assertEqual(TokenUsage.month_total(self.user.id), 10)
+        self.assertEqual(TokenUsage.month_total(self.user.id, last_month), 100)
+
+    @override_settings(CHAT_MONTHLY_TOKEN_QUOTA=100)
+    def test_usage_endpoint(self):
+        """今月の使用量と残りが返ることをテスト"""
+        self.add_message(10)
+        self.add_message(20, is_bot=True)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('chat:usage'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['month'], timezone.localdate().strftime('%Y-%m'))
+        self.assertEqual(response.data['total_tokens'], 30)
+        self.assertEqual(response.data['completion_tokens'], 20)
+        self.assertEqual(response.data['remaining'], 70)
+        self.assertEqual(len(response.data['daily']), 1)
+
+    def test_usage_endpoint_other_month(self):
+        response = self.client.get(reverse('chat:usage'), {'month': '2000-01'})
+        self.assertEqual(response.data['total_tokens'], 0)
+        self.assertIsNone(response.data['quota'])
+        response = self.client.get(reverse('chat:usage'), {'month': 'bad'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(CHAT_MONTHLY_TOKEN_QUOTA=30, CHAT_COMPLETION_CACHE_ENABLED=False)
+    @patch('chat.views.OpenAIClient')
+    def test_quota_is_enforced_before_upstream(self, mock_openai):
+        """上限を超えたらupstreamを呼ばずに429を返すことをテスト"""
+        client = mock_client(mock_openai, 'Hello')
+        self.add_message(30)
+        response = self.client.post(reverse('chat:chat_stream'), {'prompt': 'Hi'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+        client.generate_stream_response.assert_not_called()
+
+    @override_settings(CHAT_TOPIC_WORKER='db')
+    @patch('chat.topics.OpenAIClient')
+    def test_messages_and_topics_share_one_row(self, mock_openai):
+        """メッセージとトピックが同じモデルの行に記録され、一日一行にまとまることをテスト"""
+        mock_openai.return_value = OpenAIClient()
+        with patch.object(OpenAIClient, 'generate_topic_response', return_value=topic_response('トピック', 12)):
+            conversation_id = self.client.post(reverse('chat:conversation_create'),
+                                               {'prompt': 'Hi', 'ai_res': 'Hello'}, format='json').data['id']
+            generate_topic(conversation_id)
+        usage = TokenUsage.objects.get(user=self.user)
+        self.assertEqual(usage.model, OpenAIClient().model_name)
+        self.assertEqual(usage.topic_tokens, 12)
+        self.assertEqual(usage.total_tokens, usage.prompt_tokens + usage.completion_tokens + 12)
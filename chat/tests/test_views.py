@@ -1,10 +1,13 @@
+from datetime import timedelta
 from unittest.mock import patch
+from django.test import override_settings
 from django.urls import reverse
 from account.models import User
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from chat.models import Conversation, Message
 from chat.serializers import ConversationSerializer, ConversationCreateSerializer, MessageCreateSerializer
+from chat.throttling import get_limit_store
 from rest_framework.authtoken.models import Token
 from pydantic import BaseModel
 from typing import List
@@ -38,6 +41,8 @@ class LoggedInTestCase(APITestCase):
         テストメソッド実行前の事前設定
         """
         password = 'password'
+        # ユーザーIDが使い回されるので、前のテストの制限のカウンタを消す
+        get_limit_store().clear()
         self.user = User.objects.create_user(email='testuser@example.com', password=password)
         self.client = APIClient()
         self.client.login(email=self.user.email, password=password)
@@ -135,12 +140,14 @@ class ConversationCreateTestCase(LoggedInTestCase):
     def setUp(self):
         super(ConversationCreateTestCase, self).setUp()
 
-    @patch('chat.views.OpenAIClient')
+    @override_settings(CHAT_TOPIC_WORKER='inline')
+    @patch('chat.topics.OpenAIClient')
     def test_create_conversation(self, mock_openai):
         """
         会話の作成をテスト
         """
         # OpenAIのレスポンスをモック化
+        mock_openai.return_value.model_name = 'gpt-3.5-turbo-0613'
         mock_openai.return_value.generate_response_single_prompt.return_value = Response(**{
             'usage': {'total_tokens': 10},
             'choices': [{'message': {'content': 'Mocked AI response'}}]
@@ -152,7 +159,8 @@ class ConversationCreateTestCase(LoggedInTestCase):
 
         url = reverse('chat:conversation_create')
         data = {'prompt': 'Test prompt'}
-        response = self.client.post(url, data, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(Conversation.objects.filter(user=self.user, topic='Mocked Topic').exists())
         self.assertTrue(
@@ -239,3 +247,108 @@ class MessageCreateTestCase(LoggedInTestCase):
         url = reverse('chat:message_create', kwargs={'conversation_id': self.conversation.id})
         response = self.client.post(url, self.valid_payload, format='json')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ConversationSummaryTestCase(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation1 = Conversation.objects.create(topic="Topic1", user=self.user)
+        self.conversation2 = Conversation.objects.create(topic="Topic2", user=self.user)
+        Message.objects.create(conversation=self.conversation2, message="Hello", tokens=10, user=self.user)
+        Message.objects.create(conversation=self.conversation1, message="Hello", tokens=10, user=self.user)
+        Message.objects.create(conversation=self.conversation1, message="x" * 200, tokens=20, user=self.user,
+                               is_bot=True)
+
+    def test_message_write_updates_summary(self):
+        """メッセージの追加で会話の集計値が更新されることをテスト"""
+        self.conversation1.refresh_from_db()
+        last = Message.objects.filter(conversation=self.conversation1).latest('id')
+        self.assertEqual(self.conversation1.message_count, 2)
+        self.assertEqual(self.conversation1.total_tokens, 30)
+        self.assertEqual(self.conversation1.last_activity_at, last.created_at)
+        self.assertEqual(self.conversation1.last_message_preview, 'x' * 100)
+
+    def test_get_summary(self):
+        """summary指定でメッセージを含めず、最終更新順に返すことをテスト"""
+        url = reverse('chat:conversation_list')
+        with self.assertNumQueries(3):
+            # 認証、件数、一覧
+            response = self.client.get(url, {'view': 'summary'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEqual([c['id'] for c in results], [self.conversation1.id, self.conversation2.id])
+        self.assertNotIn('messages', results[0])
+        self.assertEqual(results[0]['message_count'], 2)
+
+
+class CursorPaginationTestCase(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversations = [Conversation.objects.create(topic=f"Topic{i}", user=self.user) for i in range(25)]
+        # created_atが同じ会話もidで順序が決まることを確認する
+        Conversation.objects.filter(id__in=[c.id for c in self.conversations[:5]]).update(
+            created_at=self.conversations[0].created_at)
+
+    def test_walk_all_pages(self):
+        """カーソルをたどって全件を重複なく取得できることをテスト"""
+        url = reverse('chat:conversation_list')
+        params = {'pagination': 'cursor', 'view': 'summary'}
+        ids = []
+        while url:
+            response = self.client.get(url, params, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIsNone(response.data['count'])
+            ids += [c['id'] for c in response.data['results']]
+            url, params = response.data['next'], None
+        expected = Conversation.objects.filter(user=self.user).order_by('-last_activity_at', '-id')
+        self.assertEqual(ids, [c.id for c in expected])
+
+    def walk(self, params):
+        url = reverse('chat:conversation_list')
+        ids = []
+        while url:
+            response = self.client.get(url, params, format='json')
+            ids += [c['id'] for c in response.data['results']]
+            url, params = response.data['next'], None
+        return ids
+
+    def test_cursor_keeps_view_ordering(self):
+        """summaryは最終更新順、それ以外は作成日時順のまま、カーソルでたどれることをテスト"""
+        # 最後に作った会話を、最終更新では一番古くする
+        newest = self.conversations[-1]
+        Conversation.objects.filter(id=newest.id).update(
+            last_activity_at=self.conversations[0].created_at - timedelta(days=1))
+        summary = self.walk({'pagination': 'cursor', 'view': 'summary'})
+        self.assertEqual(summary[-1], newest.id)
+        self.assertEqual(summary, [c.id for c in Conversation.objects.order_by('-last_activity_at', '-id')])
+        full = self.walk({'pagination': 'cursor'})
+        self.assertEqual(full[0], newest.id)
+        self.assertEqual(full, [c.id for c in Conversation.objects.order_by('-created_at', '-id')])
+
+    def test_cursor_is_rejected_for_search(self):
+        """ランク順のキーワード検索ではカーソルページネーションを断ることをテスト"""
+        url = reverse('chat:conversation_list')
+        response = self.client.get(url, {'pagination': 'cursor', 'q': 'Topic'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_count_is_optional(self):
+        url = reverse('chat:conversation_list')
+        response = self.client.get(url, {'pagination': 'cursor', 'count': 'true'}, format='json')
+        self.assertEqual(response.data['count'], 25)
+
+    def test_invalid_cursor(self):
+        url = reverse('chat:conversation_list')
+        response = self.client.get(url, {'pagination': 'cursor', 'cursor': 'broken'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_message_list(self):
+        """メッセージも新しい順にカーソルで取得できることをテスト"""
+        conversation = self.conversations[0]
+        for i in range(12):
+            Message.objects.create(conversation=conversation, message=f"m{i}", user=self.user)
+        url = reverse('chat:message_list', kwargs={'conversation_id': conversation.id})
+        response = self.client.get(url, format='json')
+        self.assertEqual([m['message'] for m in response.data['results']], [f"m{i}" for i in range(11, 1, -1)])
+        response = self.client.get(response.data['next'], format='json')
+        self.assertEqual([m['message'] for m in response.data['results']], ['m1', 'm0'])
+        self.assertIsNone(response.data['next'])
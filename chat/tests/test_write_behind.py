@@ -0,0 +1,85 @@
+import json
+from unittest.mock import patch
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from account.models import User
+from chat import write_behind
+from chat.history import build_history
+from chat.models import Conversation, Message, TokenUsage
+from chat.tests.test_stream import mock_client
+from chat.tests.test_tokens import FakeEncodingMixin
+from chat.tests.test_views import LoggedInTestCase
+from chat.write_behind import save_message
+
+
+def write_behind_settings(**options):
+    return override_settings(CHAT_WRITE_BEHIND=dict({'ENABLED': True, 'MAX_BATCH': 100, 'FLUSH_MS': 0,
+                                                     'WAIT_TIMEOUT': 5}, **options))
+
+
+@write_behind_settings(MAX_BATCH=3)
+@override_settings(CHAT_COMPLETION_CACHE_ENABLED=False)
+class WriteBehindTestCase(FakeEncodingMixin, LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conversation = Conversation.objects.create(topic='Buffered', user=self.user)
+        self.other = Conversation.objects.create(topic='Other', user=self.user)
+
+    def test_read_your_writes(self):
+        """積んだだけのメッセージも、同じ会話の履歴を読む前に書き込まれることをテスト"""
+        save_message(self.conversation.id, self.user.id, 'q', 10, is_bot=False)
+        save_message(self.conversation.id, self.user.id, 'a', 20, is_bot=True)
+        self.assertFalse(Message.objects.exists())
+        self.assertTrue(write_behind.has_unsaved(self.conversation.id))
+        self.assertFalse(write_behind.has_unsaved(self.other.id))
+        _, messages = build_history(self.conversation.id, 'next')
+        self.assertEqual([m['content'] for m in messages], ['q', 'a', 'next'])
+        self.assertFalse(write_behind.has_unsaved(self.conversation.id))
+
+    def test_batch_matches_message_save(self):
+        """MAX_BATCH件で一度に書き込まれ、累計・会話の集計・台帳がMessage.saveと同じになることをテスト"""
+        Message.objects.create(conversation=self.conversation, user=self.user, message='first', tokens=5)
+        save_message(self.conversation.id, self.user.id, 'q', 10, is_bot=False)
+        save_message(self.other.id, self.user.id, 'x', 7, is_bot=False)
+        self.assertEqual(Message.objects.count(), 1)
+        save_message(self.conversation.id, self.user.id, 'a', 20, is_bot=True)
+        rows = list(Message.objects.filter(conversation=self.conversation).order_by('id')
+                    .values_list('message', 'cumulative_tokens'))
+        self.assertEqual(rows, [('first', 5), ('q', 15), ('a', 35)])
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.total_tokens), (3, 35))
+        self.assertEqual(self.conversation.last_message_preview, 'a')
+        usage = TokenUsage.objects.get(user=self.user)
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens), (22, 20))
+
+    @override_settings(CHAT_STREAM_PERSIST=True)
+    @patch('chat.views.OpenAIClient')
+    def test_stream_reply_waits_for_write(self, mock_openai):
+        """AIの返事は書き込まれてからsavedイベントでIDを返すことをテスト"""
+        mock_client(mock_openai, 'ok')
+        url = reverse('chat:chat_stream_with_history', kwargs={'pk': self.conversation.pk})
+        response = self.client.post(url, {'prompt': 'Hi'}, format='json')
+        body = b''.join(response.streaming_content).decode()
+        saved = json.loads(body.split('event: saved\ndata: ')[1])
+        reply = Message.objects.get(id=saved['message'])
+        self.assertEqual((reply.message, reply.is_bot), ('ok', True))
+        prompt = Message.objects.get(conversation=self.conversation, is_bot=False)
+        self.assertEqual(reply.cumulative_tokens, prompt.tokens + reply.tokens)
+
+
+class WriteBehindThreadTestCase(FakeEncodingMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(email='writer@example.com', password='password')
+        self.conversation = Conversation.objects.create(topic='Buffered', user=self.user)
+
+    @write_behind_settings(FLUSH_MS=10)
+    def test_background_flush_and_close(self):
+        """バックグラウンドのスレッドが書き込み、終了時に残りが書き込まれることをテスト"""
+        save_message(self.conversation.id, self.user.id, 'q', 10, is_bot=False)
+        reply = save_message(self.conversation.id, self.user.id, 'a', 20, is_bot=True, wait=True)
+        self.assertEqual(Message.objects.get(id=reply.id).cumulative_tokens, 30)
+        write_behind.get_buffer().flush_interval = 60
+        save_message(self.conversation.id, self.user.id, 'late', 1, is_bot=False)
+        write_behind.close_buffer()
+        self.assertTrue(Message.objects.filter(message='late', cumulative_tokens=31).exists())
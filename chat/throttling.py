@@ -0,0 +1,348 @@
+"""
+ストリームのエンドポイントのユーザーごとの制限
+リクエスト数とトークン数はトークンバケット、同時接続数はスロットで数える。
+カウンタの保存先はCHAT_LIMIT_STOREで切り替える(local: プロセス内 / sqlite: ワーカー間で共有)
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, time as dt_time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.utils import timezone
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle, SimpleRateThrottle
+from .models import TokenUsage
+from .tokens import calc_token
+
+# 同時接続数で断ったときに返すRetry-After(秒)
+CONCURRENCY_RETRY_AFTER = 1
+
+
+def refill(tokens: float, updated: float, capacity: float, rate: float, now: float) -> float:
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class LocalLimitStore:
+    """プロセス内のカウンタ。ワーカーが一つの場合やテスト用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.slots = {}
+
+    def take(self, key: str, capacity: float, rate: float, amount: float, force: bool = False) -> float:
+        """
+        バケットからamountを取り出す。足りなければ取り出さずに、溜まるまでの秒数を返す
+        forceなら足りなくても取り出す(残高は負になり、次のリクエストが待たされる)
+        """
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = refill(tokens, updated, capacity, rate, now)
+            if tokens >= amount or force:
+                self.buckets[key] = (tokens - amount, now)
+                return 0.0
+            self.buckets[key] = (tokens, now)
+            return (amount - tokens) / rate
+
+    def acquire(self, key: str, limit: int, ttl: float):
+        """空きがあればスロットを確保してIDを返す。なければNone"""
+        now = time.time()
+        with self.lock:
+            slots = {slot: expires for slot, expires in self.slots.get(key, {}).items() if expires > now}
+            self.slots[key] = slots
+            if len(slots) >= limit:
+                return None
+            slot = uuid.uuid4().hex
+            slots[slot] = now + ttl
+            return slot
+
+    def release(self, key: str, slot: str):
+        with self.lock:
+            self.slots.get(key, {}).pop(slot, None)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+            self.slots.clear()
+
+
+class SqliteLimitStore:
+    """
+    SQLiteのファイルに置くカウンタ。同じホストの複数ワーカーで共有できる
+    更新はBEGIN IMMEDIATEで書き込みロックを取ってから行う
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.local = threading.local()
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS limit_bucket '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS limit_slot '
+                               '(key TEXT NOT NULL, slot TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS limit_slot_key ON limit_slot (key, expires)')
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.connection = connection
+        return connection
+
+    def transaction(self):
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def take(self, key: str, capacity: float, rate: float, amount: float, force: bool = False) -> float:
+        now = time.time()
+        connection = self.transaction()
+        try:
+            row = connection.execute('SELECT tokens, updated FROM limit_bucket WHERE key = ?', [key]).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = refill(tokens, updated, capacity, rate, now)
+            wait = 0.0
+            if tokens >= amount or force:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO limit_bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               [key, tokens, now])
+            connection.execute('COMMIT')
+            return wait
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def acquire(self, key: str, limit: int, ttl: float):
+        now = time.time()
+        connection = self.transaction()
+        try:
+            connection.execute('DELETE FROM limit_slot WHERE key = ? AND expires <= ?', [key, now])
+            count, = connection.execute('SELECT COUNT(*) FROM limit_slot WHERE key = ?', [key]).fetchone()
+            slot = None
+            if count < limit:
+                slot = uuid.uuid4().hex
+                connection.execute('INSERT INTO limit_slot (key, slot, expires) VALUES (?, ?, ?)',
+                                   [key, slot, now + ttl])
+            connection.execute('COMMIT')
+            return slot
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def release(self, key: str, slot: str):
+        self.connect().execute('DELETE FROM limit_slot WHERE slot = ?', [slot])
+
+    def clear(self):
+        connection = self.connect()
+        connection.execute('DELETE FROM limit_bucket')
+        connection.execute('DELETE FROM limit_slot')
+
+
+LIMIT_STORES = {'local': LocalLimitStore, 'sqlite': SqliteLimitStore}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_limit_store():
+    """CHAT_LIMIT_STOREで選んだカウンタの保存先を返す"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                options = settings.CHAT_LIMIT_STORE
+                if options['BACKEND'] == 'sqlite':
+                    _store = SqliteLimitStore(options['PATH'])
+                else:
+                    _store = LIMIT_STORES[options['BACKEND']]()
+    return _store
+
+
+def reset_limit_store(*, setting, **kwargs):
+    global _store
+    if setting == 'CHAT_LIMIT_STORE':
+        _store = None
+
+
+setting_changed.connect(reset_limit_store)
+
+
+class TokenBucketThrottle(SimpleRateThrottle):
+    """
+    DEFAULT_THROTTLE_RATESのscopeのレートで補充されるトークンバケット
+    レートの回数がバケットの容量になる
+    """
+
+    def __init__(self):
+        # override_settingsでレートを変えられるよう、クラス属性ではなく毎回設定を読む
+        self.rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.wait_seconds = None
+        self.taken = 0
+
+    def get_cache_key(self, request, view):
+        return f'{self.scope}:{request.user.pk}'
+
+    def cost(self, request) -> int:
+        return 1
+
+    def allow_request(self, request, view):
+        if self.rate is None or not request.user.is_authenticated:
+            return True
+        capacity = self.num_requests
+        # 容量より大きい要求は、バケットが満タンになれば通す
+        amount = min(self.cost(request), capacity)
+        self.wait_seconds = get_limit_store().take(self.get_cache_key(request, view), capacity,
+                                                   capacity / self.duration, amount)
+        self.taken = amount if self.wait_seconds == 0 else 0
+        return self.wait_seconds == 0
+
+    def refund(self, request, view):
+        """後ろの制限で断られた場合に、取り出した分をバケットに戻す"""
+        if self.taken:
+            # 負の量を取り出すと戻る。容量を超えた分は次に取り出すときに切り捨てられる
+            get_limit_store().take(self.get_cache_key(request, view), self.num_requests,
+                                   self.num_requests / self.duration, -self.taken, force=True)
+            self.taken = 0
+
+    def wait(self):
+        return self.wait_seconds
+
+    def charge(self, user_id: int, amount: int):
+        """後から分かった消費分をバケットから差し引く"""
+        if self.rate is None:
+            return
+        get_limit_store().take(f'{self.scope}:{user_id}', self.num_requests, self.num_requests / self.duration,
+                               amount, force=True)
+
+
+class StreamRateThrottle(TokenBucketThrottle):
+    """ストリームのリクエスト数"""
+    scope = 'stream'
+
+
+class StreamTokenThrottle(TokenBucketThrottle):
+    """
+    ストリームのトークン数
+    リクエスト時にpromptのトークン数を取り出し、AIの返事の分はストリームの終了時にchargeする
+    """
+    scope = 'stream_tokens'
+
+    def cost(self, request) -> int:
+        return calc_token(request.data.get('prompt') or '')
+
+
+class StreamConcurrencyThrottle(BaseThrottle):
+    """
+    同時に開けるストリームの数
+    確保したスロットはrequest.stream_slotsに積み、StreamLimitMixinがストリームの終了時に返す。
+    プロセスが落ちて返せなかったスロットもCHAT_STREAM_SLOT_TTL秒で切れる
+    """
+
+    def allow_request(self, request, view):
+        limit = settings.CHAT_STREAM_MAX_CONCURRENT
+        if not limit or not request.user.is_authenticated:
+            return True
+        key = f'stream_concurrency:{request.user.pk}'
+        slot = get_limit_store().acquire(key, limit, settings.CHAT_STREAM_SLOT_TTL)
+        if slot is None:
+            return False
+        request.stream_slots.append((key, slot))
+        return True
+
+    def wait(self):
+        return CONCURRENCY_RETRY_AFTER
+
+
+class MonthlyQuotaThrottle(BaseThrottle):
+    """
+    月のトークン使用量の上限(CHAT_MONTHLY_TOKEN_QUOTA)。upstreamを呼ぶ前に台帳で確認する
+    超えた場合は翌月の初めまでをRetry-Afterで返す
+    """
+
+    def allow_request(self, request, view):
+        quota = settings.CHAT_MONTHLY_TOKEN_QUOTA
+        if not quota or not request.user.is_authenticated:
+            return True
+        return TokenUsage.month_total(request.user.pk) < quota
+
+    def wait(self):
+        _, next_month = TokenUsage.month_range()
+        reset_at = timezone.make_aware(datetime.combine(next_month, dt_time.min))
+        return (reset_at - timezone.now()).total_seconds()
+
+
+def release_slots(request):
+    store = get_limit_store()
+    while request.stream_slots:
+        store.release(*request.stream_slots.pop())
+
+
+def iter_releasing(content, request):
+    try:
+        yield from content
+    finally:
+        release_slots(request)
+
+
+async def aiter_releasing(content, request):
+    try:
+        async for chunk in content:
+            yield chunk
+    finally:
+        # sqliteのカウンタはファイルに書くので、イベントループを塞がないようスレッドで返す
+        await sync_to_async(release_slots)(request)
+
+
+class StreamLimitMixin:
+    """
+    ストリームのビューに制限をかける
+    同時接続数のスロットはレスポンスを最後まで流し終えた(または切断された)ときに返す
+    """
+    throttle_classes = [MonthlyQuotaThrottle, StreamConcurrencyThrottle, StreamRateThrottle, StreamTokenThrottle]
+
+    def initial(self, request, *args, **kwargs):
+        request.stream_slots = []
+        super().initial(request, *args, **kwargs)
+
+    def check_throttles(self, request):
+        """
+        DRFのcheck_throttlesは断った後も残りの制限を調べ、バケットから取り出してしまう
+        最初に断られた時点で止め、それまでに取り出した分は戻す
+        """
+        passed = []
+        for throttle in self.get_throttles():
+            if not throttle.allow_request(request, self):
+                for previous in passed:
+                    if isinstance(previous, TokenBucketThrottle):
+                        previous.refund(request, self)
+                self.throttled(request, throttle.wait())
+            passed.append(throttle)
+
+    def throttled(self, request, wait):
+        # 他の制限で断る場合は、確保済みのスロットをすぐに返す
+        release_slots(request)
+        super().throttled(request, wait)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if not getattr(request, 'stream_slots', None):
+            return response
+        if not response.streaming:
+            release_slots(request)
+        elif response.is_async:
+            response.streaming_content = aiter_releasing(response.streaming_content, request)
+        else:
+            response.streaming_content = iter_releasing(response.streaming_content, request)
+        return response
+
+    def charge_completion(self, user_id: int, ai_res: str):
+        """AIの返事のトークン数をトークン数の制限に計上する"""
+        StreamTokenThrottle().charge(user_id, calc_token(ai_res))
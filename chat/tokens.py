@@ -0,0 +1,106 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from django.conf import settings
+import tiktoken
+from .metrics import CALC_TOKEN_DURATION, timed
+
+DEFAULT_MODEL = 'gpt-3.5-turbo'
+# OpenAIClientが呼び出すモデル。使用量の台帳はメッセージもトピックも要約もこの名前で記録する
+CHAT_MODEL = 'gpt-3.5-turbo-0613'
+# メッセージ一件ごとにかかる固定のトークン数
+TOKENS_PER_MESSAGE = 8
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(model: str = DEFAULT_MODEL):
+    """
+    モデルごとのエンコーダーを返す
+    一度読み込んだエンコーダーはプロセス内で使い回す
+    """
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model)
+            if encoding is None:
+                encoding = tiktoken.encoding_for_model(model)
+                _encodings[model] = encoding
+    return encoding
+
+
+class TokenCountCache:
+    """
+    本文のハッシュをキーにしたトークン数のLRUキャッシュ
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, text: str):
+        return model, hashlib.sha1(text.encode('utf-8')).digest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value: int):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+token_count_cache = TokenCountCache(settings.CHAT_TOKEN_CACHE_SIZE)
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """本文のトークン数を返す"""
+    key = TokenCountCache.make_key(model, text)
+    count = token_count_cache.get(key)
+    if count is None:
+        count = len(get_encoding(model).encode(text))
+        token_count_cache.set(key, count)
+    return count
+
+
+def count_tokens_batch(texts: list, model: str = DEFAULT_MODEL) -> list:
+    """
+    複数の本文のトークン数をまとめて返す
+    キャッシュにないものだけをencode_batchで一度にエンコードする
+    """
+    keys = [TokenCountCache.make_key(model, text) for text in texts]
+    counts = [token_count_cache.get(key) for key in keys]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        encoded = get_encoding(model).encode_batch([texts[i] for i in missing])
+        for i, tokens in zip(missing, encoded):
+            counts[i] = len(tokens)
+            token_count_cache.set(keys[i], counts[i])
+    return counts
+
+
+@timed(CALC_TOKEN_DURATION)
+def calc_token(s: str, model: str = DEFAULT_MODEL) -> int:
+    """Token数を計算して返す"""
+    return TOKENS_PER_MESSAGE + count_tokens(s, model)
+
+
+def calc_token_batch(texts: list, model: str = DEFAULT_MODEL) -> list:
+    """calc_tokenを複数の本文にまとめて適用する"""
+    return [TOKENS_PER_MESSAGE + count for count in count_tokens_batch(texts, model)]
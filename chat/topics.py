@@ -0,0 +1,145 @@
+"""
+会話のトピック生成
+
+会話の作成時はupstreamを待たずに仮のトピックで保存し、トピックの生成はバックグラウンドで行う
+CHAT_TOPIC_WORKERで実行方法を切り替える
+- thread: プロセス内のスレッドプールで実行する
+- db: 何もしない。manage.py process_topic_jobsがtopic_status=pendingの会話を処理する
+- inline: コミット後にその場で実行する(開発・テスト用)
+どのモードでも待ちの状態はDBに残るので、プロセスが落ちてもprocess_topic_jobsで拾い直せる
+(処理中のまま落ちた会話も、CHAT_TOPIC_CLAIM_TIMEOUT秒が過ぎれば拾い直す)
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Conversation, Message, TokenUsage
+from .open_ai_client import OpenAIClient
+from .search import get_search_backend
+
+logger = logging.getLogger(__name__)
+
+# 仮のトピックに使うpromptの文字数
+PLACEHOLDER_LENGTH = 20
+
+_executor = None
+
+
+def placeholder_topic(prompt: str) -> str:
+    """トピックが生成されるまでの仮のトピック"""
+    return prompt.strip().splitlines()[0][:PLACEHOLDER_LENGTH] if prompt.strip() else '新しいチャット'
+
+
+def topic_prompt_of(prompt: str, ai_res: str):
+    return f'[prompt]\n{prompt}\n\n[ai]\n{ai_res}'
+
+
+def create_topic(client: OpenAIClient, prompt: str, ai_res: str):
+    """AIにトピックを提案してもらい、トピックと消費トークンを返す"""
+    topic_response = client.generate_topic_response(topic_prompt_of(prompt, ai_res))
+    topic = topic_response.choices[0].message.content.strip()
+    return topic, topic_response.usage.total_tokens
+
+
+def stale_before():
+    """この日時より前に処理中になった会話は、ワーカーが落ちたものとみなす"""
+    return timezone.now() - timedelta(seconds=settings.CHAT_TOPIC_CLAIM_TIMEOUT)
+
+
+def claim(conversation_id: int):
+    """
+    待ちの会話、または処理中のまま放置された会話を処理中にし、処理を始めた日時を返す
+    他のワーカーが先に取った場合はNone
+    """
+    claimed_at = timezone.now()
+    claimable = Q(topic_status=Conversation.TOPIC_PENDING) | \
+        Q(topic_status=Conversation.TOPIC_RUNNING, topic_claimed_at__lt=stale_before())
+    claimed = Conversation.objects.filter(claimable, id=conversation_id).update(
+        topic_status=Conversation.TOPIC_RUNNING, topic_claimed_at=claimed_at)
+    return claimed_at if claimed == 1 else None
+
+
+def generate_topic(conversation_id: int) -> bool:
+    """
+    会話の最初のやり取りからトピックを生成して保存する
+    トピックの生成に使ったトークンは会話のtopic_tokensとtotal_tokens、使用量の台帳に加える
+    時間がかかりすぎて他のワーカーに拾い直された場合は、結果を捨てる
+    """
+    claimed_at = claim(conversation_id)
+    if claimed_at is None:
+        return False
+    # 自分が処理中にした会話だけを更新する
+    own = Conversation.objects.filter(id=conversation_id, topic_status=Conversation.TOPIC_RUNNING,
+                                      topic_claimed_at=claimed_at)
+    messages = Message.objects.filter(conversation_id=conversation_id).order_by('created_at', 'id')
+    prompt = messages.filter(is_bot=False).values_list('message', flat=True).first() or ''
+    ai_res = messages.filter(is_bot=True).values_list('message', flat=True).first() or ''
+    client = OpenAIClient()
+    try:
+        topic, topic_token = create_topic(client, prompt, ai_res)
+    except Exception:
+        logger.exception('トピックの生成に失敗しました conversation=%s', conversation_id)
+        own.update(topic_status=Conversation.TOPIC_FAILED)
+        return False
+    topic = topic[:255]
+    with transaction.atomic():
+        user_id = own.values_list('user_id', flat=True).first()
+        if user_id is None:
+            # 生成中に会話が削除されたか、他のワーカーに拾い直された
+            return False
+        own.update(
+            topic=topic,
+            topic_status=Conversation.TOPIC_DONE,
+            topic_tokens=F('topic_tokens') + topic_token,
+            total_tokens=F('total_tokens') + topic_token,
+        )
+        # UPDATEではpost_saveが送られないので、検索インデックスのトピックもここで入れ替える
+        backend = get_search_backend()
+        if backend is not None:
+            backend.index_conversation(Conversation(id=conversation_id, user_id=user_id, topic=topic))
+        TokenUsage.record(user_id, client.model_name, topic_tokens=topic_token)
+    return True
+
+
+def _run_in_thread(conversation_id: int):
+    try:
+        generate_topic(conversation_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.CHAT_TOPIC_WORKERS, thread_name_prefix='topic')
+    return _executor
+
+
+def enqueue_topic(conversation_id: int):
+    """
+    トピックの生成を予約する
+    会話の保存がコミットされてから実行する
+    """
+    mode = settings.CHAT_TOPIC_WORKER
+    if mode == 'thread':
+        transaction.on_commit(lambda: get_executor().submit(_run_in_thread, conversation_id))
+    elif mode == 'inline':
+        transaction.on_commit(lambda: generate_topic(conversation_id))
+
+
+def process_pending(limit: int = 100) -> int:
+    """待ちの会話と、処理中のまま放置された会話を古い順に処理し、生成できた件数を返す"""
+    pending = Conversation.objects.filter(topic_status=Conversation.TOPIC_PENDING).order_by('created_at')
+    stale = Conversation.objects.filter(topic_status=Conversation.TOPIC_RUNNING,
+                                        topic_claimed_at__lt=stale_before()).order_by('topic_claimed_at')
+    # ORでまとめると部分インデックスが使えないので、別々に読む
+    conversation_ids = list(stale.values_list('id', flat=True)[:limit])
+    conversation_ids += list(pending.values_list('id', flat=True)[:limit - len(conversation_ids)])
+    done = 0
+    for conversation_id in conversation_ids:
+        if generate_topic(conversation_id):
+            done += 1
+    return done
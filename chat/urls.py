@@ -6,8 +6,13 @@ app_name = 'chat'
 urlpatterns = [
     path('conversations/', views.ConversationList.as_view(), name='conversation_list'),
     path('conversations/create/', views.ConversationCreate.as_view(), name='conversation_create'),
+    path('conversations/import/', views.ConversationImport.as_view(), name='conversation_import'),
+    path('conversations/export/', views.ConversationExport.as_view(), name='conversation_export'),
     path('conversations/<int:pk>/', views.ConversationDetail.as_view(), name='conversation_detail'),
+    path('conversations/<int:conversation_id>/messages/', views.MessageList.as_view(), name='message_list'),
     path('conversations/<int:conversation_id>/messages/create/', views.MessageCreate.as_view(), name='message_create'),
     path('stream/', views.ChatGPTStreamView.as_view(), name='chat_stream'),
-    path('conversations/<int:pk>/stream/', views.ChatGPTStreamWithHistoryView.as_view(), name='chat_stream_with_history')
+    path('conversations/<int:pk>/stream/', views.ChatGPTStreamWithHistoryView.as_view(), name='chat_stream_with_history'),
+    path('usage/', views.UsageView.as_view(), name='usage'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
@@ -1,123 +1,147 @@
-from .models import Conversation, Message
-from django.db.models import Q
+from .models import Conversation, Message, TokenUsage
+from django.db.models import Q, Case, When, IntegerField, Sum
 from rest_framework import generics, status, pagination, response
 from .serializers import ConversationSerializer, ConversationCreateSerializer, \
-    MessageCreateSerializer
+    MessageCreateSerializer, ConversationSummarySerializer, MessageSerializer, TokenUsageSerializer
 from .open_ai_client import OpenAIClient
+from .history import build_history, abuild_history
+from .tokens import calc_token
+from .search import search_conversation_ids
+from .topics import placeholder_topic, enqueue_topic
+from .summaries import maybe_enqueue_summary
+from .bulk import ConversationData, bulk_create_conversations, import_jsonl
+from .export import aiter_chunks, buffered, export_lines, gzipped
+from .write_behind import flush_conversation, save_message
 from rest_framework.response import Response
-from account.models import User
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from collections import deque
-import tiktoken
-from django.http import StreamingHttpResponse
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.utils.urls import replace_query_param
+from django.utils.dateparse import parse_date, parse_datetime
+import base64
+import hmac
 import json
+from .streaming import stream_completion, astream_completion, sse_response, wants_compact
+from .throttling import StreamLimitMixin
+from .routers import ReplicaReadMixin
+from .archive import attach_archived_messages, ensure_restored
+from . import metrics
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import PermissionDenied
 
-# 開発中にgptに投げるかどうかを制御する変数
-USE_GPT = True
 
-
-def calc_token(s: str):
-    """Token数を計算して返す"""
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens_per_message = 8
-    add_token = len(encoding.encode(s))
-    return tokens_per_message + add_token
+def save_first_turn(user_id: int, prompt: str, ai_res: str):
+    """
+    初回の会話、prompt、AIの返事を一つのトランザクションで保存する
+    トピックは仮のものを入れておき、バックグラウンドで生成する
+    """
+    with transaction.atomic():
+        conversation_instance = Conversation.objects.create(
+            user_id=user_id,
+            topic=placeholder_topic(prompt),
+            topic_status=Conversation.TOPIC_PENDING
+        )
+        Message.objects.create(
+            conversation=conversation_instance,
+            user_id=user_id,
+            message=prompt,
+            tokens=calc_token(prompt),
+            is_bot=False
+        )
+        ai_message = Message.objects.create(
+            conversation=conversation_instance,
+            user_id=user_id,
+            message=ai_res,
+            tokens=calc_token(ai_res),
+            is_bot=True
+        )
+        enqueue_topic(conversation_instance.id)
+    return {'conversation': conversation_instance.id, 'message': ai_message.id,
+            'topic': conversation_instance.topic, 'topic_status': conversation_instance.topic_status}
 
 
-def build_history(conversation_id: int, prompt: str):
+def save_reply(conversation_id: int, user_id: int, ai_res: str):
     """
-    履歴を構築する
-    とりあえず直近四回の会話履歴＋新しいprompt
+    ストリームで返したAIの返事を保存する
+    会話が長くなっていれば古いメッセージの要約を予約する
+    CHAT_WRITE_BEHINDが有効なら、他のリクエストの分とまとめて書き込まれるまで待つ
     """
-    queryset = Message.objects.filter(conversation__id=conversation_id)
-    queryset = queryset.order_by('-created_at')[:4]
-
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    # 実際は4097だが安全マージンをとって4000までとする
-    # なんかcompletion用に1024確保しないといけないっぽい
-    max_token = 4000 - 1024
-    # ユーザーが送信したメッセージを加える
-    ret = deque()
-    ret.append({'role': 'user', 'content': prompt})
-    num_tokens = calc_token(prompt)
-    for query in queryset:
-        role = 'user'
-        if query.is_bot:
-            role = 'assistant'
-        # メッセージを足してもmax_token以内なら履歴に加える
-        add_token = calc_token(query.message)
-        if num_tokens + add_token <= max_token:
-            num_tokens += add_token
-            ret.appendleft({'role': role, 'content': query.message})
-        else:
-            break
-
-    return num_tokens, list(ret)
+    ai_message = save_message(conversation_id, user_id, ai_res, calc_token(ai_res), is_bot=True, wait=True)
+    return {'conversation': conversation_id, 'message': ai_message.id}
 
 
-class ChatGPTStreamView(APIView):
+class ChatGPTStreamView(StreamLimitMixin, APIView):
     """
     初回の会話作成時に呼び出されるストリームビュー
+    CHAT_STREAM_PERSISTが有効な場合、ストリームの終了時に会話を保存し
+    savedイベントで会話IDを返す
     """
 
-    @staticmethod
-    def generate_stream_response(stream_response):
-        for chunk in stream_response:
-            chat_completion_delta = chunk.choices[0].delta
-            data = json.dumps(dict(chat_completion_delta))
-            yield f'data: {data}\n\n'
-
     def post(self, request):
         prompt = self.request.data.get('prompt')
+        user_id = self.request.user.id
         messages = [{"role": "user", "content": prompt}]
         client = OpenAIClient()
-        stream_response = client.generate_stream_response(messages)
+        compact = wants_compact(request)
 
-        r = StreamingHttpResponse(self.generate_stream_response(stream_response), content_type='text/event-stream')
-        r['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        r['Cache-Control'] = 'no-cache'  # Ensure clients don't cache the data
+        def on_complete(ai_res):
+            self.charge_completion(user_id, ai_res)
+            if settings.CHAT_STREAM_PERSIST:
+                return save_first_turn(user_id, prompt, ai_res)
 
-        return r
+        if settings.CHAT_ASYNC_STREAM:
+            # upstreamへの接続もジェネレーターの中で行い、ワーカースレッドを占有しない
+            return sse_response(astream_completion(client, messages, sync_to_async(on_complete), compact=compact))
+        return sse_response(stream_completion(client, messages, on_complete, compact=compact))
 
 
-class ChatGPTStreamWithHistoryView(APIView):
+class ChatGPTStreamWithHistoryView(StreamLimitMixin, APIView):
     """
     履歴付きのチャットストリームを提供
+    CHAT_STREAM_PERSISTが有効な場合、ストリームの終了時にAIの返事を保存する
     """
 
     @staticmethod
-    def generate_stream_response(stream_response):
-        for chunk in stream_response:
-            chat_completion_delta = chunk.choices[0].delta
-            data = json.dumps(dict(chat_completion_delta))
-            yield f'data: {data}\n\n'
+    async def agenerate_stream_response(conversation_id: int, user_id: int, prompt: str, on_complete=None,
+                                        compact: bool = False):
+        """
+        非同期モード用のストリーム
+        履歴の取得とpromptの保存も非同期ORMで行う
+        会話があることはレスポンスを返す前にpostで確かめておく
+        """
+        _, messages = await abuild_history(conversation_id, prompt)
+        await sync_to_async(save_message)(conversation_id, user_id, prompt, calc_token(prompt), is_bot=False)
+
+        async for frame in astream_completion(OpenAIClient(), messages, on_complete, compact=compact):
+            yield frame
 
     def post(self, request, *args, **kwargs):
         prompt = self.request.data.get('prompt')
         conversation_id = self.kwargs.get('pk')
-        token, messages = build_history(conversation_id, prompt)
-
-        # ここで一回promptの保存処理をする
         user_id = self.request.user.id
-        conversation_instance = Conversation.objects.get(id=conversation_id)
-        user_instance = User.objects.get(id=user_id)
-        Message.objects.create(
-            conversation=conversation_instance,
-            user=user_instance,
-            message=prompt,
-            tokens=token,
-            is_bot=False
-        )
+        compact = wants_compact(request)
+        # SSEのヘッダーを送ってからでは404を返せないので、ストリームを始める前に会話を確かめる
+        generics.get_object_or_404(Conversation.objects.only('id'), id=conversation_id, user_id=user_id)
 
-        client = OpenAIClient()
-        stream_response = client.generate_stream_response(messages)
+        def on_complete(ai_res):
+            self.charge_completion(user_id, ai_res)
+            if settings.CHAT_STREAM_PERSIST:
+                return save_reply(conversation_id, user_id, ai_res)
 
-        r = StreamingHttpResponse(self.generate_stream_response(stream_response), content_type='text/event-stream')
-        r['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        r['Cache-Control'] = 'no-cache'  # Ensure clients don't cache the data
+        if settings.CHAT_ASYNC_STREAM:
+            # write-behindで書き込みを待つ間、共有のスレッドを塞がないよう専用のスレッドで保存する
+            on_complete = sync_to_async(on_complete, thread_sensitive=not settings.CHAT_WRITE_BEHIND['ENABLED'])
+            return sse_response(self.agenerate_stream_response(conversation_id, user_id, prompt,
+                                                               on_complete, compact))
 
-        return r
+        _, messages = build_history(conversation_id, prompt)
+
+        # ここで一回promptの保存処理をする。write-behindが有効なら書き込みは待たない
+        save_message(conversation_id, user_id, prompt, calc_token(prompt), is_bot=False)
+        return sse_response(stream_completion(OpenAIClient(), messages, on_complete, compact=compact))
 
 
 class StandardResultsSetPagination(pagination.PageNumberPagination):
@@ -135,11 +159,115 @@ class StandardResultsSetPagination(pagination.PageNumberPagination):
         })
 
 
-class ConversationList(generics.ListAPIView):
+class KeysetPagination(pagination.BasePagination):
+    """
+    (created_at, id)をキーにしたカーソルページネーション
+    OFFSETを使わないので、どれだけ深いページでも一定の時間で取得できる
+    件数はCOUNT(*)が必要になるため ?count=true の場合だけ返す
+    ビューにget_keyset_orderingがあれば、ビューの並び順のフィールドをキーにする
+    """
+    page_size = 10
+    cursor_query_param = 'cursor'
+    # 降順に並べるフィールド。一つ目は日時、二つ目は一意なフィールド
+    ordering = ('created_at', 'id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.count = None
+        if request.query_params.get('count') == 'true':
+            self.count = queryset.count()
+
+        self.keys = self.get_ordering(view)
+        time_field, id_field = self.keys
+        queryset = queryset.order_by(f'-{time_field}', f'-{id_field}')
+        cursor = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+        if cursor is not None:
+            position, pk = cursor
+            queryset = queryset.filter(Q(**{f'{time_field}__lt': position}) |
+                                       Q(**{time_field: position, f'{id_field}__lt': pk}))
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.last = results[-1] if results else None
+        return results
+
+    def get_ordering(self, view) -> tuple:
+        if view is not None and hasattr(view, 'get_keyset_ordering'):
+            return view.get_keyset_ordering()
+        return self.ordering
+
+    @staticmethod
+    def decode_cursor(cursor):
+        if not cursor:
+            return None
+        try:
+            position, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            position = parse_datetime(position)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound('カーソルが不正です')
+        if position is None:
+            raise NotFound('カーソルが不正です')
+        return position, pk
+
+    def encode_cursor(self, instance):
+        time_field, id_field = self.keys
+        position = getattr(instance, time_field).isoformat()
+        payload = json.dumps([position, getattr(instance, id_field)])
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        return response.Response({
+            'next': self.get_next_link(),
+            'count': self.count,
+            'results': data,
+            'pageSize': self.page_size,
+        })
+
+
+class ConversationList(ReplicaReadMixin, generics.ListAPIView):
+    """
+    会話の一覧
+    ?view=summary を指定するとメッセージを含めず、最終更新の新しい順に集計値だけを返す
+    ?pagination=cursor を指定すると、同じ並び順(summaryなら最終更新、それ以外はcreated_atの新しい順)の
+    カーソルページネーションになる。キーワード検索はランク順なのでカーソルでは取得できない
+    """
     serializer_class = ConversationSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = StandardResultsSetPagination
 
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.request.query_params.get('pagination') == 'cursor':
+                if self.request.query_params.get('q'):
+                    raise ValidationError({'pagination': ['キーワード検索ではカーソルページネーションを使えません']})
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def is_summary(self):
+        return self.request.query_params.get('view') == 'summary'
+
+    def get_keyset_ordering(self) -> tuple:
+        """カーソルのキー。get_querysetの並び順と同じにする"""
+        if self.is_summary():
+            return 'last_activity_at', 'id'
+        return 'created_at', 'id'
+
+    def get_serializer_class(self):
+        if self.is_summary():
+            return ConversationSummarySerializer
+        return self.serializer_class
+
     def get_serializer(self, *args, **kwargs):
         """
         このビューで使用されるシリアライザーのインスタンスを返す
@@ -159,9 +287,18 @@ class ConversationList(generics.ListAPIView):
 
         return serializer_class(*args, **kwargs)
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and not self.is_summary():
+            # アーカイブされた会話は戻さずに、圧縮したメッセージを展開して返す
+            attach_archived_messages(page)
+        return page
+
     def get_queryset(self):
         user_id = self.request.user.id
-        queryset = Conversation.objects.filter(user_id=user_id).prefetch_related('messages')
+        queryset = Conversation.objects.filter(user_id=user_id)
+        if not self.is_summary():
+            queryset = queryset.prefetch_related('messages')
         # keyword検索
         keyword = self.request.query_params.get('q', None)
         """
@@ -171,79 +308,139 @@ class ConversationList(generics.ListAPIView):
         とする
         """
         if keyword:
-            # トピックの検索
-            for word in keyword.split(' '):
-                queryset = queryset.filter(Q(topic__icontains=word))
-
-            # メッセージの検索
-            conversation_ids = set()
-            first = True
-            # ※一つにまとめることもできる。
-            for word in keyword.split(' '):
-                messages = Message.objects.filter(user_id=user_id)
-                messages = messages.filter(Q(message__icontains=word))
-                # 少なくとも今のキーワードにヒットした会話ID
-                matched_conversation_ids = set(messages.values_list('conversation_id', flat=True))
-                # 初回はそのままセット
-                if first:
-                    conversation_ids = matched_conversation_ids
-                    first = False
-                else:
-                    # 2回目以降はintersectionで被ってるIDを抽出
-                    conversation_ids = conversation_ids.intersection(matched_conversation_ids)
-            conversations = Conversation.objects.filter(user_id=user_id)
-            # topicで絞りこんだqueryとorでマージするイメージ
-            queryset = queryset | conversations.filter(id__in=conversation_ids)
-
+            conversation_ids = search_conversation_ids(user_id, keyword, queryset.db)
+            if conversation_ids is not None:
+                if not conversation_ids:
+                    return queryset.none()
+                # 検索インデックスのランク順に並べる
+                ranking = Case(*[When(id=pk, then=rank) for rank, pk in enumerate(conversation_ids)],
+                               output_field=IntegerField())
+                return queryset.filter(id__in=conversation_ids).order_by(ranking)
+            queryset = self.search_with_icontains(queryset, user_id, keyword)
+
+        if self.is_summary():
+            return queryset.order_by('-last_activity_at', '-id')
         return queryset.order_by('-created_at')
 
-
-class ConversationDetail(generics.RetrieveAPIView):
+    @staticmethod
+    def search_with_icontains(queryset, user_id: int, keyword: str):
+        """検索インデックスが使えないDB向けのキーワード検索"""
+        # トピックの検索
+        for word in keyword.split(' '):
+            queryset = queryset.filter(Q(topic__icontains=word))
+
+        # メッセージの検索
+        conversation_ids = set()
+        first = True
+        # ※一つにまとめることもできる。
+        for word in keyword.split(' '):
+            messages = Message.objects.filter(user_id=user_id)
+            messages = messages.filter(Q(message__icontains=word))
+            # 少なくとも今のキーワードにヒットした会話ID
+            matched_conversation_ids = set(messages.values_list('conversation_id', flat=True))
+            # 初回はそのままセット
+            if first:
+                conversation_ids = matched_conversation_ids
+                first = False
+            else:
+                # 2回目以降はintersectionで被ってるIDを抽出
+                conversation_ids = conversation_ids.intersection(matched_conversation_ids)
+        conversations = Conversation.objects.filter(user_id=user_id)
+        # topicで絞りこんだqueryとorでマージするイメージ
+        return queryset | conversations.filter(id__in=conversation_ids)
+
+
+class ConversationDetail(ReplicaReadMixin, generics.RetrieveAPIView):
     queryset = Conversation.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = ConversationSerializer
 
+    def get_queryset(self):
+        # 戻すのは書き込みなので、自分の会話だけを対象にする
+        return Conversation.objects.filter(user_id=self.request.user.id)
+
+    def get_object(self):
+        conversation = super().get_object()
+        if conversation.archived:
+            # アーカイブされた会話はメッセージを戻し、戻したメッセージはプライマリから読む
+            ensure_restored(conversation.id, self.request.user.id)
+            conversation = Conversation.objects.using(DEFAULT_DB_ALIAS).get(pk=conversation.pk)
+        return conversation
+
+
+class MessageList(generics.ListAPIView):
+    """会話のメッセージを新しい順にカーソルページネーションで返す"""
+    serializer_class = MessageSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        conversation_id = self.kwargs.get('conversation_id')
+        # アーカイブされた会話はメッセージを戻してから読む
+        ensure_restored(conversation_id, self.request.user.id)
+        return Message.objects.filter(conversation_id=conversation_id, conversation__user_id=self.request.user.id)
+
 
 class ConversationCreate(generics.CreateAPIView):
+    """
+    会話の作成
+    トピックの生成は待たずに仮のトピックで保存し、topic_statusがdoneになるまでバックグラウンドで生成する
+    """
     queryset = Conversation.objects.all()
     serializer_class = ConversationCreateSerializer
     permission_classes = [IsAuthenticated]
 
     def create(self, request, *args, **kwargs):
-        prompt = self.request.data.get('prompt')
-        ai_res = self.request.data.get('ai_res')
-        topic_token = 0
-        client = OpenAIClient()
-        topic_prompt = f'[prompt]\n{prompt}\n\n[ai]\n{ai_res}'
-        topic_response = client.generate_topic_response(topic_prompt)
-        topic = topic_response.choices[0].message.content.strip()
-        topic_token += topic_response.usage.total_tokens
-        user_id = self.request.user.id
-        data = {'user': user_id,
-                'topic': topic}
-        serializer = ConversationCreateSerializer(data=data)
-        if serializer.is_valid():
-            conversation_instance = serializer.save()
-            user_instance = User.objects.get(id=user_id)
-            # Messageモデルにデータを保存
-            # 初回はtopicのtokenを加える
-            new_prompt = Message.objects.create(
-                conversation=conversation_instance,
-                user=user_instance,
-                message=prompt,
-                tokens=calc_token(prompt) + topic_token,
-                is_bot=False
-            )
-            # AIの返事も追加
-            new_ai_res = Message.objects.create(
-                conversation=conversation_instance,
-                user=user_instance,
-                message=ai_res,
-                tokens=calc_token(ai_res),
-                is_bot=True
-            )
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        prompt = request.data.get('prompt')
+        ai_res = request.data.get('ai_res')
+        errors = {name: ['この項目は必須です。'] for name, value in (('prompt', prompt), ('ai_res', ai_res))
+                  if not isinstance(value, str)}
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+        # 会話とメッセージ二件を一つのトランザクションでまとめて保存し、トピックの生成を予約する
+        conversation_instance, = bulk_create_conversations(
+            request.user.id, [ConversationData([(prompt, False), (ai_res, True)])])
+        serializer = ConversationCreateSerializer(conversation_instance)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ConversationImport(APIView):
+    """
+    JSONL(一行に一つの会話)の会話履歴の取り込み
+    リクエストの本文を一行ずつ読み、CHAT_IMPORT_BATCH_SIZE件のメッセージごとにまとめて保存する
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if request.stream is None:
+            raise ValidationError({'detail': '会話履歴をJSONLで送ってください'})
+        result = import_jsonl(request.stream, request.user.id)
+        return Response(result, status=status.HTTP_201_CREATED)
+
+
+class ConversationExport(APIView):
+    """
+    自分の会話とメッセージをNDJSONでダウンロードする
+    サーバー側のカーソルで読みながら流すので、件数によらずメモリは一定。?compress=gzipでgzipにする
+    CHAT_ASYNC_STREAMが有効(ASGI)なら非同期のイテレーターで流す
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        content = buffered(export_lines(request.user.id))
+        filename = 'conversations.ndjson'
+        content_type = 'application/x-ndjson'
+        if request.query_params.get('compress') == 'gzip':
+            content = gzipped(content)
+            filename += '.gz'
+            content_type = 'application/gzip'
+        if settings.CHAT_ASYNC_STREAM:
+            # ASGIでは一チャンクずつスレッドで読み、全体をメモリに載せない
+            content = aiter_chunks(content)
+        r = StreamingHttpResponse(content, content_type=content_type)
+        r['Content-Disposition'] = f'attachment; filename="{filename}"'
+        r['X-Accel-Buffering'] = 'no'
+        return r
 
 
 class MessageCreate(generics.CreateAPIView):
@@ -256,16 +453,79 @@ class MessageCreate(generics.CreateAPIView):
         data = request.data.copy()
         user_id = request.user.id
         conversation_id = kwargs.get('conversation_id')
+        # 他のユーザーの会話には書き込ませない(アーカイブも戻さない)
+        generics.get_object_or_404(Conversation.objects.only('id'), id=conversation_id, user_id=user_id)
         token = calc_token(message)
 
         # 受け取ったデータにユーザーID、会話ID、トークンを追加
         data['user'] = user_id
         data['conversation'] = conversation_id
-        data['token'] = token
+        data['tokens'] = token
         # シリアライザを使用してバリデーションと保存
         serializer = self.get_serializer(data=data)
         if serializer.is_valid():
-            serializer.save()
+            # write-behindで未保存のメッセージやアーカイブされたメッセージがあれば、
+            # 累計トークン数がずれないよう先に書き込む・戻す
+            flush_conversation(conversation_id)
+            ensure_restored(conversation_id, user_id)
+            with transaction.atomic():
+                message_instance = serializer.save()
+                maybe_enqueue_summary(conversation_id, message_instance.cumulative_tokens)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UsageView(APIView):
+    """
+    今月(?month=YYYY-MMでその月)のトークン使用量
+    台帳の一月分の行を足すだけなので、メッセージの件数によらず速い
+    """
+    permission_classes = [IsAuthenticated]
+    usage_fields = ('prompt_tokens', 'completion_tokens', 'topic_tokens', 'summary_tokens', 'total_tokens')
+
+    def get(self, request):
+        month = request.query_params.get('month')
+        day = parse_date(f'{month}-01') if month else None
+        if month and day is None:
+            raise ValidationError({'month': 'YYYY-MM形式で指定してください'})
+        start, end = TokenUsage.month_range(day)
+        rows = TokenUsage.objects.filter(user=request.user, date__gte=start, date__lt=end).order_by('date', 'model')
+        totals = rows.aggregate(**{field: Sum(field) for field in self.usage_fields})
+        data = {'month': start.strftime('%Y-%m')}
+        data.update({field: totals[field] or 0 for field in self.usage_fields})
+        quota = settings.CHAT_MONTHLY_TOKEN_QUOTA or None
+        data['quota'] = quota
+        data['remaining'] = max(quota - data['total_tokens'], 0) if quota else None
+        data['daily'] = TokenUsageSerializer(rows, many=True).data
+        return Response(data)
+
+
+class MetricsView(APIView):
+    """
+    Prometheusのテキスト形式の計測値
+    CHAT_METRICS_TOKENを設定した場合は Authorization: Bearer <token> が必要。
+    設定していない場合はスタッフのユーザーだけが見られる
+    """
+
+    def get_authenticators(self):
+        # Bearerトークンで見る場合はユーザーの認証をしない
+        if settings.CHAT_METRICS_TOKEN:
+            return []
+        return super().get_authenticators()
+
+    def get_permissions(self):
+        if settings.CHAT_METRICS_TOKEN:
+            return [AllowAny()]
+        return [IsAdminUser()]
+
+    def initial(self, request, *args, **kwargs):
+        if not settings.CHAT_METRICS_ENABLED:
+            raise NotFound()
+        super().initial(request, *args, **kwargs)
+
+    def get(self, request):
+        token = settings.CHAT_METRICS_TOKEN
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            raise PermissionDenied()
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,273 @@
+"""
+メッセージの保存の書き込み遅延(write-behind)
+
+CHAT_WRITE_BEHINDが有効な場合、ストリームのpromptとAIの返事の保存を一旦メモリに積み、
+複数のリクエストの分を一つのトランザクションでまとめてINSERTする。
+MAX_BATCH件溜まるか、最初の一件からFLUSH_MSミリ秒経つとバックグラウンドのスレッドが書き込む。
+AIの返事はsavedイベントでIDを返すので書き込みを待つ(グループコミット)が、promptは待たない。
+
+- 同じ会話の未保存のメッセージは、build_historyが読む前に書き込む(同じプロセス内でのread-your-writes)
+- プロセスの終了時(atexit)に残りを書き込む。SIGKILLなどで落ちた場合、待たなかった分は失われる
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Max
+from django.test.signals import setting_changed
+from django.utils import timezone
+from .models import Conversation, Message, PREVIEW_LENGTH, TokenUsage
+from .search import get_search_backend
+from .summaries import maybe_enqueue_summary
+from .tokens import CHAT_MODEL
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage:
+    """書き込み待ちのメッセージ。waitで保存されたMessageを受け取る"""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.error = None
+        self.done = threading.Event()
+
+    def set_result(self, error: Exception = None):
+        self.error = error
+        self.done.set()
+
+
+def apply_counters(conversation_id: int, messages: list):
+    """Message.saveが一件ごとに行う会話の集計の更新を、会話ごとに一回で行う"""
+    last = messages[-1]
+    Conversation.objects.filter(pk=conversation_id).update(
+        message_count=F('message_count') + len(messages),
+        total_tokens=F('total_tokens') + sum(message.tokens for message in messages),
+        last_activity_at=last.created_at,
+        last_message_preview=last.message[:PREVIEW_LENGTH],
+    )
+
+
+def record_usage(messages: list):
+    usage = {}
+    for message in messages:
+        key = (message.user_id, timezone.localdate(message.created_at))
+        prompt, completion = usage.get(key, (0, 0))
+        if message.is_bot:
+            completion += message.tokens
+        else:
+            prompt += message.tokens
+        usage[key] = (prompt, completion)
+    for (user_id, date), (prompt, completion) in usage.items():
+        TokenUsage.record(user_id, CHAT_MODEL, date, prompt_tokens=prompt, completion_tokens=completion)
+
+
+def write_batch(messages: list):
+    """
+    メッセージをまとめて保存する
+    累計トークン数は会話の行をロックし、会話ごとの最新の累計をGROUP BY一回で読んでから、積んだ順に足していく
+    """
+    by_conversation = {}
+    for message in messages:
+        by_conversation.setdefault(message.conversation_id, []).append(message)
+    with transaction.atomic():
+        # Message.saveと同じく、同時に追加される分と同じ累計を読まないようにする
+        Conversation.lock(*by_conversation)
+        latest = dict(Message.objects.filter(conversation_id__in=by_conversation).values('conversation_id')
+                      .annotate(latest=Max('cumulative_tokens')).values_list('conversation_id', 'latest'))
+        for conversation_id, conversation_messages in by_conversation.items():
+            cumulative = latest.get(conversation_id) or 0
+            for message in conversation_messages:
+                cumulative += message.tokens
+                message.cumulative_tokens = cumulative
+        Message.objects.bulk_create(messages)
+        for conversation_id, conversation_messages in by_conversation.items():
+            apply_counters(conversation_id, conversation_messages)
+        record_usage(messages)
+        backend = get_search_backend()
+        if backend is not None:
+            backend.index_messages(messages)
+        for conversation_id, conversation_messages in by_conversation.items():
+            maybe_enqueue_summary(conversation_id, conversation_messages[-1].cumulative_tokens)
+
+
+class MessageBuffer:
+    def __init__(self, max_batch: int, flush_ms: float):
+        self.max_batch = max_batch
+        self.flush_interval = flush_ms / 1000
+        self.lock = threading.Condition()
+        # 書き込みは一度に一つだけ。積んだ順にコミットされる
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.first_at = None
+        # 会話ごとのコミットされていないメッセージの数(書き込み中の分も含む)
+        self.unsaved = Counter()
+        self.thread = None
+        self.closed = False
+
+    def add(self, message: Message) -> PendingMessage:
+        item = PendingMessage(message)
+        with self.lock:
+            self.pending.append(item)
+            self.unsaved[message.conversation_id] += 1
+            if self.first_at is None:
+                self.first_at = time.monotonic()
+            full = len(self.pending) >= self.max_batch
+            if self.flush_interval and not self.closed:
+                self.start()
+                if full:
+                    self.lock.notify()
+        if full and not self.flush_interval:
+            self.flush()
+        return item
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.closed and not self.due():
+                    timeout = None if self.first_at is None else \
+                        self.first_at + self.flush_interval - time.monotonic()
+                    self.lock.wait(timeout)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def due(self) -> bool:
+        if self.first_at is None:
+            return False
+        return len(self.pending) >= self.max_batch or time.monotonic() - self.first_at >= self.flush_interval
+
+    def flush(self):
+        """積んであるメッセージを書き込む"""
+        with self.flush_lock:
+            with self.lock:
+                items, self.pending = self.pending, []
+                self.first_at = None
+            if not items:
+                return
+            try:
+                write_batch([item.message for item in items])
+            except Exception:
+                logger.exception('メッセージのまとめての保存に失敗しました。一件ずつ保存し直します')
+                self.write_each(items)
+            else:
+                for item in items:
+                    item.set_result()
+            finally:
+                with self.lock:
+                    for item in items:
+                        self.unsaved[item.message.conversation_id] -= 1
+                        if not self.unsaved[item.message.conversation_id]:
+                            del self.unsaved[item.message.conversation_id]
+
+    @staticmethod
+    def write_each(items: list):
+        """会話が削除されたなどで失敗した分だけを失敗にする"""
+        for item in items:
+            # ロールバックされたbulk_createで付いたIDを消す
+            item.message.pk = None
+            item.message._state.adding = True
+            try:
+                write_batch([item.message])
+            except Exception as e:
+                logger.exception('メッセージを保存できませんでした conversation=%s', item.message.conversation_id)
+                item.set_result(e)
+            else:
+                item.set_result()
+
+    def has_unsaved(self, conversation_id: int) -> bool:
+        return bool(self.unsaved.get(conversation_id))
+
+    def wait(self, item: PendingMessage, timeout: float = None) -> Message:
+        """書き込まれるまで待ってMessageを返す。バックグラウンドのスレッドがなければその場で書き込む"""
+        if self.thread is None or self.closed:
+            self.flush()
+        if not item.done.wait(timeout):
+            raise TimeoutError('メッセージの保存が終わりませんでした')
+        if item.error is not None:
+            raise item.error
+        return item.message
+
+    def close(self):
+        """スレッドを止めて残りを書き込む"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """CHAT_WRITE_BEHINDが有効ならバッファを返す。無効ならNone"""
+    global _buffer
+    options = settings.CHAT_WRITE_BEHIND
+    if not options['ENABLED']:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = MessageBuffer(options['MAX_BATCH'], options['FLUSH_MS'])
+    return _buffer
+
+
+@atexit.register
+def close_buffer():
+    global _buffer
+    if _buffer is not None:
+        _buffer.close()
+        _buffer = None
+
+
+def reset_buffer(*, setting, **kwargs):
+    if setting == 'CHAT_WRITE_BEHIND':
+        close_buffer()
+
+
+setting_changed.connect(reset_buffer)
+
+
+def save_message(conversation_id: int, user_id: int, message: str, tokens: int, is_bot: bool, wait: bool = False):
+    """
+    メッセージを保存する
+    write-behindが有効なら積むだけで、waitの場合は書き込まれるまで待つ。無効ならその場で保存する
+    """
+    buffer = get_buffer()
+    instance = Message(conversation_id=conversation_id, user_id=user_id, message=message, tokens=tokens,
+                       is_bot=is_bot)
+    if buffer is None:
+        with transaction.atomic():
+            instance.save()
+            maybe_enqueue_summary(conversation_id, instance.cumulative_tokens)
+        return instance
+    item = buffer.add(instance)
+    if wait:
+        return buffer.wait(item, settings.CHAT_WRITE_BEHIND['WAIT_TIMEOUT'])
+    return instance
+
+
+def has_unsaved(conversation_id: int) -> bool:
+    buffer = _buffer
+    return buffer is not None and buffer.has_unsaved(conversation_id)
+
+
+def flush_conversation(conversation_id: int):
+    """会話の未保存のメッセージがあれば書き込む。履歴を読む前に呼ぶ"""
+    if has_unsaved(conversation_id):
+        _buffer.flush()
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+# ASGIではチャットのストリームを非同期ジェネレーターで流す
+os.environ.setdefault('CHAT_ASYNC_STREAM', 'true')
 
 application = get_asgi_application()
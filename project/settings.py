@@ -78,6 +78,18 @@ DATABASES = {
     }
 }
 
+# 読み取り専用のレプリカ。DATABASE_REPLICASにカンマ区切りでDBのファイルを指定する
+# 会話の一覧・詳細・検索だけがレプリカから読む(chat.routers)。テストではdefaultを使う
+CHAT_READ_REPLICAS = []
+for i, name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    DATABASES[f'replica{i}'] = {
+        'ENGINE': DATABASES['default']['ENGINE'],
+        'NAME': name.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    CHAT_READ_REPLICAS.append(f'replica{i}')
+DATABASE_ROUTERS = ['chat.routers.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -119,15 +131,23 @@ AUTH_USER_MODEL = 'account.User'
 
 INSTALLED_APPS += ['corsheaders']
 MIDDLEWARE = ['corsheaders.middleware.CorsMiddleware'] + MIDDLEWARE
+# エンドポイントごとのレイテンシとDBのクエリを計測する(chat.metrics)
+MIDDLEWARE = ['chat.middleware.MetricsMiddleware'] + MIDDLEWARE
 
 # 追加
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        # TokenAuthenticationの結果をキャッシュする
+        'account.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    # ストリームのユーザーごとの制限(chat.throttling)。回数がトークンバケットの容量になる
+    'DEFAULT_THROTTLE_RATES': {
+        'stream': os.environ.get('CHAT_STREAM_RATE', '20/min'),
+        'stream_tokens': os.environ.get('CHAT_STREAM_TOKEN_RATE', '40000/min'),
+    },
 }
 DOMAIN = os.environ.get('DOMAIN', "localhost:3000")
 SITE_NAME = "Example"
@@ -198,3 +218,144 @@ CSRF_COOKIE_AGE = 60 * 60 * 24 * 14  # 14 days
 CSRF_USE_SESSIONS = False
 CSRF_COOKIE_SECURE = False  # For Production set True
 CSRF_COOKIE_HTTPONLY = False
+
+# チャットのストリームを非同期(ASGI)で処理するかどうか
+# asgi.py経由で起動した場合はデフォルトで有効になる
+CHAT_ASYNC_STREAM = os.environ.get('CHAT_ASYNC_STREAM', 'false').lower() == 'true'
+
+# ストリームで返したAIの返事をサーバー側で保存するかどうか
+# 無効(デフォルト)ならこれまで通り、クライアントがストリームの後にai_resを
+# ConversationCreate/MessageCreateへ送って保存する。
+# 有効にするとストリームのビューが両方の発言を保存してsavedイベントで会話IDを返すので、
+# クライアントは保存のリクエストを送らないようにすること(送ると会話やメッセージ、使用量が二重になる)
+CHAT_STREAM_PERSIST = os.environ.get('CHAT_STREAM_PERSIST', 'false').lower() == 'true'
+
+# キーワード検索で返す会話の最大件数。ランク順の上位だけを一覧に渡す
+# (会話IDとランクをSQLのパラメータで渡すので、SQLiteのパラメータの上限に収まる数にする)
+CHAT_SEARCH_MAX_RESULTS = int(os.environ.get('CHAT_SEARCH_MAX_RESULTS', 300))
+
+# トークン数のキャッシュに保持する本文の件数
+CHAT_TOKEN_CACHE_SIZE = int(os.environ.get('CHAT_TOKEN_CACHE_SIZE', 4096))
+
+# upstream(OpenAI)への接続プールの設定
+OPENAI_HTTP = {
+    'MAX_CONNECTIONS': int(os.environ.get('OPENAI_MAX_CONNECTIONS', 100)),
+    'MAX_KEEPALIVE_CONNECTIONS': int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS', 20)),
+    'KEEPALIVE_EXPIRY': float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60)),
+    # h2パッケージが入っている場合だけ有効になる
+    'HTTP2': os.environ.get('OPENAI_HTTP2', 'true').lower() == 'true',
+    'CONNECT_TIMEOUT': float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5)),
+    'READ_TIMEOUT': float(os.environ.get('OPENAI_READ_TIMEOUT', 60)),
+}
+
+# 会話のトピック生成の実行方法 (thread / db / inline)
+CHAT_TOPIC_WORKER = os.environ.get('CHAT_TOPIC_WORKER', 'thread')
+CHAT_TOPIC_WORKERS = int(os.environ.get('CHAT_TOPIC_WORKERS', 2))
+# 生成中のままこの秒数が過ぎた会話は、ワーカーが落ちたものとして拾い直す
+CHAT_TOPIC_CLAIM_TIMEOUT = int(os.environ.get('CHAT_TOPIC_CLAIM_TIMEOUT', 300))
+
+# キャッシュ
+# completionsはコンプリーションのキャッシュ。LocMemCacheはLRUで、
+# FileBasedCacheやDatabaseCacheに切り替えるとワーカー間で共有できる
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'completions': {
+        'BACKEND': os.environ.get('CHAT_COMPLETION_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CHAT_COMPLETION_CACHE_LOCATION', 'completions'),
+        'TIMEOUT': int(os.environ.get('CHAT_COMPLETION_CACHE_TTL', 60 * 60)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CHAT_COMPLETION_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+}
+# 認証済みのトークンのキャッシュ(account.authentication)
+# ログアウトやユーザーの保存でのキャッシュの削除は、同じキャッシュにしか届かない。
+# LocMemCacheはプロセスごとなので、複数ワーカーでは他のワーカーが失効したトークンをTTLの間受け付ける。
+# そのためLocMemCacheのTTLは短くする。長くする場合はRedisやMemcachedなどワーカー間で共有するキャッシュにする
+AUTH_TOKEN_CACHE_BACKEND = os.environ.get('AUTH_TOKEN_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHES['auth'] = {
+    'BACKEND': AUTH_TOKEN_CACHE_BACKEND,
+    'LOCATION': os.environ.get('AUTH_TOKEN_CACHE_LOCATION', 'auth'),
+    'TIMEOUT': int(os.environ.get('AUTH_TOKEN_CACHE_TTL', 10 if 'locmem' in AUTH_TOKEN_CACHE_BACKEND else 300)),
+    'OPTIONS': {
+        'MAX_ENTRIES': int(os.environ.get('AUTH_TOKEN_CACHE_MAX_ENTRIES', 10000)),
+    },
+}
+AUTH_TOKEN_CACHE_ALIAS = 'auth'
+CHAT_COMPLETION_CACHE_ENABLED = os.environ.get('CHAT_COMPLETION_CACHE_ENABLED', 'true').lower() == 'true'
+
+# 生成中の同じリクエストのストリームを共有するかどうか
+CHAT_SINGLE_FLIGHT_ENABLED = os.environ.get('CHAT_SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+# LLMのバックエンド (openai / simulated)
+# simulatedはai_mockの本文を、CHAT_SIMULATED_LLMのレイテンシでストリームする
+CHAT_LLM_BACKEND = os.environ.get('CHAT_LLM_BACKEND', 'openai')
+CHAT_SIMULATED_LLM = {
+    # 最初のトークンまでの秒数
+    'TTFT': float(os.environ.get('CHAT_SIMULATED_TTFT', 0.3)),
+    'TOKENS_PER_SECOND': float(os.environ.get('CHAT_SIMULATED_TOKENS_PER_SECOND', 50)),
+    # 待ち時間を揺らす割合 (0.2なら±20%)
+    'JITTER': float(os.environ.get('CHAT_SIMULATED_JITTER', 0.2)),
+    'ERROR_RATE': float(os.environ.get('CHAT_SIMULATED_ERROR_RATE', 0)),
+    'SEED': os.environ.get('CHAT_SIMULATED_SEED'),
+}
+# OpenAI互換のサーバー(run_mock_llmなど)に向ける場合のURL
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL') or None
+
+# SSEでdeltaをまとめて送る窓。どちらも0ならトークンごとに送る
+CHAT_SSE_COALESCE = {
+    'WINDOW_MS': float(os.environ.get('CHAT_SSE_COALESCE_WINDOW_MS', 30)),
+    'MAX_BYTES': int(os.environ.get('CHAT_SSE_COALESCE_MAX_BYTES', 256)),
+}
+
+# ユーザーごとに同時に開けるストリームの数(0で無制限)と、返し損ねたスロットが切れるまでの秒数
+CHAT_STREAM_MAX_CONCURRENT = int(os.environ.get('CHAT_STREAM_MAX_CONCURRENT', 3))
+CHAT_STREAM_SLOT_TTL = int(os.environ.get('CHAT_STREAM_SLOT_TTL', 600))
+# 制限のカウンタの保存先 (local / sqlite)。複数ワーカーではsqliteにする
+CHAT_LIMIT_STORE = {
+    'BACKEND': os.environ.get('CHAT_LIMIT_STORE', 'local'),
+    'PATH': os.environ.get('CHAT_LIMIT_STORE_PATH', str(BASE_DIR / 'limits.sqlite3')),
+}
+
+# ユーザーごとの月のトークン使用量の上限(0で無制限)。超えるとストリームは429になる
+CHAT_MONTHLY_TOKEN_QUOTA = int(os.environ.get('CHAT_MONTHLY_TOKEN_QUOTA', 0))
+
+# 長い会話の要約。要約されていない分がTHRESHOLDトークンを超えたら、
+# 直近KEEP_TOKENS分を残して古いメッセージを要約し、履歴ではその要約を使う
+CHAT_SUMMARY_ENABLED = os.environ.get('CHAT_SUMMARY_ENABLED', 'false').lower() == 'true'
+CHAT_SUMMARY_THRESHOLD = int(os.environ.get('CHAT_SUMMARY_THRESHOLD', 2000))
+CHAT_SUMMARY_KEEP_TOKENS = int(os.environ.get('CHAT_SUMMARY_KEEP_TOKENS', 1000))
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', 512))
+# 要約の実行方法 (thread / db / inline)。スレッドプールはトピック生成と共有する
+CHAT_SUMMARY_WORKER = os.environ.get('CHAT_SUMMARY_WORKER', CHAT_TOPIC_WORKER)
+# 要約中のままこの秒数が過ぎた会話は、ワーカーが落ちたものとして拾い直す
+CHAT_SUMMARY_CLAIM_TIMEOUT = int(os.environ.get('CHAT_SUMMARY_CLAIM_TIMEOUT', 600))
+
+# メッセージの書き込み遅延(chat.write_behind)。ストリームのpromptとAIの返事を
+# MAX_BATCH件またはFLUSH_MSミリ秒ごとにまとめて一つのトランザクションで保存する
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CHAT_WRITE_BEHIND_ENABLED', 'false').lower() == 'true',
+    'MAX_BATCH': int(os.environ.get('CHAT_WRITE_BEHIND_MAX_BATCH', 100)),
+    'FLUSH_MS': float(os.environ.get('CHAT_WRITE_BEHIND_FLUSH_MS', 20)),
+    # AIの返事の書き込みを待つ最大秒数
+    'WAIT_TIMEOUT': float(os.environ.get('CHAT_WRITE_BEHIND_WAIT_TIMEOUT', 5)),
+}
+
+# 会話履歴の取り込みで一度に保存するメッセージの件数
+CHAT_IMPORT_BATCH_SIZE = int(os.environ.get('CHAT_IMPORT_BATCH_SIZE', 1000))
+# エクスポートでカーソルから一度に読む行数
+CHAT_EXPORT_CHUNK_SIZE = int(os.environ.get('CHAT_EXPORT_CHUNK_SIZE', 2000))
+
+# 放置された会話のアーカイブ(manage.py archive_conversations)。CODECはzlibかzstd(zstandardが必要)
+CHAT_ARCHIVE = {
+    'IDLE_DAYS': int(os.environ.get('CHAT_ARCHIVE_IDLE_DAYS', 90)),
+    'CODEC': os.environ.get('CHAT_ARCHIVE_CODEC', 'zlib'),
+    'LEVEL': int(os.environ.get('CHAT_ARCHIVE_LEVEL', 6)),
+}
+
+# 計測値(/api/chat/metrics/)。CHAT_METRICS_TOKENを設定するとBearerトークンが必要になる。
+# 設定しない場合はスタッフのユーザーだけが見られる
+CHAT_METRICS_ENABLED = os.environ.get('CHAT_METRICS_ENABLED', 'true').lower() == 'true'
+CHAT_METRICS_TOKEN = os.environ.get('CHAT_METRICS_TOKEN', '')